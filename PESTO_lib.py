@@ -7,10 +7,161 @@ Extra-Solaires en Transit et Occultations (PESTO) optical telescope located at
 l’Observatoire du Mont-Mégantic (OMM)
 """
 import os
+import json
+import shutil
+import time
+import fnmatch
+import threading
 from subprocess import run
+from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from astropy.io import fits
 import numpy as np
 
+# compression programs usable by PESTO_data.tar() and untar(), and the 
+# extension of the files they produce
+CODECS = {'gzip':('.gz', ['gzip']),
+          'pigz':('.gz', ['pigz', '-p', '1']), # gzip-compatible
+          'bzip2':('.bz2', ['bzip2']),
+          'xz':('.xz', ['xz'])}
+CODEC_CHUNK = 32 # number of files handled by each call to the program
+
+# tile compression algorithms usable by PESTO_data.fpack(), and the extension 
+# of the tile-compressed files (as written by fpack)
+FPACK_METHODS = ['RICE_1', 'HCOMPRESS_1', 'GZIP_1', 'GZIP_2', 'PLIO_1']
+FPACK_EXTENSION = '.fz'
+
+
+def read_classification(args):
+    """
+    Input: a tuple (path to a .fits file, index of the header to read)
+    Output: the values of the FILTRE, IMAGETYP and OBJECT headers (None if 
+    absent)
+    Opens the file read-only. Used to classify files in parallel.
+    """
+    path, hdr_ind = args
+    hdr_temp = fits.open(path)
+    header = hdr_temp[hdr_ind].header
+    values = (header.get('FILTRE'), header.get('IMAGETYP'), 
+              header.get('OBJECT'))
+    hdr_temp.close()
+    return values
+
+def list_name(f):
+    """
+    Input: the name of a .fits, .fits.gz or .fits.fz file
+    Output: the name of the decompressed file, as written in the lists of 
+    raw_PESTO_data
+    """
+    return f.replace('.gz','').replace(FPACK_EXTENSION,'')
+
+def fpack_frame(args):
+    """
+    Input: a tuple (path to a .fits or .fits.gz file, tile compression 
+    algorithm, quantization level for floating-point images, whether to 
+    remove the original file)
+    Output: the size in bytes of the tile-compressed file written
+    Writes a tile-compressed copy of the file (<name>.fits.fz), in which each 
+    image is compressed by tiles of rows, so that its headers and any 
+    sub-region can later be read without decompressing the whole image. 
+    Integer images are compressed losslessly. The 0th header is kept 
+    uncompressed, so that the headers of an unextended file can still be 
+    read from header 0.
+    """
+    path, method, quantize_level, remove = args
+    dest = path.replace('.gz','')+FPACK_EXTENSION
+    hdul = fits.open(path)
+    new_hdul = fits.HDUList()
+    for n in range(len(hdul)):
+        hdu = hdul[n]
+        if hdu.data is None or isinstance(hdu, fits.CompImageHDU):
+            if n == 0:
+                new_hdul.append(fits.PrimaryHDU(header=hdu.header))
+            else:
+                new_hdul.append(hdu.copy())
+            continue
+        if n == 0: # unextended file: the image goes in the 1st extension
+            header = hdu.header.copy()
+            for key in ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 
+                        'BZERO', 'BSCALE']:
+                header.remove(key, ignore_missing=True)
+            new_hdul.append(fits.PrimaryHDU(header=header))
+        new_hdul.append(fits.CompImageHDU(hdu.data, hdu.header, 
+                                          compression_type=method,
+                                          quantize_level=quantize_level))
+    # write under a temporary name so that a .fz file is always complete
+    temp = dest+'.'+str(os.getpid())+'.tmp'
+    new_hdul.writeto(temp, overwrite=True)
+    hdul.close()
+    os.replace(temp, dest)
+    if remove:
+        os.remove(path)
+    return os.path.getsize(dest)
+
+def funpack_frame(args):
+    """
+    Input: a tuple (path to a .fits.fz file, whether to remove it)
+    Output: the size in bytes of the decompressed file written
+    Restores the .fits file from its tile-compressed copy (see fpack_frame()).
+    """
+    path, remove = args
+    dest = path[:-len(FPACK_EXTENSION)]
+    hdul = fits.open(path)
+    images = [hdu for hdu in hdul[1:] if isinstance(hdu, fits.CompImageHDU)]
+    if len(images) == 1 and not 'NEXTEND' in hdul[0].header:
+        # unextended file: put the image back in the primary HDU
+        new_hdul = fits.HDUList([fits.PrimaryHDU(images[0].data, 
+                                                 images[0].header)])
+    else:
+        new_hdul = fits.HDUList([fits.PrimaryHDU(header=hdul[0].header)])
+        for hdu in hdul[1:]:
+            if isinstance(hdu, fits.CompImageHDU):
+                new_hdul.append(fits.ImageHDU(hdu.data, hdu.header))
+            else:
+                new_hdul.append(hdu.copy())
+    temp = dest+'.'+str(os.getpid())+'.tmp'
+    new_hdul.writeto(temp, overwrite=True)
+    hdul.close()
+    os.replace(temp, dest)
+    if remove:
+        os.remove(path)
+    return os.path.getsize(dest)
+
+def read_header(path, hdr_ind=None):
+    """
+    Input: the path to a .fits, .fits.gz or .fits.fz file, and the index of 
+    the header to read (optional; default is the first header containing 
+    FILTRE)
+    Output: a copy of the header
+    Only the headers are read: the image data is never decompressed.
+    """
+    hdul = fits.open(path)
+    if hdr_ind is None:
+        hdr_ind = 0
+        if not 'FILTRE' in hdul[0].header and len(hdul) > 1:
+            hdr_ind = 1
+    header = hdul[hdr_ind].header.copy()
+    hdul.close()
+    return header
+
+def read_section(path, y0, y1, x0, x1):
+    """
+    Input: the path to a .fits, .fits.gz or .fits.fz file, and the bounds of
+    a sub-region [y0:y1, x0:x1] of its (first) image
+    Output: the sub-region, as float64
+    For tile-compressed files, only the tiles overlapping the sub-region are 
+    decompressed; for .fits files, only the rows of the sub-region are read.
+    """
+    hdul = fits.open(path)
+    for hdu in hdul:
+        if hdu.header.get('NAXIS', 0) >= 2 and hdu.header.get('NAXIS1', 0) > 0:
+            data = np.asarray(hdu.section[y0:y1, x0:x1], dtype=np.float64)
+            hdul.close()
+            return data
+    hdul.close()
+    raise ValueError("No image data found in "+path)
+
 
 class PESTO_data:
      """
@@ -46,31 +197,159 @@ class PESTO_data:
           self.hdr_ind = {} # dictionary of locations and indices to read when
                             # looking at headers in these locations 
  
-     def untar(self):
+     def untar(self, workers=None, codec='gzip'):
           """
-          Input: None
+          Input: the number of files decompressed at once (optional; default 
+          is the number of CPUs) and the compression program, one of CODECS 
+          (optional; default is 'gzip')
           Output: None      
           Decompresses all the (compressed) files associated with
           the PESTO_data object.
+          Only needed for the 'iraf' backend of pyraf_reduction(): the 
+          'numpy' backend reads .fits.gz files directly.
           """
+          ext, program = CODECS[codec]
+          files = []
           for l in self.loc:
-               files = os.listdir(l)
-               for f in files:
-                    if '.gz' in f:
-                         run(['gzip', '-d','-f',l+'/'+f])
+               files += [l+'/'+f for f in os.listdir(l) if ext in f]
+          self.run_codec(files, program+['-d','-f'], workers, "Decompressed")
 
-     def tar(self):
+     def tar(self, workers=None, codec='gzip', level=6):
          """
-         Input: None
+         Input: the number of files compressed at once (optional; default is 
+         the number of CPUs), the compression program, one of CODECS 
+         (optional; default is 'gzip') and the compression level, from 1 
+         (fastest) to 9 (smallest) (optional; default is 6)
          Output: None
          Compresses all the (decompressed) files associated with
-         the PESTO_data object.
+         the PESTO_data object. Files compressed by another program of CODECS
+         are decompressed first rather than compressed twice; files already 
+         compressed by this program, or tile-compressed (.fits.fz), are left 
+         as they are.
          """
+         ext, program = CODECS[codec]
+         # the program decompressing each other extension (gzip for .gz)
+         others = {}
+         for c in ['gzip', 'bzip2', 'xz']:
+              if CODECS[c][0] != ext:
+                   others[CODECS[c][0]] = CODECS[c][1]
+         files = []
+         recompress = dict([(e, []) for e in others])
          for l in self.loc:
-              files = os.listdir(l)
-              for f in files:
-                   if '.gz' not in f:
-                        run(['gzip','-f',l+'/'+f])
+              for f in os.listdir(l):
+                   if (ext in f) or f.endswith(FPACK_EXTENSION) or not (
+                           os.path.isfile(l+'/'+f)):
+                        continue
+                   for e in others:
+                        if f.endswith(e):
+                             recompress[e].append(l+'/'+f)
+                             break
+                   else:
+                        files.append(l+'/'+f)
+         for e in others:
+              if len(recompress[e]) > 0:
+                   self.run_codec(recompress[e], others[e]+['-d','-f'], 
+                                  workers, "Decompressed")
+                   files += [f[:-len(e)] for f in recompress[e]]
+         self.run_codec(files, program+['-f','-'+str(level)], workers, 
+                        "Compressed")
+
+     def fpack(self, workers=None, method='RICE_1', quantize_level=16, 
+               remove=True):
+          """
+          Input: the number of processes converting files at once (optional; 
+          default is the number of CPUs), the tile compression algorithm, one 
+          of FPACK_METHODS (optional; default is 'RICE_1'), the quantization 
+          level for floating-point images (optional; default is 16, as for 
+          fpack) and whether to remove the original files (optional; default
+          True)
+          Output: None
+          Converts all the .fits and .fits.gz files associated with the 
+          PESTO_data object to tile-compressed .fits.fz files, in parallel 
+          (see fpack_frame()). Unlike .fits.gz files, these can be classified,
+          resized and stacked without decompressing them whole.
+          """
+          if not method in FPACK_METHODS:
+               print("Unknown tile compression algorithm: "+method)
+               return
+          files = []
+          for l in self.loc:
+               files += [l+'/'+f for f in os.listdir(l) if ('.fits' in f) and 
+                         not f.endswith(FPACK_EXTENSION) and 
+                         os.path.isfile(l+'/'+f)]
+          self.run_pool(fpack_frame, [(f, method, quantize_level, remove) for
+                                      f in files], files, workers, "Packed")
+
+     def funpack(self, workers=None, remove=True):
+          """
+          Input: the number of processes converting files at once (optional; 
+          default is the number of CPUs) and whether to remove the .fits.fz 
+          files (optional; default True)
+          Output: None
+          Restores the .fits files from the tile-compressed files associated 
+          with the PESTO_data object, in parallel. Only needed for the 'iraf' 
+          backend of pyraf_reduction().
+          """
+          files = []
+          for l in self.loc:
+               files += [l+'/'+f for f in os.listdir(l) if 
+                         f.endswith(FPACK_EXTENSION)]
+          self.run_pool(funpack_frame, [(f, remove) for f in files], files, 
+                        workers, "Unpacked")
+
+     def run_pool(self, function, args, files, workers=None, verb="Processed"):
+         """
+         Input: a function converting one file, the list of its arguments, 
+         the list of files converted, the number of processes (optional; 
+         default is the number of CPUs) and the verb used in the report
+         Output: None
+         Runs the function on a pool of processes and reports the throughput.
+         """
+         if len(files) == 0:
+              return
+         size_in = sum([os.path.getsize(f) for f in files])
+         start = time.time()
+         pool = Pool(workers)
+         size_out = sum(pool.map(function, args, chunksize=16))
+         pool.close()
+         pool.join()
+         self.report(verb, len(files), size_in, time.time()-start, size_out)
+
+     def report(self, verb, n_files, size_in, elapsed, size_out=None):
+         """
+         Input: the verb used in the report, the number of files processed, 
+         their size in bytes, the time taken in s and the size of the 
+         resulting files in bytes (optional)
+         Output: None
+         Prints the throughput of a compression or decompression.
+         """
+         elapsed = max(elapsed, 1e-6)
+         sizes = ("%.1f"%(size_in/1e6))+" MB"
+         if size_out is not None:
+              sizes += " -> "+("%.1f"%(size_out/1e6))+" MB"
+         print(verb+" "+str(n_files)+" files ("+sizes+") in "+
+               ("%.1f"%elapsed)+" s: "+("%.1f"%(size_in/1e6/elapsed))+
+               " MB/s, "+("%.0f"%(n_files/elapsed))+" files/s")
+
+     def run_codec(self, files, command, workers=None, verb="Processed"):
+         """
+         Input: a list of paths, the command to run on them (e.g. 
+         ['gzip','-f']), the number of commands run at once (optional; 
+         default is the number of CPUs) and the verb used in the report
+         Output: None
+         Runs the command on the files, a chunk of files per call, using a 
+         bounded pool of workers, and reports the throughput.
+         """
+         if len(files) == 0:
+              return
+         size_in = sum([os.path.getsize(f) for f in files])
+         start = time.time()
+         chunks = [files[i:i+CODEC_CHUNK] for i in 
+                   range(0, len(files), CODEC_CHUNK)]
+         pool = ThreadPoolExecutor(workers or os.cpu_count())
+         list(pool.map(lambda chunk: run(command+chunk), chunks))
+         pool.shutdown()
+         self.report(verb, len(files), size_in, time.time()-start)
 
      def flush(self): 
          """
@@ -78,30 +357,54 @@ class PESTO_data:
          Output:None
          Flushes the working directory of unneeded files and directories.
          """
-         temp = os.getcwd()
-    
-         os.chdir(self.tgt+'/'+self.name)
-         run('rm -rf ./*/', shell=True) # directories  
-         run('rm -rf *.py', shell=True) # scripts
-         run('rm -rf *.fits', shell=True) # fits files 
-         run('rm -rf *.txt', shell=True) # text files (lists) 
-         run('rm -rf *.par', shell=True) # related to iraf
-         run('rm -rf logfile', shell=True) # related to iraf
-
-         os.chdir(temp)
+         wd = self.tgt+'/'+self.name
+         if not os.path.isdir(wd):
+              return
+         # run in the working directory, without changing that of the process
+         run('rm -rf ./*/', shell=True, cwd=wd) # directories  
+         run('rm -rf *.py', shell=True, cwd=wd) # scripts
+         run('rm -rf *.fits', shell=True, cwd=wd) # fits files 
+         run('rm -rf *.txt', shell=True, cwd=wd) # text files (lists) 
+         run('rm -rf *.par', shell=True, cwd=wd) # related to iraf
+         run('rm -rf logfile', shell=True, cwd=wd) # related to iraf
+
          print("\nFlush!")
 
 ###############################################################################
 
 class raw_PESTO_data(PESTO_data):
-     
-    def __init__(self,locations_list,image_type_list,name, target_directory):
+    """
+    Input: as for PESTO_data, plus
+    target_directory: the directory in which to create the working directory
+    manifest: a header_manifest (see manifest.py) indexing the locations 
+              (optional; default is to read the headers of the files directly)
+    unique: whether to give the working directory a unique name, <name>_xxxx,
+            so that several stacks can be reduced at the same time in the 
+            same target directory (optional; default False)
+    
+    Output: raw_PESTO_data object
+    """
+    def __init__(self,locations_list,image_type_list,name, target_directory,
+                 manifest=None, unique=False):
         super(raw_PESTO_data, self).__init__(locations_list,image_type_list,
              name)
-        self.tgt = target_directory
+        self.tgt = os.path.abspath(target_directory)
+        if unique: # reserve the name by creating the directory
+            os.makedirs(self.tgt, exist_ok=True)
+            self.name = os.path.basename(mkdtemp(prefix=name+'_', 
+                                                 dir=self.tgt))
         self.reduced = False # updated later 
         self.list_made = False
         self.workdir_present = False
+        self.manifest = manifest
+        self.header_fixes = {} # header changes needed by iraf, by filename
+
+        # with a manifest, only new or modified files are read
+        if self.manifest is not None:
+            self.manifest.refresh(self.loc)
+            for l in self.loc:
+                self.hdr_ind[l] = self.manifest.hdr_index(l)
+            return
 
         # allow new data to be read regardless of header indexing.
         # assumption: only need to look at one .fits per location, and if 
@@ -134,7 +437,10 @@ class raw_PESTO_data(PESTO_data):
         WARNING: This PERMANENTLY modifies data in a given directory.
         """
         for l in self.loc: # for all files in data directories 
-            files = os.listdir(l)
+            if self.manifest is not None:
+                files = [row['filename'] for row in self.manifest.files(l)]
+            else:
+                files = os.listdir(l)
             for f in files: 
                 if '.fits' in f:
                     if self.hdr_ind[l] != 0: # if looking at extended files 
@@ -157,6 +463,8 @@ class raw_PESTO_data(PESTO_data):
                                hdu.header.remove('NEXTEND') 
                                hdu.header.append(('NEXTEND',n_extend)) 
                 hdr_temp.close()
+        if self.manifest is not None: # the modified files must be read again
+            self.manifest.refresh(self.loc)
 
     def resize(self, sf, df, mode, sizes):
         """
@@ -169,15 +477,21 @@ class raw_PESTO_data(PESTO_data):
         source and destination folders. 
         """
         if '.fits' in sf:
-            hdr = fits.open(sf,mode='update')
+            packed = sf.endswith(FPACK_EXTENSION)
+            if packed: # written decompressed
+                hdr = fits.open(sf)
+                df = df[:-len(FPACK_EXTENSION)]
+            else:
+                hdr = fits.open(sf,mode='update')
             n_extend = range(1)
-            if not 'FILTRE' in hdr[0].header:
+            if packed and not 'NEXTEND' in hdr[0].header:
+                n_extend = range(1,2) # unextended: image in 1st extension
+            elif not 'FILTRE' in hdr[0].header:
                 print("Extended file detected.")
                 fits.append(df,hdr[0].data,hdr[0].header)
                 n_extend = range(1,hdr[0].header['NEXTEND'])
             for n in n_extend:                
-                image_header = hdr[n].header
-                image_data = hdr[n].data
+                image_header = hdr[n].header.copy()
                 if 'NAXIS1' in image_header and 'NAXIS2' in image_header:
                     x = image_header['NAXIS1']
                     y = image_header['NAXIS2']
@@ -186,8 +500,10 @@ class raw_PESTO_data(PESTO_data):
                                 sizes[0]+sizes[1])>x or (sizes[2]+sizes[3])>y:
                             print("Dimensions to trim are out of range for: "+sf)
                             return
-                        new_image_data = image_data[(sizes[2]):(y-sizes[3]), (
-                                sizes[0]):(x-sizes[1])]
+                        # only the kept region is read (for tile-compressed
+                        # files, only the tiles which overlap it)
+                        new_image_data = hdr[n].section[(sizes[2]):(y-sizes[3]), 
+                                (sizes[0]):(x-sizes[1])]
                         image_header["NAXIS1"]=x-(sizes[0]+sizes[1])
                         image_header["NAXIS2"]=y-(sizes[2]+sizes[3])
                         fits.append(df,new_image_data,image_header)
@@ -195,6 +511,7 @@ class raw_PESTO_data(PESTO_data):
                         if not all(s>=0 for s in sizes):
                             print("Dimensions to extend by are out of range for: "+sf)
                             return
+                        image_data = hdr[n].data
                         new_image_data = np.hstack((np.full((y,sizes[0]),np.nan), 
                                                     image_data, 
                                                     np.full((y,sizes[1]),np.nan)))
@@ -232,74 +549,224 @@ class raw_PESTO_data(PESTO_data):
  
 ###############################################################################
 
-    def produce_lists(self):
+    def produce_lists(self, readonly=False, processes=None):
         """
-        Input: None
+        Input: whether to leave the files untouched (optional; default False)
+        and the number of processes used to read headers in read-only mode 
+        (optional; default is the number of CPUs)
         Output: None
         Produces lists of .fits files associated with the raw_PESTO_data 
         object. e.g all images of the object taken in the r band are added to 
         self.r_obj, all calibration images in the r band are added to 
         self.r_cal, etc.
+        If the object has a manifest, the files are classified using the 
+        manifest, and only the files whose headers have not yet been adjusted 
+        for iraf are opened.
+        In read-only mode, the headers are read in parallel and no file is 
+        modified. The header changes iraf needs are kept in self.header_fixes 
+        and are only applied to the copies in the working directory (see 
+        make_working_directory()).
         """
         if not self.list_made:
-            for l in self.loc:			
+            for l in self.loc:
+                run_type = self.imtype[l]
+                if readonly:
+                    self.produce_lists_readonly(l, run_type, processes)
+                    continue
+                if self.manifest is not None:
+                    self.produce_lists_from_manifest(l, run_type)
+                    continue
                 files = os.listdir(l)
-                run_type = self.imtype[l]   
                 for f in files:
-                    if '.fits' in f:
+                    if f.endswith(FPACK_EXTENSION):
+                        # rewriting the header would mean recompressing the
+                        # file: the changes are made on the working copy
+                        self.produce_lists_packed(l, f, run_type)
+                    elif '.fits' in f:
                         hdr_temp = fits.open(l+'/'+f, mode = 'update')
                         hdu = hdr_temp[self.hdr_ind[l]] 
                         hdu.header['NAXIS'] = 3
 
                         # adds the type of frame (flat, bias, object, etc...) 
                         # to the fits header to help iraf's data reduction
-                        ## CALIBRATION files (biases, flats)
-                        if run_type == 'calibration':
-                            # check 2 conditions to see if it's a flat
-                            condition1 = ('OBJECT' in hdu.header) and (
-                                    'flat' in hdu.header['object'])
-                            condition2 = ('IMAGETYP' in hdu.header) and (
-                                    'flat' in hdu.header['imagetyp'])
-                            isflat = condition1 or condition2
-                            # produce a list of biases
-                            if ('IMAGETYP' in hdu.header) and (
-                                    'zero' in hdu.header['imagetyp']):
-                                self.bias.append(f.replace('.gz',''))
-                            # roduce lists of flats in each band 
-                            elif isflat:
-                                if 'r' in hdu.header['filtre']:
-                                    self.r_cal.append(f.replace('.gz',''))
-                                elif 'g' in hdu.header['filtre']:
-                                    self.g_cal.append(f.replace('.gz',''))
-                                elif 'i' in hdu.header['filtre']:
-                                    self.i_cal.append(f.replace('.gz',''))
-                                elif 'z' in hdu.header['filtre']:
-                                    self.z_cal.append(f.replace('.gz',''))
-
-                        ## OBJECT files 
-                        elif run_type == 'object':
+                        if run_type == 'object':
                             hdu.header['imagetyp'] = 'object'
-                            if 'r' in hdu.header['filtre']:
-                                self.r_obj.append(f.replace('.gz',''))
-                            elif 'g' in hdu.header['filtre']:
-                                self.g_obj.append(f.replace('.gz',''))
-                            elif 'i' in hdu.header['filtre']:
-                                self.i_obj.append(f.replace('.gz',''))
-                            elif 'z' in hdu.header['filtre']:
-                                self.z_obj.append(f.replace('.gz',''))
+                        self.classify(f, run_type, hdu.header.get('filtre'),
+                                      hdu.header.get('imagetyp'), 
+                                      hdu.header.get('object'))
 
                         hdr_temp.close() 
 
-                self.list_made=True # update this bool
+            self.list_made=True # update this bool
+
+    def produce_lists_readonly(self, l, run_type, processes=None):
+        """
+        Input: a data directory, the type of its files ('calibration' or 
+        'object') and the number of processes used to read headers (optional;
+        default is the number of CPUs; 1 reads them in this process)
+        Output: None
+        Classifies the files of the directory without modifying them, and 
+        records the header changes needed by iraf in self.header_fixes.
+        """
+        if self.manifest is not None:
+            rows = [row for row in self.manifest.files(l) 
+                    if row['hdr_ind'] is not None]
+            files = [row['filename'] for row in rows]
+            values = [(row['filtre'], row['imagetyp'], row['object']) 
+                      for row in rows]
+        else:
+            files = [f for f in os.listdir(l) if '.fits' in f]
+            args = [(l+'/'+f, self.hdr_ind[l]) for f in files]
+            if processes == 1: # e.g. within a worker of pipeline.py
+                values = [read_classification(a) for a in args]
+            else:
+                pool = Pool(processes)
+                values = pool.map(read_classification, args, chunksize=64)
+                pool.close()
+                pool.join()
+
+        for f, (filtre, imagetyp, obj) in zip(files, values):
+            # iraf expects NAXIS = 3, and IMAGETYP = 'object' for objects
+            fix = {'NAXIS':3}
+            if run_type == 'object':
+                fix['IMAGETYP'] = 'object'
+                imagetyp = 'object'
+            self.header_fixes[list_name(f)] = [self.hdr_ind[l], fix]
+            self.classify(f, run_type, filtre, imagetyp, obj)
+
+    def apply_header_fixes(self, directory):
+        """
+        Input: the directory containing the copies of the files to fix 
+        (usually the working directory)
+        Output: None
+        Applies the header changes recorded by produce_lists(readonly=True) 
+        to the copies of the files in the directory, and saves them to the 
+        sidecar file header_fixes.json in that directory. Tile-compressed 
+        copies are decompressed first, since iraf cannot read them.
+        """
+        f = open(directory+'/header_fixes.json', 'w')
+        json.dump(self.header_fixes, f)
+        f.close()
+        for name in self.header_fixes:
+            path = directory+'/'+name
+            if os.path.exists(path+FPACK_EXTENSION):
+                funpack_frame((path+FPACK_EXTENSION, True))
+            if not os.path.exists(path):
+                continue
+            hdr_ind, fix = self.header_fixes[name]
+            hdr_temp = fits.open(path, mode = 'update')
+            for key in fix:
+                hdr_temp[hdr_ind].header[key] = fix[key]
+            hdr_temp.close()
+
+    def produce_lists_from_manifest(self, l, run_type):
+        """
+        Input: a data directory and the type of its files ('calibration' or 
+        'object')
+        Output: None
+        Classifies the files of the directory using the manifest. The headers 
+        are only updated (NAXIS = 3, and IMAGETYP = 'object' for objects) in 
+        the files where this has not been done yet. 
+        """
+        changed = False
+        for row in self.manifest.files(l):
+            f = row['filename']
+            if row['hdr_ind'] is None: # unreadable file
+                continue
+            if f.endswith(FPACK_EXTENSION):
+                self.produce_lists_packed(l, f, run_type, row)
+                continue
+            imagetyp = row['imagetyp']
+            if (row['naxis'] != 3) or (run_type == 'object' and 
+                                       imagetyp != 'object'):
+                hdr_temp = fits.open(l+'/'+f, mode = 'update')
+                hdu = hdr_temp[row['hdr_ind']]
+                hdu.header['NAXIS'] = 3
+                if run_type == 'object':
+                    hdu.header['imagetyp'] = 'object'
+                hdr_temp.close()
+                changed = True
+            if run_type == 'object':
+                imagetyp = 'object'
+            self.classify(f, run_type, row['filtre'], imagetyp, row['object'])
+        if changed: # the modified files must be read again
+            self.manifest.refresh([l])
+
+    def produce_lists_packed(self, l, f, run_type, row=None):
+        """
+        Input: a data directory, the name of a tile-compressed (.fits.fz) file
+        in it, the type of its files ('calibration' or 'object') and its row 
+        in the manifest (optional; default is to read its header)
+        Output: None
+        Classifies the file without modifying it. Only its header is read. 
+        The header changes needed by iraf are recorded in self.header_fixes, 
+        and applied to the decompressed copy in the working directory.
+        """
+        if row is not None:
+            hdr_ind = row['hdr_ind']
+            filtre, imagetyp, obj = row['filtre'], row['imagetyp'], row['object']
+        else:
+            hdr_ind = self.hdr_ind[l]
+            header = read_header(l+'/'+f, hdr_ind)
+            filtre = header.get('FILTRE')
+            imagetyp = header.get('IMAGETYP')
+            obj = header.get('OBJECT')
+        fix = {'NAXIS':3}
+        if run_type == 'object':
+            fix['IMAGETYP'] = 'object'
+            imagetyp = 'object'
+        self.header_fixes[list_name(f)] = [hdr_ind, fix]
+        self.classify(f, run_type, filtre, imagetyp, obj)
+
+    def classify(self, f, run_type, filtre, imagetyp, obj):
+        """
+        Input: a filename, the type of files of its directory ('calibration'
+        or 'object'), and the values of its FILTRE, IMAGETYP and OBJECT 
+        headers (None if absent)
+        Output: None
+        Adds the file to the list matching its type and band.
+        """
+        ## CALIBRATION files (biases, flats)
+        if run_type == 'calibration':
+            # check 2 conditions to see if it's a flat
+            condition1 = (obj is not None) and ('flat' in obj)
+            condition2 = (imagetyp is not None) and ('flat' in imagetyp)
+            isflat = condition1 or condition2
+            # produce a list of biases
+            if (imagetyp is not None) and ('zero' in imagetyp):
+                self.bias.append(list_name(f))
+                return
+            # produce lists of flats in each band 
+            elif isflat:
+                lists = [self.r_cal, self.g_cal, self.i_cal, self.z_cal]
+            else:
+                return
+        ## OBJECT files 
+        elif run_type == 'object':
+            lists = [self.r_obj, self.g_obj, self.i_obj, self.z_obj]
+        else:
+            return
+        for band, band_list in zip(['r','g','i','z'], lists):
+            if band in filtre:
+                band_list.append(list_name(f))
+                break
     
-    def make_working_directory(self):
+    def make_working_directory(self, link=None, fix_headers=True):
         """
-        Input: None
+        Input: how to bring the files into the working directory: None to copy
+        them, 'hardlink' or 'symlink' (optional; default is None), and whether 
+        to apply the header changes recorded by produce_lists(readonly=True) 
+        (optional; default True, not needed by the 'numpy' backend)
         Output: None
         Creates a directory containing all .fits files associated to the 
         object and one .txt file for each list bound to the raw_PESTO_data 
         object. The created directory contains everything PyRAF needs for the 
         data reduction.   
+        With links, only the files whose headers must change are copied; all 
+        others are linked, so that building the working directory does not 
+        copy any data. (iraf's ccdproc replaces the images it processes with 
+        new files rather than writing into them, so the linked originals are 
+        not modified.)
         """
         if not self.workdir_present:
              l = self.tgt+'/'+self.name
@@ -327,12 +794,89 @@ class raw_PESTO_data(PESTO_data):
             
              self.workdir_present = True
 
+             if link is not None:
+                 self.link_working_directory(link, fix_headers)
+                 return
+
              # copy all files in loc directories to the working directory
              # give full permissions to everything 
              for l in self.loc:
                  run(['rsync','-r','-p',l+'/',self.tgt+'/'+self.name]) 
              run('chmod 777 '+self.tgt+'/'+self.name+'/*', shell=True)
+
+             # if the lists were produced read-only, fix the copies for iraf
+             if fix_headers and len(self.header_fixes) > 0:
+                 self.apply_header_fixes(self.tgt+'/'+self.name)
+
+    def link_working_directory(self, link='hardlink', fix_headers=True):
+        """
+        Input: the type of link, 'hardlink' or 'symlink' (optional; default 
+        is 'hardlink'), and whether to apply the header changes recorded by 
+        produce_lists(readonly=True) (optional; default True)
+        Output: None
+        Fills the working directory with links to the files in the loc 
+        directories. Files whose headers must change are copied instead, and 
+        only these copies are modified. Hardlinks which cannot be made (e.g. 
+        across filesystems) are replaced by copies. Subdirectories of the loc 
+        directories are not included.
+        """
+        wd = self.tgt+'/'+self.name
+        to_copy = set()
+        if fix_headers:
+            to_copy = set(self.header_fixes)
+        for l in self.loc:
+            for entry in os.scandir(l):
+                if not entry.is_file():
+                    continue
+                dest = wd+'/'+entry.name
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                if entry.name in to_copy:
+                    shutil.copyfile(entry.path, dest)
+                    os.chmod(dest, 0o777)
+                elif link == 'symlink':
+                    os.symlink(os.path.abspath(entry.path), dest)
+                else:
+                    try:
+                        os.link(entry.path, dest)
+                    except OSError:
+                        shutil.copyfile(entry.path, dest)
+        if fix_headers and len(self.header_fixes) > 0:
+            self.apply_header_fixes(wd)
  
+    def make_frame_cubes(self, cube_directory, threads=None):
+        """
+        Input: the directory in which to write the cubes, and the number of
+        threads used to read the frames (optional; default is chosen by 
+        concurrent.futures)
+        Output: a dictionary of framecube.frame_cube objects, by band
+        Packs the object frames of each band into a memory-mapped cube named
+        <name>_<band> (see framecube.py). Stacks of any range of frames can 
+        then be made from the cube without a working directory.
+        """
+        import framecube
+        import reduction
+        if not self.list_made:
+            print('Please make sure lists for each band were produced')
+            return {}
+        objects = [l for l in self.loc if self.imtype[l] == 'object']
+        cubes = {}
+        for filter_type, obj in [('r', self.r_obj), ('g', self.g_obj), 
+                                 ('i', self.i_obj), ('z', self.z_obj)]:
+            if len(obj) == 0:
+                continue
+            paths = []
+            for f in obj:
+                for l in objects:
+                    path = reduction.resolve(l+'/'+f)
+                    if os.path.exists(path):
+                        paths.append(path)
+                        break
+            cubes[filter_type] = framecube.ingest(paths, cube_directory+'/'+
+                                                  self.name+'_'+filter_type,
+                                                  threads=threads)
+        return cubes
+
     def delete_working_directory(self):
          """
          Input: None
@@ -343,34 +887,121 @@ class raw_PESTO_data(PESTO_data):
               run(['rm', '-r', self.tgt+'/'+self.name])
               self.workdir_present=False
 
-    def pyraf_reduction(self, results_file="results.txt"):
+    def pyraf_reduction(self, results_file="results.txt", backend="iraf",
+                        ram_budget=None, library=None, zerocor=False,
+                        night=None, workers=None, spool=None):
         """
-        Input: The name of the results file to which we save the data 
-        (optional; "results.txt" by default)
+        Input: The name of the results file to which we save the data
+        (optional; "results.txt" by default), the reduction backend, either
+        'iraf' or 'numpy' (optional; "iraf" by default), for the 'numpy'
+        backend, a memory budget in bytes (optional; default is no budget), a
+        calibration_library (see calibration.py) holding the master flats and
+        biases (optional; default is to combine the flats for every stack),
+        whether to bias-correct the object images (optional; default is
+        False, as OMM data is already bias-corrected) and the night from which
+        to measure the timestamps, e.g. '2018-07-09' (optional; default is the
+        date of the earliest frame of the stack, see headerstats.py) and, for
+        the 'numpy' backend, the number of bands reduced at once (optional; 
+        default is all bands at once) and, for the 'daemon' backend, the spool 
+        directory of the IRAF workers (see iraf_daemon.py)
         Output: None
+        With the 'iraf' backend, datared.py is run with PyRAF in a separate
+        Python 2 process. With the 'daemon' backend, the working directory is
+        sent to long-lived IRAF workers (see iraf_daemon.py), which have 
+        loaded PyRAF once, and this waits for the reduction to finish (at
+        most iraf_daemon.TIMEOUT). With the 'numpy' backend, the same
+        reduction is performed by reduction.py, without starting IRAF, and
+        the bands are reduced concurrently, one process each (or one after
+        the other within a worker of a pool, e.g. that of pipeline.py). If a
+        memory budget is given, the frames are memory-mapped and stacked in
+        tiles of rows which fit within the budget, so that stacks of 1000 or
+        3000 frames never have to be loaded in full. The 'numpy' backend also 
+        reads compressed (.fits.gz) frames directly, decompressing them in 
+        memory, so the frames need not be gunzipped beforehand (see untar()).
+        If a library is given, the master flat of each band (and the master
+        bias) is only combined the first time its calibration files are seen,
+        and is copied into the working directory for every later stack.
+        Without a library, zerocor makes the IRAF backends combine the biases
+        themselves (see datared.py).
+        Raises a RuntimeError if the 'daemon' backend's job fails, or does not
+        finish in time.
         """
         if self.list_made==False:
             return 'Please make sure lists for each band were produced'
         if self.workdir_present==False:
             return 'Please make sure a working directory exists'
-        temp = os.getcwd()
-        run(['rsync','datared.py',self.tgt+'/'+self.name])
-        os.chdir(self.tgt+'/'+self.name)
+        if backend == "numpy":
+            import reduction
+            reduction.reduce_working_directory(self.tgt+'/'+self.name,
+                                               results_file,
+                                               ram_budget=ram_budget,
+                                               library=library,
+                                               zerocor=zerocor,
+                                               night=night, 
+                                               workers=workers)
+            return
+        elif backend not in ["iraf", "daemon"]:
+            return 'Please use the backend "iraf", "daemon" or "numpy"'
+        if library is not None:
+            # datared.py skips flatcombine if Flat_<band>.fits is present and
+            # applies a bias correction if bias.fits is present
+            l = self.tgt+'/'+self.name
+            for filter_type, cal, obj in [('r', self.r_cal, self.r_obj),
+                                          ('g', self.g_cal, self.g_obj),
+                                          ('i', self.i_cal, self.i_obj),
+                                          ('z', self.z_cal, self.z_obj)]:
+                if len(cal) > 0 and len(obj) > 0:
+                    master = library.master_flat([l+'/'+f for f in cal],
+                                                 filter_type, ram_budget)
+                    run(['cp', '-f', master, l+'/Flat_'+filter_type+'.fits'])
+            if zerocor and len(self.bias) > 0:
+                master = library.master_bias([l+'/'+f for f in self.bias],
+                                             ram_budget)
+                run(['cp', '-f', master, l+'/bias.fits'])
+        if backend == "daemon":
+            import iraf_daemon
+            if spool is None:
+                return 'Please give the spool directory of the IRAF workers'
+            job = iraf_daemon.submit(spool, self.tgt+'/'+self.name, 
+                                     results_file, night, zerocor=zerocor)
+            status = iraf_daemon.wait(spool, job)
+            if status is None:
+                raise RuntimeError("Reduction of "+self.tgt+'/'+self.name+
+                                   " did not finish within "+
+                                   str(iraf_daemon.TIMEOUT)+" s")
+            elif status['status'] != 'done':
+                raise RuntimeError("Reduction of "+self.tgt+'/'+self.name+
+                                   " failed:\n"+status.get('error', ''))
+            return
+        # datared.py is run in the working directory, as a separate process, 
+        # so the working directory of this process is never changed
+        here = os.path.dirname(os.path.abspath(__file__))
+        run(['rsync',here+'/datared.py',here+'/headerstats.py',
+             self.tgt+'/'+self.name])
+        args = results_file
+        if night is not None:
+            args += " "+night
+        if zerocor:
+            args += " --zerocor"
         run("bash -c 'source activate iraf27 && python2 datared.py "+
-            results_file+" && source deactivate'", shell=True)
-        os.chdir(temp)
+            args+" && source deactivate'", shell=True, 
+            cwd=self.tgt+'/'+self.name)
 
     def extract_reduced_images(self, reduced_data_folder_loc, 
-                               reduced_data_folder_name):
+                               reduced_data_folder_name=None):
         """
         Input: the parent directory of the reduced data directory, and the name 
-        of the directory itself 
+        of the directory itself (optional; default is the name of the working
+        directory, which is unique if the object was created with unique=True)
         Output: a reduced_PESTO_data object 
         Creates the necessary directories to begin WCS/photometric calibration
         of the stacked image.
         """
+        if reduced_data_folder_name is None:
+            reduced_data_folder_name = self.name
         # create necessary directory, copy over stack's .fits file 
-        run(['mkdir', reduced_data_folder_loc+'/'+reduced_data_folder_name])
+        run(['mkdir', '-p', 
+             reduced_data_folder_loc+'/'+reduced_data_folder_name])
         run('cp -r '+self.tgt+'/'+self.name+'/*reduced.fits '+
             reduced_data_folder_loc+'/'+reduced_data_folder_name, shell=True) 
         return reduced_PESTO_data([reduced_data_folder_loc], ['object'], 
@@ -397,9 +1028,8 @@ class reduced_PESTO_data(PESTO_data):
        astrometry unless all 3 quantities are estimated. Same is true for 
        min_scale and max_scale.
        """
-       temp = os.getcwd()
-       os.chdir(self.loc[0]+'/'+self.name) # move to reduced data directory
-       files = os.listdir()
+       d = self.loc[0]+'/'+self.name # reduced data directory
+       files = os.listdir(d)
       
        # reference pixel is at the center of the region of interest
        center_x = roi_x[0] + (roi_x[1] - roi_x[0])/2.0 
@@ -436,11 +1066,10 @@ class reduced_PESTO_data(PESTO_data):
             #options += " --nsigma 6" # decrease sigma required for source detection (default 8) -> increase source count
             #options += " --odds-to-solve 1e5" # decrease odds required to come to a soln (default 1e9) -> increase odds
 
-            run("solve-field "+str(options)+" "+f, shell=True)
+            # solve-field and find are run in the reduced data directory
+            run("solve-field "+str(options)+" "+f, shell=True, cwd=d)
             run("find . -type f -not -name '*wcs*' -print0 | xargs -0 rm --",
-                shell=True) # remove all files not in format *wcs*
-
-       os.chdir(temp) # return to original directory
+                shell=True, cwd=d) # remove all files not in format *wcs*
 
      def WCS_merge(self, wcs_location, delta_x=0, delta_y=0):
         """
@@ -453,9 +1082,7 @@ class reduced_PESTO_data(PESTO_data):
 
         hdu_wcs = fits.open(wcs_location, mode='readonly')[0]
 
-        temp = os.getcwd()
-        os.chdir(self.loc[0]+'/'+self.name) # move to reduced data directory
-        files = os.listdir()
+        files = os.listdir(self.loc[0]+'/'+self.name) # reduced data directory
         for f in files:
              hdu_temp = fits.open(
                      self.loc[0]+'/'+self.name+'/'+f,mode='update')[0]
@@ -494,8 +1121,6 @@ class reduced_PESTO_data(PESTO_data):
              hdu_temp.writeto(self.loc[0]+'/'+self.name+'/'+f,'warn',
                               overwrite=True) # merge the WCS solution
 
-        os.chdir(temp)
-
      def WCS_preparation(self, angle=0):
         """
         Input: The angle of the frame relative to a frame where x=RA, y=DEC, 
@@ -558,21 +1183,64 @@ class reduced_PESTO_data(PESTO_data):
                               overwrite=True) 
 
      def photometry(self, RA_bounds, DEC_bounds, thresh_factor=3.0,
-                    results_file="results.txt"):
+                    results_file="results.txt", output_dir=None, 
+                    cache_dir=None, offline=False, fields=None, 
+                    mode="segmentation", positions=None, 
+                    apertures=(6.0, 10.0, 15.0), targets=None, stats=None, 
+                    zero_point=None):
         """
         Input: a threshold factor to be used in selecting what level of 
         background to ignore during image segmentation, 2 arrays denoting the 
         RA and Dec boundaries (in degrees) of the source to detect, and the 
         results file to append to (optional; default is 'results.txt' 
         ***If a non-default name is used in pyraf_reduction(), the same 
-        filename must be used here.
+        filename must be used here.), and the directory in which to write 
+        the segmented image, the .csv and the results file (optional; default 
+        is the current working directory; an absolute results_file is used 
+        as-is), the directory of the reference catalogue cache (optional; 
+        default is to query Vizier for every image; see catalogue.py) and 
+        whether to only use catalogue tiles already in the cache (optional; 
+        default False), and a dictionary of the field models of the night, 
+        by filter, reused from one stack to the next (optional; e.g. an empty 
+        dictionary created before the loop over the stacks of a night; see 
+        fieldmodel.py), the photometry mode, either "segmentation" (detect 
+        the sources, then find the one within the bounds) or "forced" 
+        (measure known positions; see aperturephotometry.forced_photometry()) 
+        (optional; default "segmentation"), the (RA, Dec) positions to measure 
+        in forced mode, the first being the target (optional; default is the 
+        centre of the RA and Dec boundaries), and the radii of the apertures 
+        and of the background annuli in forced mode (optional; default 6, 10 
+        and 15 pixels), and a list of other targets (e.g. comparison stars), 
+        each a tuple (name, RA boundaries, Dec boundaries), measured in the 
+        same pass, each with its own results file (optional; default is none; 
+        in forced mode, the centre of the boundaries is measured; see 
+        aperturephotometry.write_rows()), and the statistics of the stack in 
+        each band, by filter, to write before the results of the band 
+        (optional; default is none, when the reduction already wrote them to 
+        the results file), and the zero point of the magnitudes in forced 
+        mode (optional; default is to calibrate them against the reference 
+        catalogue, as in segmentation mode)
         Output: None
         
         e.g. reduced_dataset.photometry([275.1,276.2], [7.10,7.18], 3.5)
         Produces a segmented image and a .csv with properties for all the 
         sources and appends properties of the specified source to the results 
         file (if it is found)
+        
+        e.g. reduced_dataset.photometry([275.1,276.2], [7.10,7.18], 
+                                        mode="forced")
+        Measures the centre of the boundaries in an aperture, with no image 
+        segmentation, and appends its properties to the results file
         """
+        if targets is None:
+             targets = []
+        if mode == "forced" and positions is None:
+             positions = [(np.mean(RA_bounds), np.mean(DEC_bounds))]
+        if mode == "forced":
+             names = [t[0] for t in targets]
+             positions = ([tuple(positions[0])]+
+                          [(np.mean(t[1]), np.mean(t[2])) for t in targets]+
+                          [tuple(p) for p in positions[1:]])
         import aperturephotometry
         files = os.listdir(self.loc[0]+'/'+self.name)
         for f in files: 
@@ -583,10 +1251,130 @@ class reduced_PESTO_data(PESTO_data):
              hdu_temp.writeto(
                      self.loc[0]+'/'+self.name+'/'+f,'warn',overwrite=True) 
              hdu = fits.open(self.loc[0]+'/'+self.name+'/'+f)    
+             band_stats = ""
+             if stats is not None:
+                  band_stats = stats.get(hdu[0].header["filtre"][0], "")
+             if mode == "forced":
+                  r_ap, r_in, r_out = apertures
+                  aperturephotometry.forced_photometry(
+                          hdu[0].header, hdu[0].data, f.replace('.fits', ''),
+                          positions, results_file, r_ap, r_in, r_out, 
+                          zero_point, output_dir=output_dir, names=names, 
+                          stats=band_stats, cache_dir=cache_dir, 
+                          offline=offline, fields=fields)
+                  continue
              aperturephotometry.photometry(hdu[0].header,
                                            hdu[0].data,f.replace('.fits', ''),
                                            RA_bounds, DEC_bounds, thresh_factor,
-                                           results_file)
+                                           results_file, 
+                                           output_dir=output_dir,
+                                           cache_dir=cache_dir, 
+                                           offline=offline, fields=fields,
+                                           targets=targets, stats=band_stats)
 
 ###############################################################################
 
+class stack_prefetcher:
+    """
+    Input:
+    batches: a list (or any iterable) of batches of frames, where each batch 
+             is a list of paths to the frames of one stack, possibly with 
+             wildcards (e.g. '/data/MAXIJ1820/180709_000107*')
+    buffers: a list of two buffer directories (created if needed)
+    decompress: whether to decompress (gunzip) the frames once copied 
+                (optional; default is True)
+
+    Output: stack_prefetcher object
+    
+    Iterating over the prefetcher yields, for each batch, the buffer 
+    directory into which its frames were copied (and decompressed). While 
+    the caller processes one batch, the next batch is copied into the other 
+    buffer by a background thread, so that the copying and decompression of 
+    batch N+1 overlap with the reduction and photometry of batch N. A buffer 
+    is only emptied once the caller has asked for the next batch. Used by 
+    pipeline.py when the stacks are run one after the other.
+    
+    e.g. 
+    for buffer in stack_prefetcher(batches, [works+'_A', works+'_B']):
+        data = raw_PESTO_data([buffer, calibs], ...)
+    """
+    def __init__(self, batches, buffers, decompress=True):
+        self.batches = batches
+        self.buffers = buffers
+        self.decompress = decompress
+        self.listings = {} # cached contents of the source directories
+        for b in self.buffers:
+            os.makedirs(b, exist_ok=True)
+
+    def expand(self, batch):
+        """
+        Input: a batch (list of paths, possibly with wildcards)
+        Output: the list of files matching the batch
+        Each source directory is only listed once, however many batches or 
+        patterns refer to it.
+        """
+        files = []
+        for pattern in batch:
+            d, name = os.path.split(pattern)
+            if not any(c in name for c in '*?['):
+                files.append(pattern)
+                continue
+            if not d in self.listings:
+                self.listings[d] = sorted(os.listdir(d))
+            files += [d+'/'+f for f in fnmatch.filter(self.listings[d], name)]
+        return files
+
+    def fill(self, buffer, batch):
+        """
+        Input: a buffer directory and a batch
+        Output: None
+        Empties the buffer, then copies (and decompresses) the batch into it.
+        """
+        for f in os.listdir(buffer):
+            path = buffer+'/'+f
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        copied = []
+        for f in self.expand(batch):
+            shutil.copyfile(f, buffer+'/'+os.path.basename(f))
+            copied.append(buffer+'/'+os.path.basename(f))
+        if self.decompress:
+            gz = [f for f in copied if f.endswith('.gz')]
+            for i in range(0, len(gz), 500): # stay below the argument limit
+                run(['gzip', '-d', '-f']+gz[i:i+500])
+
+    def _start(self, buffer, batch):
+        """
+        Fills the buffer with the batch in a background thread.
+        """
+        def target():
+            try:
+                self.fill(buffer, batch)
+            except Exception as e:
+                thread.error = e
+        thread = threading.Thread(target=target, daemon=True)
+        thread.error = None
+        thread.start()
+        return thread
+
+    def __iter__(self):
+        batches = iter(self.batches)
+        batch = next(batches, None)
+        if batch is None:
+            return
+        n = 0
+        thread = self._start(self.buffers[0], batch)
+        while thread is not None:
+            thread.join() # wait for the current batch to be in its buffer 
+            if thread.error is not None:
+                raise thread.error
+            current = self.buffers[n % 2]
+            n += 1
+            batch = next(batches, None)
+            if batch is None:
+                thread = None
+            else: # prefetch the next batch into the other buffer
+                thread = self._start(self.buffers[n % 2], batch)
+            yield current
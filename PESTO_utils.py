@@ -5,7 +5,8 @@
 This script contains utilities which are used when debugging the pipeline. They 
 allow the user to look into the headers of the image files (.fits) which are 
 used to see quantities such as exposures, the filters used during observations, 
-the size of the image in pixels, etc.
+the size of the image in pixels, etc. If the data object has a manifest (see 
+manifest.py), the headers are read from the manifest instead of the files.
 """
 
 #import PESTO_lib
@@ -13,6 +14,27 @@ import os
 from astropy.io import fits
 import time
 
+
+def headers(self, l):
+    """
+    Input: a data directory of the PESTO_data object
+    Output: a generator of (filename, header) pairs for all .fits files in 
+    the directory
+    If the object has a manifest (see manifest.py), the headers are the rows 
+    of the manifest, and no file is opened. Keywords are accessed the same 
+    way in both cases (e.g. header['FILTRE']).
+    """
+    manifest = getattr(self, 'manifest', None)
+    if manifest is not None:
+        for row in manifest.files(l):
+            yield row['filename'], row
+        return
+    files = os.listdir(l)
+    for f in files:
+        if '.fits' in f:
+            hdr_temp = fits.open(l+'/'+f)
+            yield f, hdr_temp[self.hdr_ind[l]].header
+            hdr_temp.close()
            
 def files_with_zero(self):
     """
@@ -21,13 +43,9 @@ def files_with_zero(self):
     Checks for files with IMAGETYP == 'zero' and prints any files which do.
     """
     for l in self.loc: # for all files in data directories
-        files = os.listdir(l)
-        for f in files:
-            if '.fits' in f:
-                hdr_temp = fits.open(l+'/'+f, mode = 'update')
-                hdu = hdr_temp[self.hdr_ind[l]] 
-                if 'zero' in hdu.header['IMAGETYP']:
-                    print(f) # print files with zero as image type
+        for f, header in headers(self, l):
+            if 'zero' in header['IMAGETYP']:
+                print(f) # print files with zero as image type
 
 def print_filters(self):
     """
@@ -36,24 +54,20 @@ def print_filters(self):
     Prints the filters used for all .fits files in the directories in use.
     """
     for l in self.loc: # for all files in data directories
-        files = os.listdir(l)
         print("\nLooking for filters in "+l+":")
-        for f in files:
-            if '.fits' in f:
-                hdr_temp = fits.open(l+'/'+f)
-                hdu = hdr_temp[self.hdr_ind[l]]  # file and corresp. filter
-                if 'r' in hdu.header['filtre']:
-                    print('r filter: '+f)
-                if 'g' in hdu.header['filtre']:
-                    print('g filter: '+f)
-                if 'i' in hdu.header['filtre']:
-                    print('i filter: '+f)
-                if 'z' in hdu.header['filtre']:
-                    print('z filter: '+f)
-                if 'Ha' in hdu.header['filtre']:
-                    print('Ha filter: '+f)
-                if 'N/A' in hdu.header['filtre']:
-                        print('N/A filter: '+f)
+        for f, header in headers(self, l): # file and corresp. filter
+            if 'r' in header['filtre']:
+                print('r filter: '+f)
+            if 'g' in header['filtre']:
+                print('g filter: '+f)
+            if 'i' in header['filtre']:
+                print('i filter: '+f)
+            if 'z' in header['filtre']:
+                print('z filter: '+f)
+            if 'Ha' in header['filtre']:
+                print('Ha filter: '+f)
+            if 'N/A' in header['filtre']:
+                    print('N/A filter: '+f)
     
 def print_NAXES(self):
     """
@@ -63,14 +77,10 @@ def print_NAXES(self):
     directories in use.
     """
     for l in self.loc: # for all files in data directories
-        files = os.listdir(l)
         print("\nLooking for NAXIS1 & NAXIS2 in "+l+":")
-        for f in files:
-            if '.fits' in f:
-                hdr_temp = fits.open(l+'/'+f)
-                hdu = hdr_temp[self.hdr_ind[l]] 
-                print(f+': NAXIS1='+str(hdu.header['NAXIS1'])+
-                      ', NAXIS2='+str(hdu.header['NAXIS2']))
+        for f, header in headers(self, l):
+            print(f+': NAXIS1='+str(header['NAXIS1'])+
+                  ', NAXIS2='+str(header['NAXIS2']))
 
 def print_WCS_headers(self):
     """
@@ -80,15 +90,11 @@ def print_WCS_headers(self):
     directories in use.
     """
     for l in self.loc: # for all files in data directories 
-        files = os.listdir(l)
         print("\nLooking for RA & DEC in "+l+":")
         time.sleep(10)
-        for f in files:
-            if '.fits' in f:
-               hdr_temp = fits.open(l+'/'+f)
-               hdu = hdr_temp[self.hdr_ind[l]] 
-               print(f+': RA='+str(hdu.header['RA'])+
-                     ', DEC='+str(hdu.header['DEC']))
+        for f, header in headers(self, l):
+           print(f+': RA='+str(header['RA'])+
+                 ', DEC='+str(header['DEC']))
 
 def print_objects(self):
     """
@@ -99,13 +105,9 @@ def print_objects(self):
     Can be the name of the target, "zero", "flat", etc. 
     """
     for l in self.loc: # for all files in data directories
-        files = os.listdir(l)
         print("\nLooking for OBJECTs in "+l+":")
-        for f in files:
-            if '.fits' in f:
-                hdr_temp = fits.open(l+'/'+f)
-                hdu = hdr_temp[self.hdr_ind[l]] 
-                print(f+': OBJECT='+hdu.header['OBJECT'])
+        for f, header in headers(self, l):
+            print(f+': OBJECT='+header['OBJECT'])
 
 def print_exposures(self):
     """
@@ -115,10 +117,6 @@ def print_exposures(self):
     directories in use.
     """
     for l in self.loc: # for all files in data directories 
-        files = os.listdir(l)
         print("\nLooking for EXPOSUREs in "+l+":")
-        for f in files:
-            if '.fits' in f:
-                hdr_temp = fits.open(l+'/'+f)
-                hdu = hdr_temp[self.hdr_ind[l]]
-                print(f+': EXPOSURE= '+str(hdu.header['EXPOSURE']))
+        for f, header in headers(self, l):
+            print(f+': EXPOSURE= '+str(header['EXPOSURE']))
@@ -3,19 +3,145 @@
 @aperturephotometry.py
 
 Perform image segmentation to detect sources in the field and then search for 
-a specific source. 
+a specific source, or measure known positions directly (forced photometry). 
 """
 
+# the row written for a target with no source, followed by the filter: 
+# "NO SOURCE FOUND.\t<filter>" (read back by resultstore.parse_line())
+NO_SOURCE = "NO SOURCE FOUND."
+
+def no_source_row(filt):
+    """
+    Input: the filter used
+    Output: the row of a target for which no source was found
+    """
+    return NO_SOURCE+"\t"+filt+"\n"
+
+def target_results_path(results_path, name):
+    """
+    Input: the path to the results file of the target, and the name of 
+    another target
+    Output: the path to the results file of the other target, e.g. 
+    results_190312_source1.txt for results_190312.txt and source1
+    """
+    import os
+    root, ext = os.path.splitext(results_path)
+    return root+"_"+name+ext
+
+def write_rows(results_path, rows, names, stats=""):
+    """
+    Input: the path to the results file of the target, the photometry rows 
+    of the targets (each ending with a newline), their names (the first, 
+    the target, being None) and the statistics of the stack in the band of 
+    the rows, as written by the reduction (ending with a tab) (optional; 
+    default is none, for a reduction which already wrote them to the results 
+    file of the target)
+    Output: None
+    
+    The row of the target is appended to its results file, after the stack 
+    statistics. Each other target has its own results file (see 
+    target_results_path()), to which the same stack statistics and its own 
+    row are appended.
+    """
+    tf = open(results_path, 'a')
+    tf.write(stats+rows[0])
+    tf.close()
+    for name, row in zip(names[1:], rows[1:]):
+        tf = open(target_results_path(results_path, name), 'a')
+        tf.write(stats+row)
+        tf.close()
+
+def reference_sources(header, data, w, cache_dir=None, offline=False, 
+                      fields=None):
+    """
+    Input: the header of a reduced object's .fits file, the image data of the 
+    file, its WCS solution, the directory of the reference catalogue cache 
+    (optional; default is to query Vizier; see catalogue.py), whether to only 
+    use catalogue tiles already in the cache (optional; default False) and a 
+    dictionary of the field models of the night, by filter, to use and fill 
+    (optional; default is none; see fieldmodel.py)
+    Output: the sources of the reference catalogue around the image (an 
+    astropy Table, or None if a field model of the night was reused) and the 
+    field model of the filter (None without field models)
+    """
+    import numpy as np
+    
+    # set the catalogue and filter of the image
+    ref_catalog = "II/349/ps1"
+    ref_catalog_name = "PS1" # PanStarrs 1
+    filt = header["filtre"][0]
+    # get the centre of the image and its RA, Dec
+    x_size = data.shape[1]
+    y_size = data.shape[0]
+    ra_centre, dec_centre = np.array(w.all_pix2world(x_size/2.0, 
+                                                     y_size/2.0, 1))
+    # set radius to search in, minimum, maximum magnitudes
+    minmag = 10.0
+    maxmag = 22.0 
+    max_emag = 0.3 # maximum error on magnitude 
+    pixscale = np.mean(np.abs([header["CDELT1"], header["CDELT2"]])) # in deg
+    pixscale = pixscale*3600.0 # in arcsec
+    radius = pixscale*y_size/60.0 # radius in arcmin 
+    
+    # query print statement
+    #print('Querying Vizier %s around RA %.4f, Dec %.4f with a radius of %.4f arcmin\n'%(
+    #        ref_catalog, ra_centre, dec_centre, radius))
+    
+    ref = model = None
+    if fields is not None and filt in fields: # field model of the night
+        model = fields[filt]
+        model.update(w) # reprojects the catalogue if the field moved
+        return ref, model
+    if fields is not None: 
+        # the model is kept all night: allow for the drift of the field
+        radius = 1.5*radius
+    # querying 
+    if cache_dir is not None: # tiles of the catalogue cached on disk
+        import catalogue
+        ref = catalogue.read(cache_dir, float(ra_centre), 
+                             float(dec_centre), radius/60.0, filt, 
+                             ref_catalog, (minmag, maxmag, max_emag), 
+                             offline)
+    else:
+        from astroquery.vizier import Vizier
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+        v = Vizier(columns=["*"], column_filters={
+                filt+"mag":str(minmag)+".."+str(maxmag),
+                "e_"+filt+"mag":"<"+str(max_emag)}, row_limit=-1) 
+        
+        Q = v.query_region(SkyCoord(ra=ra_centre, dec=dec_centre, 
+                        unit = (u.deg, u.deg)), radius = str(radius)+'m', 
+                        catalog=ref_catalog, cache=False)
+        ref = Q[0]
+    if fields is not None:
+        import fieldmodel
+        model = fields[filt] = fieldmodel.field_model(ref, w, data.shape)
+    return ref, model
+
 def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
-               results_file, im=True):
+               results_file, im=True, output_dir=None, cache_dir=None,
+               offline=False, fields=None, targets=None, stats=""):
     """
     Input: the header of a reduced object's .fits file, the image data of the 
     file, the name to be used when creating the segmented image and a csv 
     containing all detected sources, a threshold factor to be used in image 
     segmentation, 2 arrays giving the RA and DEC (in degrees) boundaries on the 
     desired source, the name of the results textfile to which the photometry 
-    will be appended, and a boolean indicating whether or not to save the image 
-    of the segmentation test (optional; defaultTrue)
+    will be appended, a boolean indicating whether or not to save the image 
+    of the segmentation test (optional; defaultTrue), and the directory in 
+    which to write the image, the .csv and the results file (optional; default
+    is the current working directory; an absolute results_file is used as-is), 
+    the directory of the reference catalogue cache (optional; default is to 
+    query Vizier for every image; see catalogue.py) and whether to only use 
+    catalogue tiles already in the cache (optional; default False), and a 
+    dictionary of the field models of the night, by filter, to use and fill 
+    (optional; default is to query and match the catalogue for every image; 
+    see fieldmodel.py), and a list of other targets to look for, each a 
+    tuple (name, RA boundaries, Dec boundaries), whose results are written to 
+    their own results files (optional; default is none), and the statistics 
+    of the stack to write before the results (optional; default is none; see 
+    write_rows())
     Output: None
     
     Obtains a stack of images in the form of a header and data from a .fits 
@@ -33,11 +159,11 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
     
     A tab-delimited results file is appended to. The number of images used in 
     the stack, the total exposure time of the stack and its error, the 
-    timestamp (averaged across all images) and its error are already included.    
+    timestamp (averaged across all images) and its error are already included 
+    (or are given as the statistics of the stack).
     IF a source is found, this script appends the x and y minima of the 
     source's centroid, the pixel area of the source, the photon count, and the 
-    error on the photon count. If not, the flag NO SOURCE FOUND is appended to 
-    the image. 
+    error on the photon count. If not, no_source_row() is appended instead. 
     """
     
     import numpy as np   
@@ -47,7 +173,6 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
                                sigma_clipped_stats)
     from astropy.convolution import Gaussian2DKernel
     from astropy.table import Table, Column
-    from astroquery.vizier import Vizier
     from astropy.coordinates import SkyCoord
     import astropy.units as u
     from photutils import Background2D, MedianBackground
@@ -72,12 +197,24 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
     segm = detect_sources(data, threshold, npixels=7, filter_kernel=kernel)
     segm.remove_masked_labels(mask)
     
+    # results file, in the output directory (by default, the current working 
+    # dir) unless an absolute path is given
+    results_path = os.path.join(output_dir or os.getcwd(), results_file)
+    if targets is None:
+        targets = []
+    names = [None]+[t[0] for t in targets]
+    
     try: 
         segm.remove_border_labels(10, partial_overlap=True, relabel=True)
     except: 
         print("The background threshold factor is too large; sources are "+
               "being ignored during image segmentation.\nPlease try a smaller"+
               " value.\n")
+        # complete the rows of the stack, so that no results file is left 
+        # with an unfinished line
+        write_rows(results_path, 
+                   [no_source_row(header["filtre"][0])]*len(names), 
+                   names, stats)
         return
  
     # pictures to see what's going on
@@ -95,7 +232,9 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
         ax1.imshow(data-bkg.background, origin='lower', cmap='Greys_r', 
                    norm=norm) 
         ax2.imshow(segm, origin='lower', cmap=segm.cmap(random_state=12345)) 
-        plt.savefig('segmentationtest_'+name+'.png')
+        plt.savefig(os.path.join(output_dir or os.getcwd(),
+                                 'segmentationtest_'+name+'.png'))
+        plt.close(fig)
     
     # find source properties (centroid, source pixel area, etc.) 
     from photutils import source_properties
@@ -123,8 +262,9 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
     ra, dec = w.all_pix2world(segm_tbl['xcentroid'], segm_tbl['ycentroid'],1)
     segm_tbl["ra"] = ra
     segm_tbl["dec"] = dec
-    segm_tbl.write('segmentation_table_'+name+'.csv', format = 'csv', 
-              overwrite=True)
+    segm_tbl.write(os.path.join(output_dir or os.getcwd(),
+                                'segmentation_table_'+name+'.csv'), 
+                   format = 'csv', overwrite=True)
     
     # build a new table with only the parameters we care about 
     tbl = Table()
@@ -141,56 +281,42 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
     
     ### query Vizier to match sources and do aperture photometry
     
-    # set the catalogue and filter of the image
-    ref_catalog = "II/349/ps1"
-    ref_catalog_name = "PS1" # PanStarrs 1
-    filt = header["filtre"][0]
-    # get the centre of the image and its RA, Dec
+    filt = header["filtre"][0] # filter of the image
     x_size = data.shape[1]
     y_size = data.shape[0]
-    ra_centre, dec_centre = np.array(w.all_pix2world(x_size/2.0, 
-                                                     y_size/2.0, 1))
-    # set radius to search in, minimum, maximum magnitudes
-    minmag = 10.0
-    maxmag = 22.0 
-    max_emag = 0.3 # maximum error on magnitude 
     pixscale = np.mean(np.abs([header["CDELT1"], header["CDELT2"]])) # in deg
     pixscale = pixscale*3600.0 # in arcsec
-    radius = pixscale*y_size/60.0 # radius in arcmin 
+    ref, model = reference_sources(header, data, w, cache_dir, offline, 
+                                   fields)
     
-    # query print statement
-    #print('Querying Vizier %s around RA %.4f, Dec %.4f with a radius of %.4f arcmin\n'%(
-    #        ref_catalog, ra_centre, dec_centre, radius))
-    
-    # querying 
-    v = Vizier(columns=["*"], column_filters={
-            filt+"mag":str(minmag)+".."+str(maxmag),
-            "e_"+filt+"mag":"<"+str(max_emag)}, row_limit=-1) # no row limit
-    
-    Q = v.query_region(SkyCoord(ra=ra_centre, dec=dec_centre, 
-                    unit = (u.deg, u.deg)), radius = str(radius)+'m', 
-                    catalog=ref_catalog, cache=False)
-    cat_coords = w.all_world2pix(Q[0]['RAJ2000'], Q[0]['DEJ2000'], 1)
-    # mask out edge sources
-    x_lims = [int(0.05*x_size), int(0.95*x_size)] 
-    y_lims = [int(0.05*y_size), int(0.95*y_size)]
-    mask = (cat_coords[0] > x_lims[0]) & (
-            cat_coords[0] < x_lims[1]) & (
-            cat_coords[1] > y_lims[0]) & (
-            cat_coords[1] < y_lims[1])
-    good_cat_sources = Q[0][mask] # sources in catalogue 
-    
-    # cross-matching coords of sources found by astrometry
-    source_coords = SkyCoord(ra=tbl['ra'], dec=tbl['dec'], frame='fk5', 
-                             unit='degree')
-    # and coords of valid sources in the queried catalog 
-    cat_source_coords = SkyCoord(ra=good_cat_sources['RAJ2000'], 
-                                     dec=good_cat_sources['DEJ2000'], 
-                                     frame='fk5', unit='degree')
+    if fields is not None:
+        good_cat_sources = model.sources # sources in catalogue
+        # indices of matching sources (within 5.0 pix of each other), with
+        # one query of the KD-tree of the catalogue's pixel positions
+        idx_image, idx_cat = model.match(tbl['xcentroid'], tbl['ycentroid'],
+                                         5.0)
+    else:
+        cat_coords = w.all_world2pix(ref['RAJ2000'], ref['DEJ2000'], 1)
+        # mask out edge sources
+        x_lims = [int(0.05*x_size), int(0.95*x_size)] 
+        y_lims = [int(0.05*y_size), int(0.95*y_size)]
+        mask = (cat_coords[0] > x_lims[0]) & (
+                cat_coords[0] < x_lims[1]) & (
+                cat_coords[1] > y_lims[0]) & (
+                cat_coords[1] < y_lims[1])
+        good_cat_sources = ref[mask] # sources in catalogue 
         
-    # indices of matching sources (within 5.0 pix of each other) 
-    idx_image, idx_cat, d2d, d3d = cat_source_coords.search_around_sky(
-            source_coords, 5.0*pixscale*u.arcsec)
+        # cross-matching coords of sources found by astrometry
+        source_coords = SkyCoord(ra=tbl['ra'], dec=tbl['dec'], frame='fk5', 
+                                 unit='degree')
+        # and coords of valid sources in the queried catalog 
+        cat_source_coords = SkyCoord(ra=good_cat_sources['RAJ2000'], 
+                                         dec=good_cat_sources['DEJ2000'], 
+                                         frame='fk5', unit='degree')
+            
+        # indices of matching sources (within 5.0 pix of each other) 
+        idx_image, idx_cat, d2d, d3d = cat_source_coords.search_around_sky(
+                source_coords, 5.0*pixscale*u.arcsec)
     
     # compute magnitude offsets and zero point
     mag_offsets = ma.array(good_cat_sources[filt+'mag'][idx_cat] - 
@@ -219,49 +345,224 @@ def photometry(header, data, name, RA_bound, DEC_bound, thresh_factor,
     
     #return tbl
 
-    # boundaries on the desired source
-    RA_min, RA_max = RA_bound
-    DEC_min, DEC_max = DEC_bound
-
-    # parse a list of all sources for a source within the RA, Dec bounds
-    cwd = os.getcwd() # current working dir
-    for i in range(len(tbl['id'])):
-        # if source is found:
-        if (RA_min <= tbl[i]['ra'] <= RA_max) and (
-                DEC_min <= tbl[i]['dec'] <= DEC_max):                      
-            print("\nFound a source.\n")
+    # boundaries on the desired source, and on the other targets
+    bounds = np.array([list(RA_bound)+list(DEC_bound)]+
+                      [list(t[1])+list(t[2]) for t in targets], 
+                      dtype=np.float64)
+    
+    # look for all the targets at once among the sources: the first source 
+    # within the RA, Dec bounds of each target, if any
+    ra = np.asarray(tbl['ra'], dtype=np.float64)
+    dec = np.asarray(tbl['dec'], dtype=np.float64)
+    inside = ((bounds[:,0:1] <= ra) & (ra <= bounds[:,1:2]) & 
+              (bounds[:,2:3] <= dec) & (dec <= bounds[:,3:4]))
+    found = np.any(inside, axis=1)
+    first = np.argmax(inside, axis=1)
+    
+    # Write xcentroid and ycentroid, the pixel area of the source, 
+    # the photon count, photon count error, calibrated magnitude, 
+    # calibrated magnitude error, and filter used to the file.
+    # If xcentroid and ycentroid change drastically from one stack to 
+    # another, the sources are not the same or astrometric calibration 
+    # may have failed. 
+    # If no source is found, no_source_row() is written instead.
+    rows = []
+    for t in range(len(names)):
+        if not found[t]:
+            rows.append(no_source_row(filt))
+            continue
+        i = first[t]
+        xcentroid = tbl["xcentroid"].data[i]
+        ycentroid = tbl["ycentroid"].data[i]
+        area = tbl["area"].data[i]
+        pc = tbl["pc"].data[i]
+        pc_err = tbl["pc_err"].data[i] 
+        mag = tbl["mag_calib"].data[i]
+        mag_err = tbl["mag_calib_unc"][i]
+        # line to write to the file: 
+        line = str(xcentroid)+"\t"+str(ycentroid)+"\t"+str(area)
+        line += "\t"+str(pc)+"\t"+str(pc_err) 
+        line += "\t"+str(mag)+"\t"+str(mag_err)+"\t"+filt+"\n"
+        rows.append(line)
+    if found[0]:
+        print("\nFound a source.\n")
+    else:
+        print("No source found.\n")
+    if len(targets) > 0:
+        print("Found "+str(np.sum(found[1:]))+" of "+str(len(targets))+
+              " other targets.\n")
 
-            # Write xcentroid and ycentroid, the pixel area of the source, 
-            # the photon count, photon count error, calibrated magnitude, 
-            # calibrated magnitude error, and filter used to the file.
-            # If xcentroid and ycentroid change drastically from one stack to 
-            # another, the sources are not the same or astrometric calibration 
-            # may have failed. 
-            xcentroid = tbl["xcentroid"].data[i]
-            ycentroid = tbl["ycentroid"].data[i]
-            area = tbl["area"].data[i]
-            pc = tbl["pc"].data[i]
-            pc_err = tbl["pc_err"].data[i] 
-            mag = tbl["mag_calib"].data[i]
-            mag_err = tbl["mag_calib_unc"][i]
-            # line to write to the file: 
-            line = str(xcentroid)+"\t"+str(ycentroid)+"\t"+str(area)
-            line += "\t"+str(pc)+"\t"+str(pc_err) 
-            line += "\t"+str(mag)+"\t"+str(mag_err)+"\t"+filt+"\n"
-            tf = open(cwd+"/"+results_file,'a')
-            tf.write(line)
-            tf.close()
-            return tbl
-
-    # if no source is found:
-    line = "NO SOURCE FOUND.\n" 
-    print("No source found.\n")
-    tf = open(cwd+"/"+results_file,'a')
-    tf.write(line)
-    tf.close()
+    write_rows(results_path, rows, names, stats)
 
     return tbl
 
 
+def aperture_sums(data, x, y, r_ap=6.0, r_in=10.0, r_out=15.0):
+    """
+    Input: the image data, arrays of the (0-based) x and y pixel positions to 
+    measure, the radius of the apertures, and the inner and outer radii of 
+    the background annuli (optional; defaults 6, 10 and 15 pixels)
+    Output: arrays of the number of pixels in each aperture, the sum of the 
+    data in each aperture, the median and standard deviation of the data in 
+    each annulus, and whether each aperture is complete (all its pixels are 
+    on the image and valid, and its annulus is on the image)
+    
+    All the positions are measured at once: a box around each position is 
+    cut out of the image, and the pixels whose centres fall within the 
+    aperture or the annulus are selected with a mask. Pixels outside the 
+    image, and pixels whose ADU is 0 (as in photometry()), are ignored.
+    """
+    import numpy as np
+    import warnings
+    
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    half = int(np.ceil(max(r_ap, r_out)))+1
+    offsets = np.arange(-half, half+1)
+    rows = np.round(y).astype(int)[:,None,None]+offsets[None,:,None]
+    cols = np.round(x).astype(int)[:,None,None]+offsets[None,None,:]
+    inside = ((rows >= 0) & (rows < data.shape[0]) & (cols >= 0) & 
+              (cols < data.shape[1]))
+    boxes = data[np.clip(rows, 0, data.shape[0]-1), 
+                 np.clip(cols, 0, data.shape[1]-1)].astype(np.float64)
+    boxes[~inside | (boxes == 0)] = np.nan
+    
+    d2 = (cols-x[:,None,None])**2+(rows-y[:,None,None])**2
+    aperture = (d2 <= r_ap**2) & np.isfinite(boxes)
+    annulus = (d2 >= r_in**2) & (d2 <= r_out**2)
+    npix = np.sum(aperture, axis=(1,2))
+    complete = ((npix == np.sum(d2 <= r_ap**2, axis=(1,2))) & 
+                np.all(inside | ~annulus, axis=(1,2)))
+    total = np.sum(np.where(aperture, boxes, 0.0), axis=(1,2))
+    with warnings.catch_warnings(): # empty annuli (off the image) give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bkg = np.nanmedian(np.where(annulus, boxes, np.nan), axis=(1,2))
+        bkg_std = np.nanstd(np.where(annulus, boxes, np.nan), axis=(1,2))
+    return npix, total, bkg, bkg_std, complete
 
+def forced_photometry(header, data, name, positions, results_file, 
+                      r_ap=6.0, r_in=10.0, r_out=15.0, zero_point=None, 
+                      output_dir=None, names=None, stats="", cache_dir=None, 
+                      offline=False, fields=None):
+    """
+    Input: the header of a reduced object's .fits file, the image data of the 
+    file, the name to be used when creating the .csv of the measurements, a 
+    list of (RA, Dec) positions (in degrees) to measure, the first being the 
+    target, the name of the results textfile to which the photometry of the 
+    target will be appended, the radius of the apertures and the inner and 
+    outer radii of the background annuli (optional; defaults 6, 10 and 15 
+    pixels), the zero point added to the instrumental magnitudes (optional; 
+    default is to calibrate them against the reference catalogue), the 
+    directory in which to write the .csv and the results file (optional; 
+    default is the current working directory; an absolute results_file is 
+    used as-is) and the names of the positions after the 
+    first, to give each its own results file (optional; default is to only 
+    write the results of the target), and the statistics of the stack to 
+    write before the results (optional; default is none; see write_rows()), 
+    and, to calibrate the magnitudes, the directory of the reference 
+    catalogue cache, whether to only use the cache and the field models of 
+    the night (optional; as in photometry())
+    Output: an astropy Table of the measurements at all the positions
+    
+    Forced photometry: the positions are known, so no background map or image 
+    segmentation is needed. The positions are converted 
+    to pixels with the WCS of the header, and each is measured in a circular 
+    aperture, from which the median of a local annulus is subtracted as the 
+    background (see aperture_sums()). Outputs a .csv of the measurements at 
+    all the positions. Unless a zero point is given, the sources of the 
+    reference catalogue on the image are measured in the same apertures, and 
+    the zero point is the sigma-clipped mean of the offsets between their 
+    catalogue and instrumental magnitudes (as in photometry()).
+    
+    As in photometry(), the results file is appended to with the x and y 
+    position of the target, the pixel area of the aperture, the photon count 
+    and its error, the magnitude and its error, and the filter used. If the 
+    target's aperture is not wholly on the image or its background-subtracted 
+    photon count is not positive, no_source_row() is appended instead.
+    """
+    import numpy as np
+    import os
+    from astropy.stats import sigma_clipped_stats
+    from astropy.table import Table
+    from astropy.wcs import WCS
     
+    filt = header["filtre"][0]
+    effective_gain = 13.522 # as in photometry()
+    
+    positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+    w = WCS(header)
+    x, y = w.all_world2pix(positions[:,0], positions[:,1], 0)
+    npix, total, bkg, bkg_std, complete = aperture_sums(data, x, y, r_ap, 
+                                                        r_in, r_out)
+    
+    pc = total-npix*bkg # background-subtracted photon count
+    n_ann = np.pi*(r_out**2-r_in**2)
+    
+    zp_std = 0.0
+    if zero_point is None: # calibrate against the reference catalogue
+        ref, model = reference_sources(header, data, w, cache_dir, offline, 
+                                       fields)
+        if model is not None:
+            cat = model.sources
+            cat_x, cat_y = model.xy[:,0]-1, model.xy[:,1]-1 # origin 0
+        else:
+            cat_x, cat_y = w.all_world2pix(ref['RAJ2000'], ref['DEJ2000'], 0)
+            # mask out edge sources, as in photometry()
+            x_size, y_size = data.shape[1], data.shape[0]
+            mask = ((cat_x > int(0.05*x_size)) & (cat_x < int(0.95*x_size)) & 
+                    (cat_y > int(0.05*y_size)) & (cat_y < int(0.95*y_size)))
+            cat, cat_x, cat_y = ref[mask], cat_x[mask], cat_y[mask]
+        c_npix, c_total, c_bkg, c_std, c_complete = aperture_sums(
+                data, cat_x, cat_y, r_ap, r_in, r_out)
+        c_pc = c_total-c_npix*c_bkg
+        cat_mag = np.asarray(cat[filt+'mag'], dtype=np.float64)
+        good = c_complete & (c_pc > 0) & np.isfinite(cat_mag)
+        if np.any(good):
+            zero_point, zp_med, zp_std = sigma_clipped_stats(
+                    cat_mag[good]+2.5*np.log10(c_pc[good]))
+        else:
+            print("No source of the reference catalogue could be measured; "+
+                  "the magnitudes are not calibrated.\n")
+            zero_point = zp_std = np.nan
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Poisson noise of the source, noise of the background in the 
+        # aperture, and error on the background level
+        pc_err = np.sqrt(np.abs(pc)/effective_gain+npix*bkg_std**2+
+                         npix**2*bkg_std**2/n_ann)
+        mag = -2.5*np.log10(pc)+zero_point
+        # propagate the error on the zero point, as in photometry()
+        mag_err = np.sqrt((2.5/np.log(10)*pc_err/pc)**2+zp_std**2)
+    
+    tbl = Table()
+    tbl["id"] = np.arange(1, len(x)+1)
+    tbl["xcentroid"] = x
+    tbl["ycentroid"] = y
+    tbl["area"] = npix
+    tbl["ra"] = positions[:,0]
+    tbl["dec"] = positions[:,1]
+    tbl["bkg"] = bkg
+    tbl["pc"] = pc
+    tbl["pc_err"] = pc_err
+    tbl["mag_calib"] = mag
+    tbl["mag_calib_unc"] = mag_err
+    tbl.write(os.path.join(output_dir or os.getcwd(),
+                           'forced_photometry_'+name+'.csv'), 
+              format='csv', overwrite=True)
+    
+    names = [None]+list(names or [])
+    rows = []
+    for i in range(len(names)):
+        if complete[i] and np.isfinite(pc[i]) and pc[i] > 0:
+            line = str(x[i])+"\t"+str(y[i])+"\t"+str(npix[i])
+            line += "\t"+str(pc[i])+"\t"+str(pc_err[i]) 
+            line += "\t"+str(mag[i])+"\t"+str(mag_err[i])+"\t"+filt+"\n"
+        else: # the aperture is (partly) off the image, or holds no source
+            line = no_source_row(filt)
+        rows.append(line)
+    if rows[0].startswith(NO_SOURCE):
+        print("No source found.\n")
+    results_path = os.path.join(output_dir or os.getcwd(), results_file)
+    write_rows(results_path, rows, names, stats)
+    
+    return tbl
@@ -0,0 +1,348 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@association.py
+
+Cross-stack association of the sources detected in the field. The source
+tables written by the photometry of each stack (segmentation_table_<name>.csv,
+or forced_photometry_<name>.csv; see aperturephotometry.py) are linked
+together: each source is matched to the stars already known, with a KD-tree
+over their positions on the sky, and is given the persistent ID of its star
+(or a new one). The result is a star x stack matrix of the photon counts (and
+their errors, positions, ...) of every star of the field, together with the
+statistics and the zero point of each stack, saved as a columnar .npz file.
+
+The matrix replaces the separate results files of alternative sources needed
+by lightcurve.py: the weather correction and the relative photometry can be
+computed from it directly (see correct_weather() and relative_flux()), and
+the results file of any star can be written from it (see write_star()) or
+fed to lightcurve.correct_weather() (see weather_database()).
+"""
+import os
+import warnings
+import numpy as np
+from scipy.spatial import cKDTree
+
+import resultstore
+
+# arrays of the matrix with one value per star and stack
+PER_STAR = ['flux', 'flux_err', 'x', 'y', 'area']
+
+# arrays of the matrix with one value per stack (see datared.py)
+PER_STACK = ['stack', 'exposure', 'exposure_err', 'time', 'time_err']
+
+# number of known stars considered for each source
+NEIGHBOURS = 8
+
+
+def unit_vectors(ra, dec):
+    """
+    Input: arrays of RA and Dec, in degrees
+    Output: an array of the corresponding unit vectors (one per row)
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                            np.sin(dec)])
+
+def read_table(path):
+    """
+    Input: the path to a source table (.csv) written by the photometry
+    Output: a dictionary of arrays of the RA, Dec, photon count, photon count
+    error, x and y centroid and area of the sources, and of their calibrated
+    magnitudes if the table holds them (forced photometry)
+    """
+    from astropy.table import Table
+    t = Table.read(path, format='csv')
+    flux = 'source_sum' if 'source_sum' in t.colnames else 'pc'
+    columns = {'ra':'ra', 'dec':'dec', 'flux':flux, 'flux_err':flux+'_err',
+               'x':'xcentroid', 'y':'ycentroid', 'area':'area'}
+    if 'mag_calib' in t.colnames:
+        columns['mag'] = 'mag_calib'
+    return dict([(k, np.asarray(t[c], dtype=np.float64)) for k, c in
+                 columns.items()])
+
+def stack_zero_point(sources=None, row=None):
+    """
+    Input: the sources of a stack (see read_table()) and the row of the
+    stack in a results file (optional; used if the sources hold no
+    calibrated magnitudes)
+    Output: the zero point of the calibrated magnitudes of the stack (the
+    calibrated magnitude plus the instrumental magnitude), or nan if unknown
+    """
+    mag, flux = np.zeros(0), np.zeros(0)
+    if sources is not None and 'mag' in sources:
+        mag, flux = sources['mag'], sources['flux']
+    elif row is not None:
+        record = resultstore.parse_line(row)
+        if record is not None and record['status'] == resultstore.FOUND:
+            mag, flux = np.array([record['mag']]), np.array([record['pc']])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        zp = mag+2.5*np.log10(flux)
+    zp = zp[np.isfinite(zp)]
+    return np.median(zp) if len(zp) > 0 else np.nan
+
+class source_association:
+    """
+    Input:
+    radius: the largest distance, in arcsec, between a source and the star it
+            is associated with (optional; default 2.0, about 4 pixels)
+
+    Output: source_association object
+    """
+    def __init__(self, radius=2.0):
+        self.radius = radius
+        # chord between two unit vectors separated by the radius
+        self.chord = 2*np.sin(np.radians(radius/3600.0)/2)
+        self.ra_sum = np.zeros(0)
+        self.dec_sum = np.zeros(0)
+        self.detections = np.zeros(0, dtype=int)
+        self.columns = [] # for each stack, the star IDs and the sources
+        self.stats = []
+        self.zero_points = []
+
+    def __len__(self):
+        return len(self.detections)
+
+    def positions(self):
+        """
+        Input: None
+        Output: the mean RA and Dec of each star
+        """
+        return self.ra_sum/self.detections, self.dec_sum/self.detections
+
+    def add_stack(self, sources, stats=None, zero_point=np.nan):
+        """
+        Input: the sources of a stack (a dictionary of arrays; see
+        read_table()), the statistics of the stack (the stack size, mean
+        exposure and its error, mean timestamp and its error; optional;
+        default is unknown) and the zero point of its calibrated magnitudes
+        (optional; default is unknown; see stack_zero_point())
+        Output: the star ID of each source
+        Each source is associated with a known star within the radius, one
+        to one: the pairs of a source and one of its NEIGHBOURS nearest stars
+        are taken from the closest, skipping those whose source or star is
+        already associated, so that a source whose nearest star went to
+        another source can still be associated with its next nearest star.
+        Sources with no star start a new one.
+        """
+        n = len(sources['ra'])
+        ids = -np.ones(n, dtype=int)
+        if len(self) > 0 and n > 0:
+            ra, dec = self.positions()
+            tree = cKDTree(unit_vectors(ra, dec))
+            d, star = tree.query(unit_vectors(sources['ra'], sources['dec']),
+                                 k=min(NEIGHBOURS, len(self)),
+                                 distance_upper_bound=self.chord)
+            d, star = d.reshape((n, -1)), star.reshape((n, -1))
+            source = np.repeat(np.arange(n), d.shape[1])
+            d, star = d.ravel(), star.ravel()
+            pairs = np.where(np.isfinite(d))[0]
+            taken = set()
+            for p in pairs[np.argsort(d[pairs], kind='stable')]:
+                if ids[source[p]] >= 0 or star[p] in taken:
+                    continue
+                ids[source[p]] = star[p]
+                taken.add(star[p])
+        new = np.where(ids < 0)[0]
+        ids[new] = len(self)+np.arange(len(new))
+        self.ra_sum = np.concatenate([self.ra_sum, np.zeros(len(new))])
+        self.dec_sum = np.concatenate([self.dec_sum, np.zeros(len(new))])
+        self.detections = np.concatenate([self.detections,
+                                          np.zeros(len(new), dtype=int)])
+        # unwrap the RA of each source around its star, then update the means
+        ra = np.asarray(sources['ra'], dtype=np.float64)
+        known = self.detections[ids] > 0
+        mean_ra = np.where(known, self.ra_sum[ids]/np.maximum(
+                self.detections[ids], 1), ra)
+        ra = mean_ra+((ra-mean_ra+180.0) % 360.0-180.0)
+        np.add.at(self.ra_sum, ids, ra)
+        np.add.at(self.dec_sum, ids, sources['dec'])
+        np.add.at(self.detections, ids, 1)
+        self.columns.append((ids, sources))
+        self.stats.append([np.nan]*len(PER_STACK) if stats is None else
+                          [float(s) for s in stats])
+        self.zero_points.append(float(zero_point))
+        return ids
+
+    def matrix(self):
+        """
+        Input: None
+        Output: a dictionary of arrays: 'id', 'ra', 'dec' and 'detections'
+        (one per star), PER_STACK and 'zero_point' (one per stack) and
+        PER_STAR (star x stack, nan where a star was not detected)
+        """
+        ra, dec = self.positions()
+        m = {'id':np.arange(len(self)), 'ra':ra % 360.0, 'dec':dec,
+             'detections':self.detections.copy()}
+        stats = np.array(self.stats, dtype=np.float64).reshape(
+                (-1, len(PER_STACK)))
+        for k, c in enumerate(PER_STACK):
+            m[c] = stats[:,k]
+        m['zero_point'] = np.array(self.zero_points, dtype=np.float64)
+        for c in PER_STAR:
+            m[c] = np.full((len(self), len(self.columns)), np.nan)
+            for j, (ids, sources) in enumerate(self.columns):
+                m[c][ids, j] = sources[c]
+        return m
+
+    def save(self, path):
+        """
+        Input: the path of the .npz file to write
+        Output: None
+        """
+        np.savez(path, **self.matrix())
+
+def load(path):
+    """
+    Input: the path of a .npz file written by source_association.save()
+    Output: the matrix, as a dictionary of arrays
+    """
+    f = np.load(path)
+    m = dict([(k, f[k]) for k in f.files])
+    f.close()
+    return m
+
+def band_row(path, band):
+    """
+    Input: the path to the results file of a stack, and a band
+    Output: the row of the file for the band, or None if there is none (the
+    rows of the bands are in no particular order)
+    """
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'r')
+    lines = f.readlines()
+    f.close()
+    for line in lines:
+        record = resultstore.parse_line(line)
+        if record is not None and record['filter'] == band:
+            return line
+    return None
+
+def from_directories(directories, name='object_r_reduced', radius=2.0):
+    """
+    Input: the directories of the stacks of a night, in order (e.g. those of
+    the jobs of pipeline.py), the name of their reduced image (optional;
+    default 'object_r_reduced') and the association radius in arcsec
+    (optional; default 2.0)
+    Output: the source_association of the stacks
+    Each directory must hold the source table of the stack; its statistics
+    (and, for segmentation tables, its zero point) are read from the row of
+    the results.txt of the directory whose filter is the band of the image
+    (e.g. r for 'object_r_reduced'), if any.
+    """
+    band = name.split('_')[1] if name.count('_') >= 1 else None
+    a = source_association(radius)
+    for d in directories:
+        path = os.path.join(d, 'segmentation_table_'+name+'.csv')
+        if not os.path.exists(path):
+            path = os.path.join(d, 'forced_photometry_'+name+'.csv')
+        if not os.path.exists(path):
+            print("No source table in "+d+"; skipping it")
+            continue
+        stats = None
+        row = band_row(os.path.join(d, 'results.txt'), band)
+        if row is not None:
+            stats = row.split('\t')[:len(PER_STACK)]
+        sources = read_table(path)
+        a.add_stack(sources, stats, stack_zero_point(sources, row))
+    return a
+
+def find_star(m, RA_bound, DEC_bound):
+    """
+    Input: a matrix, and the RA and Dec boundaries of a source (as in
+    PESTO_lib.reduced_PESTO_data.photometry())
+    Output: the ID of the most often detected star within the boundaries, or
+    None
+    """
+    inside = np.where((RA_bound[0] <= m['ra']) & (m['ra'] <= RA_bound[1]) &
+                      (DEC_bound[0] <= m['dec']) & (m['dec'] <= DEC_bound[1])
+                      )[0]
+    if len(inside) == 0:
+        return None
+    return inside[np.argmax(m['detections'][inside])]
+
+def weather_factors(m, comparisons):
+    """
+    Input: a matrix, and the IDs of the comparison stars
+    Output: the weather factor of each stack: the mean, over the comparison
+    stars detected in the stack, of their largest photon count divided by
+    their photon count in the stack (as in lightcurve.build_weather_database()
+    and lightcurve.correct_weather()), or nan if none was detected
+    """
+    flux = m['flux'][np.asarray(comparisons)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        factors = np.nanmax(flux, axis=1)[:,None]/flux
+    factors[~np.isfinite(factors)] = np.nan
+    with warnings.catch_warnings(): # stacks with no comparison star give nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(factors, axis=0)
+
+def correct_weather(m, star, comparisons):
+    """
+    Input: a matrix, the ID of the star to correct and the IDs of the
+    comparison stars
+    Output: the corrected photon count of the star and its error, in each
+    stack (nan where the star or all the comparison stars were not detected)
+    """
+    f = weather_factors(m, comparisons)
+    return m['flux'][star]*f, m['flux_err'][star]*f
+
+def relative_flux(m, star, comparison):
+    """
+    Input: a matrix, the ID of the star and the ID of the comparison star
+    Output: the photon count of the star relative to the comparison star,
+    and its error, in each stack (as in lightcurve.relative_photometry(): the
+    difference of the counts, and the sum of their errors)
+    """
+    return (m['flux'][star]-m['flux'][comparison],
+            m['flux_err'][star]+m['flux_err'][comparison])
+
+def write_star(m, star, output_path, filt='r', flux=None, flux_err=None):
+    """
+    Input: a matrix, the ID of a star, the path of the results file to write,
+    the filter (optional; default 'r') and the photon counts and errors to
+    write instead of those of the matrix (optional; e.g. from
+    correct_weather())
+    Output: the number of lines written
+    Writes the stacks in which the star was detected in the format of the
+    results files (see lightcurve.py). The magnitudes are calibrated with the
+    zero point of each stack; they are nan where it is unknown.
+    """
+    if flux is None:
+        flux, flux_err = m['flux'][star], m['flux_err'][star]
+    zp = m.get('zero_point', np.full(len(flux), np.nan))
+    lines = []
+    for j in np.where(np.isfinite(flux))[0]:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mag = zp[j]-2.5*np.log10(flux[j])
+            mag_err = 2.5/np.log(10)*flux_err[j]/flux[j]
+        values = ([m[c][j] for c in PER_STACK]+
+                  [m['x'][star,j], m['y'][star,j], m['area'][star,j],
+                   flux[j], flux_err[j], mag, mag_err])
+        lines.append('\t'.join([str(v) for v in values])+'\t'+filt+'\n')
+    f = open(output_path, 'w')
+    f.write(''.join(lines))
+    f.close()
+    return len(lines)
+
+def weather_database(m, db_path, comparisons):
+    """
+    Input: a matrix, the path of the weather database to write and the IDs
+    of the comparison stars
+    Output: None
+    Writes the weather database of lightcurve.correct_weather() from the
+    comparison stars of the matrix, as lightcurve.build_weather_database()
+    would from their separate results files.
+    """
+    entries = []
+    for star in comparisons:
+        flux = m['flux'][star]
+        detected = np.where(np.isfinite(flux))[0]
+        largest = np.max(flux[detected]) if len(detected) > 0 else np.nan
+        entries.append(''.join([
+                '\t'.join([str(m['time'][j]), str(m['x'][star,j]),
+                           str(m['y'][star,j]), str(flux[j]),
+                           str(largest/flux[j])])+'\n' for j in detected]))
+    f = open(db_path, 'w')
+    f.write('ALT_CHANGE\n'.join(entries))
+    f.close()
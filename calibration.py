@@ -0,0 +1,141 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@calibration.py
+
+A persistent library of combined calibration images (master flats and master
+biases). Each master is combined once from a set of calibration files and
+stored on disk, keyed by a hash of the names, sizes and relevant headers of
+these files. Every subsequent stack which uses the same calibration files
+reuses the stored master instead of combining the flats again.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+from astropy.io import fits
+
+import reduction
+
+# header keywords which identify a calibration file
+# (NAXIS is excluded because produce_lists() modifies it for IRAF)
+CALIB_KEYWORDS = ['FILTRE', 'IMAGETYP', 'OBJECT', 'DATE', 'EXPOSURE',
+                  'NAXIS1', 'NAXIS2']
+
+# the combining performed for each kind of master; part of the key so that
+# changing it invalidates the stored masters
+METHODS = {'flat':'flatcombine median crreject mode',
+           'zero':'zerocombine average minmax'}
+
+
+def _calibration_header(filename):
+    """
+    Returns the header of a calibration file which contains the FILTRE
+    keyword (the 0th header, or the 1st if the file is extended).
+    """
+    hdul = fits.open(filename)
+    header = hdul[0].header
+    if not 'FILTRE' in header and len(hdul) > 1:
+        header = hdul[1].header
+    header = header.copy()
+    hdul.close()
+    return header
+
+class calibration_library:
+    """
+    Input:
+    library_directory: the directory in which to store the masters (created
+                       if it does not exist)
+
+    Output: calibration_library object
+    """
+    def __init__(self, library_directory):
+        self.dir = library_directory
+        os.makedirs(self.dir, exist_ok=True)
+
+    def key(self, filenames, kind, filter_type=''):
+        """
+        Input: a list of paths to calibration files, the kind of master
+        ('flat' or 'zero') and the band (optional; default is no band)
+        Output: the hexadecimal key of the master combined from these files
+        """
+        h = hashlib.sha1()
+        h.update((kind+'\t'+filter_type+'\t'+METHODS[kind]+'\n').encode())
+        for f in sorted(filenames, key=os.path.basename):
+            header = _calibration_header(f)
+            entry = [os.path.basename(f), str(os.path.getsize(f))]
+            entry += [str(header.get(k, '')) for k in CALIB_KEYWORDS]
+            h.update(('\t'.join(entry)+'\n').encode())
+        return h.hexdigest()
+
+    def path(self, key, kind, filter_type=''):
+        """
+        Input: the key of a master, its kind and its band
+        Output: the path at which this master is stored
+        """
+        prefix = 'Flat_'+filter_type if kind == 'flat' else 'bias'
+        return self.dir+'/'+prefix+'_'+key[:16]+'.fits'
+
+    def _build(self, filenames, kind, filter_type, ram_budget):
+        """
+        Returns the path to the master for these calibration files, combining
+        and storing it first if it is not in the library.
+        """
+        key = self.key(filenames, kind, filter_type)
+        master = self.path(key, kind, filter_type)
+        if os.path.exists(master):
+            return master
+
+        # combine under a temporary name so that a master which exists is
+        # always complete, even if several stacks build it at the same time
+        temp = master.replace('.fits', '.'+str(os.getpid())+'.tmp.fits')
+        if kind == 'flat':
+            reduction.flatcombine(filenames, temp, ram_budget=ram_budget)
+        else:
+            reduction.zerocombine(filenames, temp, ram_budget=ram_budget)
+        os.replace(temp, master)
+
+        # record what the master was built from
+        record = {'key':key, 'kind':kind, 'filter':filter_type,
+                  'method':METHODS[kind], 'created':time.ctime(),
+                  'inputs':sorted(filenames)}
+        f = open(master.replace('.fits', '.json'), 'w')
+        json.dump(record, f, indent=1)
+        f.close()
+        print("Stored new master "+kind+" "+os.path.basename(master))
+        return master
+
+    def master_flat(self, filenames, filter_type, ram_budget=None):
+        """
+        Input: a list of paths to the flats of a band, the band, and the
+        memory budget for combining (optional; see reduction.flatcombine())
+        Output: the path to the master flat
+        """
+        return self._build(filenames, 'flat', filter_type, ram_budget)
+
+    def master_bias(self, filenames, ram_budget=None):
+        """
+        Input: a list of paths to biases, and the memory budget for combining
+        (optional; see reduction.zerocombine())
+        Output: the path to the master bias
+        """
+        return self._build(filenames, 'zero', '', ram_budget)
+
+    def install(self, master, destination):
+        """
+        Input: the path to a master and the path to which to copy it (e.g. the
+        working directory, under the name IRAF expects)
+        Output: the image data of the master
+        """
+        shutil.copyfile(master, destination)
+        return reduction.load_frame(master)[0]
+
+    def clear(self):
+        """
+        Input: None
+        Output: None
+        Removes all masters from the library.
+        """
+        for f in os.listdir(self.dir):
+            if f.endswith('.fits') or f.endswith('.json'):
+                os.remove(self.dir+'/'+f)
@@ -0,0 +1,173 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@catalogue.py
+
+An on-disk cache of the reference catalogue (PS1, through Vizier) used by
+aperturephotometry.py to compute zero points, so that Vizier is not queried
+again for every stack of a night, and so that photometry can be run on nodes
+without internet access.
+
+The sky is divided into tiles of TILE_SIZE x TILE_SIZE degrees (in RA and
+Dec). Each tile is fetched from Vizier once, for a given catalogue, filter
+and magnitude cuts, and is stored as a compact binary table (a .npy
+structured array holding the RA, Dec, magnitude and magnitude error of each
+source) in the cache directory. A query for a field (centre and radius) reads
+the tiles covering it and keeps the sources within the radius.
+
+In offline mode, Vizier is never queried: only tiles already in the cache
+(e.g. fetched beforehand with prefetch(), on a node with internet access)
+are used.
+"""
+import os
+import numpy as np
+
+# reference catalogue, as in aperturephotometry.py
+REF_CATALOG = "II/349/ps1" # PanStarrs 1
+
+# width and height of a tile, in degrees
+TILE_SIZE = 0.25
+
+# magnitude cuts, as in aperturephotometry.py
+MINMAG = 10.0
+MAXMAG = 22.0
+MAX_EMAG = 0.3
+
+
+def tile_path(cache_dir, catalog, filt, cuts, i, j):
+    """
+    Input: the cache directory, the catalogue, the filter, the magnitude cuts
+    (minmag, maxmag, max_emag) and the indices of a tile (in RA and Dec)
+    Output: the path of the tile in the cache
+    """
+    key = '_'.join([catalog.replace('/', '-'), filt]+
+                   [repr(float(c)) for c in cuts]+[str(i), str(j)])
+    return os.path.join(cache_dir, key+'.npy')
+
+def tiles(ra, dec, radius):
+    """
+    Input: the RA and Dec of the centre of a field and its radius, in degrees
+    Output: a list of the indices (in RA and Dec) of the tiles covering it
+    """
+    nra = int(round(360.0/TILE_SIZE))
+    dec_min = max(dec-radius, -90.0)
+    dec_max = min(dec+radius, 90.0)
+    cos_dec = np.cos(np.radians(max(abs(dec_min), abs(dec_max))))
+    if cos_dec*180.0 <= radius: # the field reaches a pole
+        i_range = range(nra)
+    else:
+        dra = radius/cos_dec
+        i_range = [i % nra for i in range(int(np.floor((ra-dra)/TILE_SIZE)),
+                                          int(np.floor((ra+dra)/TILE_SIZE))+1)]
+    # the last row of tiles ends at the pole
+    j_range = range(int(np.floor(dec_min/TILE_SIZE)),
+                    min(int(np.floor(dec_max/TILE_SIZE)),
+                        int(round(90.0/TILE_SIZE))-1)+1)
+    return sorted(set([(i, j) for i in i_range for j in j_range]))
+
+def fetch_tile(catalog, filt, cuts, i, j):
+    """
+    Input: the catalogue, the filter, the magnitude cuts (minmag, maxmag,
+    max_emag) and the indices of a tile (in RA and Dec)
+    Output: the sources of the catalogue within the tile, as a structured
+    array (see read())
+    Queries Vizier for the circle enclosing the tile, then keeps the sources
+    within the tile.
+    """
+    from astroquery.vizier import Vizier
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+
+    minmag, maxmag, max_emag = cuts
+    ra0, dec0 = i*TILE_SIZE, j*TILE_SIZE
+    centre = SkyCoord(ra=ra0+TILE_SIZE/2.0, dec=dec0+TILE_SIZE/2.0,
+                      unit=(u.deg, u.deg))
+    # enclosing radius, in arcmin (the tile is narrower away from the equator)
+    radius = TILE_SIZE*np.sqrt(2.0)/2.0*60.0*1.01
+    v = Vizier(columns=["RAJ2000", "DEJ2000", filt+"mag", "e_"+filt+"mag"],
+               column_filters={filt+"mag":str(minmag)+".."+str(maxmag),
+                               "e_"+filt+"mag":"<"+str(max_emag)},
+               row_limit=-1) # no row limit
+    Q = v.query_region(centre, radius=str(radius)+'m', catalog=catalog,
+                       cache=False)
+    dtype = [('RAJ2000', np.float64), ('DEJ2000', np.float64),
+             (filt+'mag', np.float32), ('e_'+filt+'mag', np.float32)]
+    if len(Q) == 0: # no source
+        return np.zeros(0, dtype=dtype)
+    t = Q[0]
+    ra = np.asarray(t['RAJ2000'], dtype=np.float64)
+    dec = np.asarray(t['DEJ2000'], dtype=np.float64)
+    inside = ((np.floor(ra/TILE_SIZE) % int(round(360.0/TILE_SIZE)) == i) &
+              (np.floor(dec/TILE_SIZE) == j))
+    sources = np.zeros(np.sum(inside), dtype=dtype)
+    sources['RAJ2000'] = ra[inside]
+    sources['DEJ2000'] = dec[inside]
+    sources[filt+'mag'] = np.asarray(t[filt+'mag'])[inside]
+    sources['e_'+filt+'mag'] = np.asarray(t['e_'+filt+'mag'])[inside]
+    return sources
+
+def read(cache_dir, ra, dec, radius, filt, catalog=REF_CATALOG,
+         cuts=(MINMAG, MAXMAG, MAX_EMAG), offline=False):
+    """
+    Input: the cache directory (created if needed), the RA and Dec of the
+    centre of the field and its radius (in degrees), the filter (e.g. 'r'),
+    the catalogue (optional; default is PS1), the magnitude cuts (minmag,
+    maxmag, max_emag) (optional; default is as in aperturephotometry.py) and
+    whether to only use tiles already in the cache (optional; default False)
+    Output: an astropy Table of the sources of the catalogue within the
+    field, with the columns RAJ2000, DEJ2000, <filt>mag and e_<filt>mag (as
+    in a Vizier query)
+    Tiles missing from the cache are fetched from Vizier and added to it,
+    unless offline. In offline mode, missing tiles are reported and skipped.
+    """
+    from astropy.table import Table
+
+    os.makedirs(cache_dir, exist_ok=True)
+    parts = []
+    missing = 0
+    for i, j in tiles(ra, dec, radius):
+        path = tile_path(cache_dir, catalog, filt, cuts, i, j)
+        if os.path.exists(path):
+            parts.append(np.load(path))
+            continue
+        if offline:
+            missing += 1
+            continue
+        sources = fetch_tile(catalog, filt, cuts, i, j)
+        # written elsewhere, then moved into place, so that other processes
+        # never read a partial tile
+        temp = path+'.'+str(os.getpid())+'.tmp.npy'
+        np.save(temp, sources)
+        os.replace(temp, path)
+        parts.append(sources)
+    if missing > 0:
+        print(str(missing)+" tile(s) of "+catalog+" ("+filt+") covering "+
+              str((ra, dec))+" are not in the cache "+cache_dir+"; skipping "+
+              "them (offline mode)")
+
+    dtype = [('RAJ2000', np.float64), ('DEJ2000', np.float64),
+             (filt+'mag', np.float32), ('e_'+filt+'mag', np.float32)]
+    sources = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+    # keep the sources within the radius (angular distance from the centre)
+    r0, d0 = np.radians(ra), np.radians(dec)
+    r1, d1 = np.radians(sources['RAJ2000']), np.radians(sources['DEJ2000'])
+    cos_sep = (np.sin(d0)*np.sin(d1)+
+               np.cos(d0)*np.cos(d1)*np.cos(r1-r0))
+    within = cos_sep >= np.cos(np.radians(radius))
+    return Table(sources[within])
+
+def prefetch(cache_dir, ra, dec, radius, filters=('r', 'g', 'i', 'z'),
+             catalog=REF_CATALOG, cuts=(MINMAG, MAXMAG, MAX_EMAG)):
+    """
+    Input: the cache directory, the RA and Dec of the centre of a field and
+    its radius (in degrees), the filters to fetch (optional; default is r, g,
+    i and z), the catalogue (optional; default is PS1) and the magnitude cuts
+    (optional; default is as in aperturephotometry.py)
+    Output: None
+    Fetches all the tiles covering the field which are not yet in the cache,
+    so that photometry can later be run offline. Use a radius somewhat larger
+    than that of the field, to allow for its drift during the night.
+    """
+    for filt in filters:
+        t = read(cache_dir, ra, dec, radius, filt, catalog, cuts)
+        print("Cached "+str(len(t))+" sources of "+catalog+" ("+filt+") "+
+              "within "+str(radius)+" deg of "+str((ra, dec)))
@@ -4,6 +4,11 @@
 
 Stack domeflats and apply this stack to correct individual object images. Then, 
 stack the corrected object images.
+
+Run in the working directory, as 
+    python2 datared.py <results file> [<night>]
+or imported once by a long-lived worker (see iraf_daemon.py), which then calls
+datared() for each working directory.
 """
 
 
@@ -19,74 +24,110 @@ from iraf import noao, imred, ccdred
 from iraf import immatch
 from iraf import zerocombine, ccdproc, imcombine
 
-# if desired, can output a file which is named something other than 
-# "results.txt" by passing it as a cmd line arg
-results_file = str(sys.argv[1]) 
-
-for filter_type in ['r','g','i','z']:
-    name = "object_list_"+str(filter_type)+".txt"
-    subname = str(filter_type)+"_list.txt"
-    if ('object_list_'+filter_type+'.txt' in os.listdir(os.getcwd())) and (
-            os.stat(name).st_size!=0) and (os.stat(subname).st_size!=0):
-
-        # bias corrections performed automatically at OMM, so this correction 
-        # is unnecessary, but it is left here in case it is useful 
-        #ccdproc('@object_list_'+filter_type+'.txt',
-        #             zero='bias.fits',
-        #             zerocor = iraf.yes,
-        #             darkcor=iraf.no,
-        #             flatcor=iraf.no,
-        #             fixpix=iraf.no,
-        #             overscan=iraf.no,     
-        #             trim=iraf.no)
-
-        #copying the stack number, and the average and stdevs of exposure (ms) 
-        # and timestamp (s) to results.txt
-        f = open('object_list_'+filter_type+'.txt','r')
-        contents = f.readlines()
-        f.close()
-        stack = len(contents)
-        import numpy as np
-        from astropy.io import fits
-        exp = []
-        time = []
-        for line in contents:
-            hdu = fits.open(line[:-1])[0]
-            exp.append(hdu.header['EXPOSURE'])
-            date = hdu.header['DATE']
-            time.append(float(date[11:-13])*3600.0+
-                        float(date[14:-10])*60.0+
-                        float(date[17:-7])+
-                        float(date[20:])/1000000.0) # convert to seconds
-        exp = np.asarray(exp)
-        time = np.asarray(time)
-        estd = np.std(exp)
-        if estd < 1e-5:
-            estd = 0.0
-        tf = open('/data/irulan/omm_transients/'+results_file,'a')
-
-        # write the stack size, exposure time, error on exposure, timestamp, 
-        # and error on timestamp
-        tf.write(str(stack) + "\t" + str(np.mean(exp)) + "\t" +
-                 str(estd) + "\t" + str(np.mean(time)) + "\t" +
-                 str(np.std(time)) + "\t")
-        tf.close()
-
-        # apply the stacked flat correction to each object image, 
-        # then stack the corrected objects
-        ccdred.flatcombine('@'+filter_type+'_list.txt',
-                           output='Flat_'+filter_type+'.fits',
-                           combine='median',
-                           reject='crreject')
-        # zerocor=iraf.yes if bias.fits is supplied
-        # include zero="bias.fits" arg if bias.fits is supplied 
-        ccdproc('@object_list_'+filter_type+'.txt',
-                     flat='Flat_'+filter_type+'.fits',
-                     zerocor = iraf.no, 
-                     darkcor=iraf.no,   
-                     flatcor=iraf.yes, 
-                     fixpix=iraf.no,
-                     overscan=iraf.no,
-                     trim=iraf.no)
-        imcombine('@object_list_'+filter_type+'.txt', 
-                  output='object_'+filter_type+'_reduced.fits')
\ No newline at end of file
+import numpy as np
+import headerstats
+
+# directory to which the stack statistics are appended
+RESULTS_DIRECTORY = '/data/irulan/omm_transients'
+
+
+def datared(results_file, night=None, results_dir=RESULTS_DIRECTORY,
+            zerocor=False):
+    """
+    Input: the name of the results file, the night from which to measure the 
+    timestamps (optional; default is the date of the earliest frame of the 
+    stack), the directory of the results file (optional; ignored if 
+    results_file is an absolute path) and whether to bias-correct the object
+    images (optional; default is False)
+    Output: None
+    Reduces the working directory which is the current directory (of both 
+    Python and IRAF). The object images are bias-corrected if bias.fits is 
+    present (e.g. copied from a calibration library); with zerocor, it is 
+    first combined from the biases of bias_list.txt if absent.
+    """
+    if zerocor and not os.path.exists('bias.fits'):
+        if os.path.exists('bias_list.txt') and (
+                os.stat('bias_list.txt').st_size != 0):
+            zerocombine('@bias_list.txt', output='bias.fits')
+        else:
+            print("No biases in the working directory; the object images "+
+                  "are not bias-corrected")
+    for filter_type in ['r','g','i','z']:
+        name = "object_list_"+str(filter_type)+".txt"
+        subname = str(filter_type)+"_list.txt"
+        if ('object_list_'+filter_type+'.txt' in os.listdir(os.getcwd())) and (
+                os.stat(name).st_size!=0) and (os.stat(subname).st_size!=0):
+
+            # bias corrections performed automatically at OMM, so this correction 
+            # is unnecessary, but it is left here in case it is useful 
+            #ccdproc('@object_list_'+filter_type+'.txt',
+            #             zero='bias.fits',
+            #             zerocor = iraf.yes,
+            #             darkcor=iraf.no,
+            #             flatcor=iraf.no,
+            #             fixpix=iraf.no,
+            #             overscan=iraf.no,     
+            #             trim=iraf.no)
+
+            #copying the stack number, and the average and stdevs of exposure (ms) 
+            # and timestamp (s) to results.txt
+            # (headers read in parallel, see headerstats.py)
+            f = open('object_list_'+filter_type+'.txt','r')
+            contents = [line.strip() for line in f.readlines() if line.strip()]
+            f.close()
+            stack, exp, estd, time, tstd = headerstats.stack_statistics(contents,
+                                                                        night)
+            tf = open(os.path.join(results_dir, results_file),'a')
+
+            # write the stack size, exposure time, error on exposure, timestamp, 
+            # and error on timestamp
+            tf.write(str(stack) + "\t" + str(exp) + "\t" +
+                     str(estd) + "\t" + str(time) + "\t" +
+                     str(tstd) + "\t")
+            tf.close()
+
+            # apply the stacked flat correction to each object image, 
+            # then stack the corrected objects
+            # if a master flat was copied from a calibration library (see 
+            # calibration.py), it is used as-is
+            if not os.path.exists('Flat_'+filter_type+'.fits'):
+                ccdred.flatcombine('@'+filter_type+'_list.txt',
+                                   output='Flat_'+filter_type+'.fits',
+                                   combine='median',
+                                   reject='crreject')
+            # zerocor=iraf.yes if bias.fits is supplied
+            # include zero="bias.fits" arg if bias.fits is supplied 
+            if os.path.exists('bias.fits'):
+                zerocor = iraf.yes
+            else:
+                zerocor = iraf.no
+            ccdproc('@object_list_'+filter_type+'.txt',
+                         flat='Flat_'+filter_type+'.fits',
+                         zero='bias.fits',
+                         zerocor = zerocor, 
+                         darkcor=iraf.no,   
+                         flatcor=iraf.yes, 
+                         fixpix=iraf.no,
+                         overscan=iraf.no,
+                         trim=iraf.no)
+            imcombine('@object_list_'+filter_type+'.txt', 
+                      output='object_'+filter_type+'_reduced.fits')
+
+
+if __name__ == '__main__':
+    # if desired, can output a file which is named something other than 
+    # "results.txt" by passing it as a cmd line arg
+    results_file = str(sys.argv[1]) 
+
+    # the night from which to measure the timestamps (e.g. 2018-07-09) can be 
+    # passed as a second arg, so that frames taken after midnight follow 
+    # those taken before it; by default, the date of the earliest frame of the
+    # stack
+    # pass --zerocor to combine the biases and bias-correct the object images
+    zerocor = '--zerocor' in sys.argv
+    args = [a for a in sys.argv[2:] if a != '--zerocor']
+    night = None
+    if len(args) > 0:
+        night = str(args[0])
+
+    datared(results_file, night, zerocor=zerocor)
@@ -0,0 +1,73 @@
+"""
+@authors: Nicholas Vieira & Valérie Desharnais
+@hierarchical.py
+
+An example of hierarchical stacking for MAXI J1820+070: the object frames of
+the night are reduced once into base stacks of <base> frames (see
+multiscale.py), and stacks of each of the given sizes (multiples of <base>)
+are then composed from them, without reading the frames again.
+
+The object frames of the night are first packed into one memory-mapped cube
+per band (see framecube.py). The base stacks are kept next to the cube, so
+that running the script again with other stack sizes reuses them.
+"""
+
+import os
+import PESTO_lib
+import reduction
+import multiscale
+
+whichdate = '190312'
+base = int(input("\nWhat is the base stack size? \n> "))
+sizes = [int(s) for s in input("\nWhich stack sizes? (multiples of the "+
+                                 "base stack size, e.g. 1000 3000)\n> "
+                                 ).split()]
+combine = 'average' # or 'median'
+
+location = ["/exports/scratch/MAXIJ1820/"+whichdate+"_night",
+            "/exports/scratch/MAXIJ1820/"+whichdate+"_calibs"]
+target = "/exports/scratch/MAXIJ1820"
+name = "hierarchical_"+whichdate
+wcs_location = ("/data/irulan/omm_transients/wcs_solutions/"+whichdate+
+                "_soln.fits")
+
+# FOR MAXI
+RA = [275.087, 275.095]
+DEC = [7.184, 7.187]
+
+data = PESTO_lib.raw_PESTO_data(location, ["object","calibration"], name,
+                                target)
+data.produce_lists(readonly=True) # the raw frames are never modified
+cubes = data.make_frame_cubes(target)
+cube = cubes['r']
+products = target+"/"+name+"_base"+str(base)
+if os.path.exists(products+".txt"):
+    base_stacks = multiscale.multiscale_stacks(products)
+else:
+    flat = reduction.flatcombine([reduction.resolve(location[1]+'/'+f) for f
+                                  in data.r_cal], ram_budget=2e9)[0]
+    base_stacks = multiscale.build(cube, products, base, flat)
+
+for size in sizes:
+    results_file = "results_"+whichdate+"_"+str(size)+".txt"
+    for first, last, image, stats in base_stacks.stacks(size, 
+                                                        combine=combine):
+        # one reduced data directory per stack, as for
+        # extract_reduced_images()
+        folder = name+"_"+str(size)+"_"+str(first)
+        os.makedirs(target+"/"+name+"/"+folder, exist_ok=True)
+        header = cube.header.copy()
+        header['NCOMBINE'] = last-first
+        header['DATE'] = cube.dates[first]
+        reduction.write_image(target+"/"+name+"/"+folder+
+                              "/object_r_reduced.fits", image, header)
+
+        # same statistics as datared.py
+        tf = open(reduction.RESULTS_DIRECTORY+"/"+results_file, 'a')
+        tf.write("\t".join([str(s) for s in stats])+"\t")
+        tf.close()
+
+        reduced_data = PESTO_lib.reduced_PESTO_data([target+"/"+name], 
+                                                    ['object'], folder)
+        reduced_data.WCS_merge(wcs_location)
+        reduced_data.photometry(RA, DEC, 2.0, results_file)
@@ -0,0 +1,63 @@
+"""
+@authors: Nicholas Vieira & Valérie Desharnais
+@rolling.py
+
+An example of overlapping (rolling) stacks for MAXI J1820+070: a stack of
+<stack> frames is produced every <stride> frames, e.g. stacks of 1000 frames
+every 100 frames, for better time resolution (QPO work) than disjoint stacks.
+
+The object frames of the night are first packed into one memory-mapped cube
+per band (see framecube.py). Each new stack then only reads the <stride>
+frames which enter it (running sums for averages), rather than reducing
+<stack> frames again.
+"""
+
+import os
+import PESTO_lib
+import reduction
+
+whichdate = '190312'
+stack = int(input("\nWhat is the stack size? \n> "))
+stride = int(input("\nHow many frames between the starts of two stacks? \n> "))
+combine = 'average' # or 'median'
+
+location = ["/exports/scratch/MAXIJ1820/"+whichdate+"_night",
+            "/exports/scratch/MAXIJ1820/"+whichdate+"_calibs"]
+target = "/exports/scratch/MAXIJ1820"
+name = "rolling_"+whichdate
+results_file = "results_"+whichdate+"_rolling.txt"
+wcs_location = ("/data/irulan/omm_transients/wcs_solutions/"+whichdate+
+                "_soln.fits")
+
+# FOR MAXI
+RA = [275.087, 275.095]
+DEC = [7.184, 7.187]
+
+data = PESTO_lib.raw_PESTO_data(location, ["object","calibration"], name,
+                                target)
+data.produce_lists(readonly=True) # the raw frames are never modified
+cubes = data.make_frame_cubes(target)
+flat = reduction.flatcombine([reduction.resolve(location[1]+'/'+f) for f in
+                              data.r_cal], ram_budget=2e9)[0]
+cube = cubes['r']
+
+for first, last, image in cube.rolling_stacks(stack, stride, combine, flat,
+                                             ram_budget=2e9):
+    # one reduced data directory per stack, as for extract_reduced_images()
+    folder = name+"_"+str(first)
+    os.makedirs(target+"/"+name+"/"+folder, exist_ok=True)
+    header = cube.header.copy()
+    header['NCOMBINE'] = last-first
+    header['DATE'] = cube.dates[first]
+    reduction.write_image(target+"/"+name+"/"+folder+"/object_r_reduced.fits",
+                          image, header)
+
+    # same statistics as datared.py, from the sidecar table of the cube
+    tf = open(reduction.RESULTS_DIRECTORY+"/"+results_file, 'a')
+    tf.write("\t".join([str(s) for s in cube.statistics(first, last)])+"\t")
+    tf.close()
+
+    reduced_data = PESTO_lib.reduced_PESTO_data([target+"/"+name], ['object'],
+                                                folder)
+    reduced_data.WCS_merge(wcs_location)
+    reduced_data.photometry(RA, DEC, 2.0, results_file)
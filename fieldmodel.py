@@ -0,0 +1,108 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@fieldmodel.py
+
+A model of the field observed during a night, reused by the photometry of
+every stack (see aperturephotometry.py) to match the detected sources to the
+reference catalogue.
+
+The model holds the sources of the catalogue which fall on the image (away
+from its edges), their pixel positions under the WCS solution of the stacks,
+and a KD-tree over these positions. The detections of each stack are then
+matched to the catalogue with a single query of the tree, instead of
+building SkyCoord objects and projecting the catalogue for every stack. The
+projection is only recomputed when the WCS solution of a stack moves the
+field by more than a tolerance (in pixels) from the one the model was built
+with.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+# fraction of the image, on each side, in which catalogue sources are ignored
+EDGE = 0.05
+
+
+class field_model:
+    """
+    Input:
+    catalog: the sources of the reference catalogue around the field (an
+             astropy Table with the columns RAJ2000 and DEJ2000, as returned
+             by Vizier or catalogue.read())
+    wcs: the WCS solution of the stacks (astropy.wcs.WCS)
+    shape: the shape of the images (rows, columns)
+    tolerance: the largest shift of the field, in pixels, for which the
+               projection of the catalogue is reused (optional; default 0.5)
+
+    Output: field_model object
+    """
+    def __init__(self, catalog, wcs, shape, tolerance=0.5):
+        self.catalog = catalog
+        self.shape = shape
+        self.tolerance = tolerance
+        self.ra = np.asarray(catalog['RAJ2000'], dtype=np.float64)
+        self.dec = np.asarray(catalog['DEJ2000'], dtype=np.float64)
+        self.projections = 0
+        self.project(wcs)
+
+    def project(self, wcs):
+        """
+        Input: a WCS solution
+        Output: None
+        Projects the catalogue onto the image, keeps the sources away from
+        its edges and builds the KD-tree over their pixel positions.
+        """
+        y_size, x_size = self.shape
+        # pixel coordinates as in aperturephotometry.py (origin 1)
+        x, y = wcs.all_world2pix(self.ra, self.dec, 1)
+        x_lims = [int(EDGE*x_size), int((1-EDGE)*x_size)]
+        y_lims = [int(EDGE*y_size), int((1-EDGE)*y_size)]
+        self.good = np.where((x > x_lims[0]) & (x < x_lims[1]) &
+                             (y > y_lims[0]) & (y < y_lims[1]))[0]
+        self.sources = self.catalog[self.good] # sources on the image
+        self.xy = np.column_stack([x[self.good], y[self.good]])
+        self.tree = cKDTree(self.xy) if len(self.good) > 0 else None
+        self.wcs = wcs
+        # the corners and centre of the image, to measure shifts of the field
+        corners = np.array([[1, 1], [x_size, 1], [1, y_size],
+                            [x_size, y_size], [x_size/2.0, y_size/2.0]],
+                           dtype=np.float64)
+        self.probe_pix = corners
+        self.probe_world = np.column_stack(wcs.all_pix2world(
+                corners[:,0], corners[:,1], 1))
+        self.projections += 1
+
+    def shift(self, wcs):
+        """
+        Input: a WCS solution
+        Output: the largest shift, in pixels, of the corners and centre of
+        the image between the WCS of the model and this one
+        """
+        x, y = wcs.all_world2pix(self.probe_world[:,0], self.probe_world[:,1],
+                                 1)
+        return np.max(np.hypot(x-self.probe_pix[:,0], y-self.probe_pix[:,1]))
+
+    def update(self, wcs):
+        """
+        Input: the WCS solution of a stack
+        Output: whether the projection of the catalogue was recomputed
+        """
+        if self.shift(wcs) <= self.tolerance:
+            return False
+        self.project(wcs)
+        return True
+
+    def match(self, x, y, radius=5.0):
+        """
+        Input: the pixel positions of the detected sources of a stack (as in
+        aperturephotometry.py), and the largest distance, in pixels, between
+        a detection and its catalogue source (optional; default 5.0)
+        Output: the indices of the matched detections and of their sources in
+        self.sources (the nearest catalogue source to each detection)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.tree is None or len(x) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        points = np.column_stack([x, np.asarray(y, dtype=np.float64)])
+        d, idx = self.tree.query(points, distance_upper_bound=radius)
+        matched = np.isfinite(d)
+        return np.where(matched)[0], idx[matched]
@@ -0,0 +1,269 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@framecube.py
+
+Packs all the object frames of a night in one band into a single
+memory-mapped cube (frame, y, x), stored as a .npy file, together with a
+sidecar table (.txt) of the filename, timestamp and exposure of each frame
+and the header of the first frame (.hdr).
+
+The frames are read once, at ingest. Every later stage selects a range of
+frames as a slice of the memory map, which copies nothing: stacking,
+screening and photometry then read only the pixels they use, instead of
+opening (and copying into a working directory) thousands of small files.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.io import fits
+
+import reduction
+import headerstats
+
+# columns of the sidecar table
+TABLE_COLUMNS = ['filename', 'date', 'time', 'exposure']
+
+# number of frames read at once when updating a running sum
+ROLLING_CHUNK = 100
+
+
+def read_frame(filename):
+    """
+    Input: the path to a .fits, .fits.gz or .fits.fz file
+    Output: the image data (in its own data type, scaled) and its header
+    """
+    hdul = reduction.open_frame(filename)
+    for hdu in hdul:
+        if hdu.data is not None:
+            data = np.asarray(hdu.data)
+            header = hdu.header.copy()
+            hdul.close()
+            return data, header
+    hdul.close()
+    raise ValueError("No image data found in "+filename)
+
+def ingest(filenames, path, dtype=None, threads=None):
+    """
+    Input: a list of paths to the object frames of a night in one band, the
+    path (without extension) of the cube to create, the data type of the
+    cube (optional; default is the data type of the first frame, e.g. uint16
+    for raw frames) and the number of threads used to read the frames
+    (optional; default is chosen by concurrent.futures)
+    Output: the frame_cube
+    Writes <path>.npy, <path>.txt and <path>.hdr. The frames are sorted by
+    timestamp, and their timestamps are measured from the midnight starting
+    the night of the first frame (see headerstats.to_seconds()). The cube is
+    written under a temporary name, so that a cube which exists is always
+    complete.
+    """
+    exposures, dates = headerstats.read_keywords(filenames, threads or
+                                                 headerstats.THREADS)
+    order = np.argsort(headerstats.parse_dates(dates), kind='stable')
+    filenames = [filenames[i] for i in order]
+    dates = [dates[i] for i in order]
+    exposures = exposures[order]
+    times = headerstats.to_seconds(headerstats.parse_dates(dates))
+    first, header = read_frame(filenames[0])
+    if dtype is None:
+        dtype = first.dtype
+    temp = path+'.'+str(os.getpid())+'.tmp.npy'
+    cube = np.lib.format.open_memmap(temp, mode='w+', dtype=dtype,
+                                     shape=(len(filenames),)+first.shape)
+    cube[0] = first
+    pool = ThreadPoolExecutor(threads)
+    for i, frame in enumerate(pool.map(read_frame, filenames[1:])):
+        cube[i+1] = frame[0]
+    pool.shutdown()
+    cube.flush()
+    del cube
+    os.replace(temp, path+'.npy')
+
+    f = open(path+'.txt', 'w')
+    f.write('# '+'\t'.join(TABLE_COLUMNS)+'\n')
+    for i in range(len(filenames)):
+        f.write('\t'.join([os.path.abspath(filenames[i]), dates[i],
+                           repr(float(times[i])),
+                           repr(float(exposures[i]))])+'\n')
+    f.close()
+    header.totextfile(path+'.hdr', overwrite=True)
+    print("Packed "+str(len(filenames))+" frames into "+path+'.npy')
+    return frame_cube(path)
+
+class frame_cube:
+    """
+    Input:
+    path: the path (without extension) of a cube written by ingest()
+
+    Output: frame_cube object
+
+    The cube is opened read-only as a memory map: frames are only read from
+    disk when their pixels are used.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(path+'.npy', mmap_mode='r')
+        self.header = fits.Header.fromtextfile(path+'.hdr')
+        self.filenames = []
+        self.dates = []
+        times = []
+        exposures = []
+        f = open(path+'.txt', 'r')
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            name, date, t, exp = line.rstrip('\n').split('\t')
+            self.filenames.append(name)
+            self.dates.append(date)
+            times.append(float(t))
+            exposures.append(float(exp))
+        f.close()
+        self.times = np.asarray(times)
+        self.exposures = np.asarray(exposures)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def frames(self, start=0, stop=None, step=1):
+        """
+        Input: the first and last (excluded) frames, and the step (optional;
+        default is every frame)
+        Output: the frames, as a read-only view of the memory map (no copy)
+        """
+        return self.data[start:stop:step]
+
+    def select(self, t0, t1):
+        """
+        Input: the start and end times (in s since the midnight starting
+        the night, as in self.times; times of day after midnight are also
+        accepted)
+        Output: the first and last (excluded) frames taken in [t0, t1)
+        """
+        if t0 < self.times[0]-43200.0: # a time of day after midnight
+            t0 += 86400.0
+            t1 += 86400.0
+        return (int(np.searchsorted(self.times, t0, side='left')),
+                int(np.searchsorted(self.times, t1, side='left')))
+
+    def statistics(self, start=0, stop=None):
+        """
+        Input: the first and last (excluded) frames
+        Output: the same statistics as reduction.stack_statistics(), taken
+        from the sidecar table instead of the headers
+        """
+        exp = self.exposures[start:stop]
+        time = self.times[start:stop]
+        estd = np.std(exp)
+        if estd < 1e-5:
+            estd = 0.0
+        return len(exp), np.mean(exp), estd, np.mean(time), np.std(time)
+
+    def stack(self, start=0, stop=None, flat=None, bias=None,
+              ram_budget=2e9):
+        """
+        Input: the first and last (excluded) frames, a combined flat and a
+        combined bias with which to correct the frames (optional; default is
+        no correction) and the memory budget in bytes (optional; default is
+        2 GB)
+        Output: the stacked image (average, no rejection, as imcombine)
+        The frames are read from the memory map one tile of rows at a time
+        (see reduction.tiled_combine()).
+        """
+        return reduction.tiled_combine(self.frames(start, stop), 'average',
+                                       'none', flat=flat, zero=bias,
+                                       ram_budget=ram_budget)
+
+    def corrected(self, start, stop, flat=None, bias=None, flat_mean=None):
+        """
+        Input: the first and last (excluded) frames, a combined flat and a
+        combined bias (optional; default is no correction) and the mean of
+        the flat (optional; default is computed from the flat)
+        Output: the frames (as float64), bias- and flat-corrected
+        """
+        data = np.array(self.data[start:stop], dtype=np.float64)
+        if bias is not None:
+            data = reduction.zero_correct(data, bias)
+        if flat is not None:
+            data = reduction.flat_correct(data, flat, flat_mean)
+        return data
+
+    def rolling_stacks(self, stack, stride, combine='average', flat=None,
+                       bias=None, start=0, stop=None, ram_budget=2e9):
+        """
+        Input: the number of frames per stack, the number of frames between
+        the starts of two consecutive stacks, the type of combining
+        ('average' or 'median'; optional, default is 'average'), a combined
+        flat and a combined bias (optional; default is no correction), the
+        range of frames to stack (optional; default is the whole cube) and
+        the memory budget in bytes (optional; default is 2 GB)
+        Output: a generator of (first frame, last frame (excluded), stacked
+        image), one for each stack
+        Produces overlapping stacks when stride < stack. For averages, a
+        running sum is kept, so each stack only reads the O(stride) frames
+        which enter (and leave) it, ROLLING_CHUNK frames at a time. For
+        medians, the frames of the previous stack are kept in a ring buffer
+        (stack frames in float64) and only those which leave are replaced,
+        if the ring fits within the memory budget; otherwise, each stack is
+        combined from the memory map one tile of rows at a time (see
+        reduction.tiled_combine()), as in stack().
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        flat_mean = None if flat is None else np.mean(flat)
+        if combine == 'average':
+            total = None
+            for first in range(start, stop-stack+1, stride):
+                last = first+stack
+                if total is None or stride >= stack:
+                    total = np.zeros(self.data.shape[1:], dtype=np.float64)
+                    entering = first
+                else:
+                    for i in range(first-stride, first, ROLLING_CHUNK):
+                        total -= np.sum(self.corrected(
+                                i, min(first, i+ROLLING_CHUNK), flat, bias,
+                                flat_mean), axis=0)
+                    entering = last-stride
+                for i in range(entering, last, ROLLING_CHUNK):
+                    total += np.sum(self.corrected(
+                            i, min(last, i+ROLLING_CHUNK), flat, bias,
+                            flat_mean), axis=0)
+                yield first, last, total/stack
+        elif combine == 'median':
+            ring = None
+            ring_bytes = (stack*self.data.shape[1]*self.data.shape[2]*8*
+                          reduction.TILE_OVERHEAD)
+            for first in range(start, stop-stack+1, stride):
+                if ring_bytes > ram_budget:
+                    yield first, first+stack, reduction.tiled_combine(
+                            self.data[first:first+stack], 'median', 'none',
+                            flat=flat, zero=bias, ram_budget=ram_budget)
+                    continue
+                last = first+stack
+                if ring is None or stride >= stack:
+                    ring = np.empty((stack,)+self.data.shape[1:],
+                                    dtype=np.float64)
+                    entering = first
+                else:
+                    entering = last-stride
+                # frame i is kept in slot i % stack, which is the slot of the
+                # frame (i-stack) leaving the stack
+                for i in range(entering, last):
+                    ring[i % stack] = self.corrected(i, i+1, flat, bias,
+                                                     flat_mean)[0]
+                yield first, last, np.nanmedian(ring, axis=0)
+        else:
+            raise ValueError("Unknown combine: "+str(combine))
+
+    def write_stack(self, filename, start=0, stop=None, flat=None, bias=None,
+                    ram_budget=2e9):
+        """
+        Input: the path of the image to write, and the same as stack()
+        Output: the statistics of the stack (see statistics())
+        Writes the stacked image, with the header of the first frame of the
+        cube, e.g. for photometry with reduced_PESTO_data.
+        """
+        header = self.header.copy()
+        header['NCOMBINE'] = len(self.frames(start, stop))
+        header['DATE'] = self.dates[start]
+        reduction.write_image(filename, self.stack(start, stop, flat, bias,
+                                                   ram_budget), header)
+        return self.statistics(start, stop)
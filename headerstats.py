@@ -0,0 +1,137 @@
+"""
+@authors: Valerie Desharnais & Nicholas Vieira
+@headerstats.py
+
+Batched extraction of the statistics of a stack from the headers of its
+frames: the stack size, the mean and standard deviation of the exposure, and
+the mean and standard deviation of the timestamp.
+
+The headers are read in parallel (by threads), and the DATE keywords are
+parsed all at once with numpy's datetime64, rather than frame by frame. The
+timestamps are measured from the midnight (UTC) starting the night, so that
+frames taken after midnight follow those taken before it instead of starting
+over at 0 s.
+
+By default, the night is the date (UTC) of the earliest frame of the stack,
+so that a stack taken within one date has the same timestamps as the time
+of day used before. Passing night=OBSERVING instead measures every stack
+from the observing night of its earliest frame (its date NIGHT_OFFSET
+earlier), so that all the stacks of a night, even those taken wholly after
+midnight, share one origin. Timestamps after midnight are then above
+86400 s: results files written with either origin must not be mixed.
+
+Used by both datared.py (Python 2, in the iraf environment) and reduction.py,
+so this module must remain compatible with Python 2.
+"""
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from astropy.io import fits
+
+# keywords read from each frame
+KEYWORDS = ['EXPOSURE', 'DATE']
+
+# the start of the Modified Julian Date
+MJD_ZERO = np.datetime64('1858-11-17T00:00:00', 'us')
+
+# number of threads reading headers
+THREADS = 8
+
+# the night argument selecting the observing night of the earliest frame
+OBSERVING = 'observing'
+
+# a frame belongs to the observing night of the date this much earlier (frames
+# taken before noon (UTC) belong to the night which started the day before)
+NIGHT_OFFSET = np.timedelta64(12, 'h')
+
+
+def _read_keywords(filename):
+    """
+    Returns the values of KEYWORDS in the 0th header of a frame.
+    """
+    header = fits.getheader(filename, 0)
+    return [header[k] for k in KEYWORDS]
+
+def read_keywords(filenames, threads=THREADS):
+    """
+    Input: a list of paths to .fits files, and the number of threads reading
+    them (optional; default is THREADS)
+    Output: an array of the exposures and a list of the dates of the frames
+    """
+    if len(filenames) == 0:
+        return np.zeros(0), []
+    pool = ThreadPool(max(1, min(threads, len(filenames))))
+    values = pool.map(_read_keywords, filenames)
+    pool.close()
+    pool.join()
+    exp = np.array([v[0] for v in values], dtype=np.float64)
+    dates = [v[1] for v in values]
+    return exp, dates
+
+def parse_dates(dates):
+    """
+    Input: a list of DATE keywords (e.g. '2018-07-09T23:59:50.123456')
+    Output: an array of datetime64 (in microseconds)
+    """
+    return np.array(dates, dtype='datetime64[us]')
+
+def night_start(night):
+    """
+    Input: the night, as a date ('2018-07-09'), a DATE keyword or a
+    datetime64
+    Output: midnight (UTC) starting this date, as a datetime64 (in
+    microseconds)
+    """
+    return np.datetime64(np.datetime64(night, 'D'), 'us')
+
+def observing_night(times):
+    """
+    Input: an array of datetime64
+    Output: the observing night of the earliest time, as a datetime64 (in
+    days)
+    """
+    return np.datetime64(times.min()-NIGHT_OFFSET, 'D')
+
+def to_seconds(times, night=None):
+    """
+    Input: an array of datetime64, and the night from which to measure them
+    (optional; default is the date of the earliest time; OBSERVING for the
+    observing night of the earliest time, see observing_night())
+    Output: an array of the times, in s since midnight starting the night
+    Times after the following midnight are above 86400 s.
+    """
+    if night is None:
+        night = times.min()
+    elif isinstance(night, str) and night == OBSERVING:
+        night = observing_night(times)
+    delta = times-night_start(night)
+    return delta.astype('timedelta64[us]').astype(np.int64)/1e6
+
+def to_mjd(times):
+    """
+    Input: an array of datetime64
+    Output: an array of the Modified Julian Dates of the times
+    """
+    delta = (times-MJD_ZERO).astype('timedelta64[us]').astype(np.int64)
+    return delta/86400e6
+
+def stack_statistics(filenames, night=None, units='seconds', threads=THREADS):
+    """
+    Input: a list of paths to the object images of a stack, the night from
+    which to measure the timestamps (optional; default is the date of the
+    earliest frame of the stack; see to_seconds()), the units of the
+    timestamps, 'seconds' or 'mjd' (optional; default is 'seconds') and the
+    number of threads reading the headers (optional; default is THREADS)
+    Output: the stack size, the mean and standard deviation of the exposure
+    and the mean and standard deviation of the timestamp (in s, or in days
+    for MJD)
+    """
+    exp, dates = read_keywords(filenames, threads)
+    times = parse_dates(dates)
+    if units == 'mjd':
+        t = to_mjd(times)
+    else:
+        t = to_seconds(times, night)
+    estd = np.std(exp)
+    if estd < 1e-5:
+        estd = 0.0
+    return len(filenames), np.mean(exp), estd, np.mean(t), np.std(t)
@@ -0,0 +1,276 @@
+"""
+@authors: Valerie Desharnais & Nicholas Vieira
+@iraf_daemon.py
+
+A long-lived IRAF reduction worker. The worker loads PyRAF and ccdred once,
+then takes reduction jobs from a spool directory and runs datared() (see
+datared.py) on each, so that conda activation, interpreter startup and the
+loading of IRAF are paid once per worker instead of once per stack.
+
+The spool directory holds:
+    queue/    jobs waiting to be run (one .json file per job)
+    running/  jobs claimed by a worker
+    done/     the status of finished jobs, until it is read by wait() (a job
+              whose worker died is moved here as failed)
+    stop      if present, the workers exit once their current job is done
+A job is claimed by renaming it into running/, which only one worker can do,
+so several workers may serve the same spool directory side by side.
+
+Start a worker (in the iraf environment, from a directory containing the
+login.cl to use) with
+    python2 iraf_daemon.py <spool directory>
+raw_PESTO_data.pyraf_reduction(backend='daemon', spool=...) then submits
+jobs and waits for them.
+
+The submission functions are also used by PESTO_lib.py (Python 3), so this
+module must remain compatible with both Python 2 and 3, and must only import
+PyRAF when serving.
+"""
+import os
+import sys
+import json
+import errno
+import time
+import socket
+import traceback
+import subprocess
+
+# time between two looks at the queue, in s
+POLL_INTERVAL = 0.5
+
+# default maximum time to wait for a job, in s
+TIMEOUT = 4*3600
+
+
+def spool_directories(spool):
+    """
+    Input: the spool directory
+    Output: None
+    Creates the subdirectories of the spool directory if needed.
+    """
+    for d in ['queue', 'running', 'done']:
+        if not os.path.isdir(spool+'/'+d):
+            try:
+                os.makedirs(spool+'/'+d)
+            except OSError: # created by another worker
+                pass
+
+def submit(spool, workdir, results_file="results.txt", night=None,
+           results_dir=None, zerocor=False):
+    """
+    Input: the spool directory, the (absolute) working directory to reduce,
+    the name of the results file (optional; "results.txt" by default), the
+    night from which to measure the timestamps (optional; see datared.py),
+    the directory of the results file (optional; same as datared.py by
+    default) and whether to bias-correct the object images (optional;
+    default is False; see datared.py)
+    Output: the name of the job
+    """
+    spool_directories(spool)
+    job = (socket.gethostname()+'_'+str(os.getpid())+'_'+
+           repr(time.time()).replace('.', '_'))
+    record = {'workdir':os.path.abspath(workdir),
+              'results_file':results_file, 'night':night,
+              'results_dir':results_dir, 'zerocor':zerocor,
+              'submitted':time.time()}
+    # written elsewhere, then moved into the queue, so that workers never
+    # see a partial job
+    temp = spool+'/'+job+'.tmp'
+    f = open(temp, 'w')
+    json.dump(record, f)
+    f.close()
+    os.rename(temp, spool+'/queue/'+job+'.json')
+    return job
+
+def alive(worker):
+    """
+    Input: the name of a worker (<host>_<pid>)
+    Output: False if the worker runs on this host and its process is gone,
+    True otherwise (the processes of other hosts cannot be checked)
+    """
+    host, pid = worker.rsplit('_', 1)
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def write_status(spool, name, status):
+    """
+    Input: the spool directory, the file name of a job (<job>.json) and its
+    status
+    Output: None
+    Writes the status into done/, where wait() reads it.
+    """
+    temp = spool+'/done/'+name+'.tmp'
+    f = open(temp, 'w')
+    json.dump(status, f)
+    f.close()
+    os.rename(temp, spool+'/done/'+name)
+
+def abandon(spool, running, worker):
+    """
+    Input: the spool directory, the path to a job in running/ and the name of
+    its worker, which died
+    Output: None
+    Moves the job into done/ as failed, so that it is neither left in
+    running/ nor run again.
+    """
+    try:
+        f = open(running, 'r')
+        status = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError): # removed in the meantime
+        return
+    status['worker'] = worker
+    status['status'] = 'failed'
+    status['error'] = 'The worker '+worker+' running the job died'
+    name = os.path.basename(running).split('__', 1)[1]
+    if not os.path.exists(spool+'/done/'+name): # not finished in the meantime
+        write_status(spool, name, status)
+    try:
+        os.remove(running)
+    except OSError:
+        pass
+
+def wait(spool, job, timeout=TIMEOUT):
+    """
+    Input: the spool directory, the name of a job and the maximum time to
+    wait in s (optional; default is TIMEOUT; None for no maximum)
+    Output: the status of the job (a dictionary whose 'status' is 'done' or
+    'failed', the latter with an 'error'), or None if the job did not finish
+    in time
+    The status is removed from done/ once read. A job whose worker died is
+    moved from running/ into done/ as failed (see abandon()); a job which is
+    still queued when the time is up is withdrawn from the queue (one which
+    is running is left to its worker, and its status to done/).
+    """
+    start = time.time()
+    done = spool+'/done/'+job+'.json'
+    while not os.path.exists(done):
+        for r in os.listdir(spool+'/running'):
+            worker, name = r.split('__', 1)
+            if name == job+'.json' and not alive(worker):
+                abandon(spool, spool+'/running/'+r, worker)
+        if os.path.exists(done):
+            break
+        if timeout is not None and time.time()-start > timeout:
+            try:
+                os.remove(spool+'/queue/'+job+'.json')
+            except OSError: # already claimed
+                pass
+            return None
+        time.sleep(POLL_INTERVAL)
+    f = open(done, 'r')
+    status = json.load(f)
+    f.close()
+    os.remove(done)
+    return status
+
+def start(spool, workers=1, home='~/iraf'):
+    """
+    Input: the spool directory, the number of workers to start (optional;
+    default is 1) and the directory containing the login.cl to use
+    (optional; default is ~/iraf)
+    Output: a list of the processes of the workers
+    Starts workers in the background, in the iraf27 conda environment. They
+    keep running after this process exits, until stop() is called.
+    """
+    spool = os.path.abspath(spool)
+    spool_directories(spool)
+    if os.path.exists(spool+'/stop'):
+        os.remove(spool+'/stop')
+    script = os.path.abspath(__file__).replace('.pyc', '.py')
+    processes = []
+    for n in range(workers):
+        processes.append(subprocess.Popen(
+                "bash -c 'source activate iraf27 && python2 "+script+" "+
+                spool+"'", shell=True, cwd=os.path.expanduser(home)))
+    return processes
+
+def stop(spool):
+    """
+    Input: the spool directory
+    Output: None
+    Asks the workers of the spool directory to exit once their current job
+    is done.
+    """
+    f = open(spool+'/stop', 'w')
+    f.close()
+
+def claim(spool, worker):
+    """
+    Input: the spool directory and the name of the worker
+    Output: the path to the claimed job in running/, or None if the queue is
+    empty
+    Jobs are taken in the order in which they were submitted.
+    """
+    jobs = sorted([j for j in os.listdir(spool+'/queue') if
+                   j.endswith('.json')],
+                  key=lambda j: os.path.getmtime(spool+'/queue/'+j)
+                  if os.path.exists(spool+'/queue/'+j) else 0)
+    for j in jobs:
+        running = spool+'/running/'+worker+'__'+j
+        try:
+            os.rename(spool+'/queue/'+j, running)
+            return running
+        except OSError: # claimed by another worker
+            continue
+    return None
+
+def serve(spool, once=False):
+    """
+    Input: the spool directory, and whether to exit when the queue is empty
+    (optional; default False)
+    Output: None
+    Loads IRAF, then runs the jobs of the spool directory until the file
+    <spool>/stop appears.
+    """
+    import datared # loads pyraf and ccdred, once
+    from pyraf import iraf
+
+    spool = os.path.abspath(spool)
+    spool_directories(spool)
+    worker = socket.gethostname()+'_'+str(os.getpid())
+    home = os.getcwd()
+    print("IRAF worker "+worker+" serving "+spool)
+    while not os.path.exists(spool+'/stop'):
+        running = claim(spool, worker)
+        if running is None:
+            if once:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        f = open(running, 'r')
+        record = json.load(f)
+        f.close()
+        status = dict(record)
+        status['worker'] = worker
+        start = time.time()
+        try:
+            # this is the worker's own process: changing directory here does
+            # not affect the submitting process
+            os.chdir(record['workdir'])
+            iraf.chdir(record['workdir'])
+            results_dir = record.get('results_dir') or (
+                    datared.RESULTS_DIRECTORY)
+            datared.datared(record['results_file'], record.get('night'),
+                            results_dir, record.get('zerocor', False))
+            status['status'] = 'done'
+        except Exception:
+            status['status'] = 'failed'
+            status['error'] = traceback.format_exc()
+            print(status['error'])
+        finally:
+            os.chdir(home)
+            iraf.chdir(home)
+            iraf.flpr() # forget the images of this job
+        status['elapsed'] = time.time()-start
+        write_status(spool, os.path.basename(running).split('__', 1)[1],
+                     status)
+        os.remove(running)
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -0,0 +1,170 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@manifest.py
+
+A persistent index (SQLite database) of the .fits files in PESTO data
+directories. For each file, the manifest records its path, size and
+modification time together with the header keywords used throughout the
+pipeline (FILTRE, IMAGETYP, OBJECT, DATE, EXPOSURE, NAXIS1/2, ...) and the
+index of the header in which they are found.
+
+The manifest is built once, reading the headers in parallel, and is refreshed
+incrementally: only files which are new or whose size or modification time
+changed are read again. raw_PESTO_data and the functions of PESTO_utils.py
+query the manifest instead of opening every file.
+"""
+import os
+import sqlite3
+from multiprocessing import Pool
+from astropy.io import fits
+
+# columns of the manifest, in order
+COLUMNS = ['path', 'location', 'filename', 'size', 'mtime', 'hdr_ind',
+           'filtre', 'imagetyp', 'object', 'date', 'exposure', 'naxis',
+           'naxis1', 'naxis2', 'nextend', 'ra', 'dec']
+
+# header keywords stored in the manifest, and the columns they go in
+KEYWORDS = [('FILTRE','filtre'), ('IMAGETYP','imagetyp'), ('OBJECT','object'),
+            ('DATE','date'), ('EXPOSURE','exposure'), ('NAXIS','naxis'),
+            ('NAXIS1','naxis1'), ('NAXIS2','naxis2'), ('RA','ra'),
+            ('DEC','dec')]
+
+
+def read_entry(args):
+    """
+    Input: a tuple (path, location, filename, size, mtime) describing a file
+    Output: the row of the manifest for this file (see COLUMNS)
+    If the file cannot be read, the header columns are left empty (None).
+    """
+    path, location, filename, size, mtime = args
+    row = dict([(c, None) for c in COLUMNS])
+    row.update({'path':path, 'location':location, 'filename':filename,
+                'size':size, 'mtime':mtime})
+    try:
+        hdul = fits.open(path)
+        # unextended files have FILTRE in their 0th header
+        hdr_ind = 0
+        if not 'FILTRE' in hdul[0].header and len(hdul) > 1:
+            hdr_ind = 1
+        header = hdul[hdr_ind].header
+        row['hdr_ind'] = hdr_ind
+        row['nextend'] = hdul[0].header.get('NEXTEND')
+        for key, column in KEYWORDS:
+            value = header.get(key)
+            if value is not None and not isinstance(value, (int, float)):
+                value = str(value)
+            row[column] = value
+        hdul.close()
+    except Exception as e:
+        print("Could not read the header of "+path+": "+str(e))
+    return tuple([row[c] for c in COLUMNS])
+
+def _location(l):
+    """
+    Normalizes the path of a data directory.
+    """
+    return os.path.normpath(os.path.abspath(l))
+
+class header_manifest:
+    """
+    Input:
+    db_path: the path to the SQLite database holding the manifest (created if
+             it does not exist)
+    processes: the number of processes used to read headers (optional;
+               default is the number of CPUs)
+
+    Output: header_manifest object
+    """
+    def __init__(self, db_path, processes=None):
+        self.db_path = db_path
+        self.processes = processes
+        self.db = sqlite3.connect(db_path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        types = {'size':'INTEGER', 'mtime':'REAL', 'hdr_ind':'INTEGER',
+                 'exposure':'REAL', 'naxis':'INTEGER', 'naxis1':'INTEGER',
+                 'naxis2':'INTEGER', 'nextend':'INTEGER'}
+        columns = [c+' '+types.get(c, 'TEXT') for c in COLUMNS]
+        columns[0] += ' PRIMARY KEY'
+        self.db.execute('CREATE TABLE IF NOT EXISTS frames ('+
+                        ', '.join(columns)+')')
+        self.db.execute('CREATE INDEX IF NOT EXISTS frames_location '+
+                        'ON frames (location, filename)')
+        self.db.commit()
+
+    def refresh(self, locations):
+        """
+        Input: a list of data directories
+        Output: the number of files whose headers were (re)read
+        Brings the manifest up to date with the contents of the directories:
+        files which are new or whose size or modification time changed are
+        read (in parallel), and files which no longer exist are forgotten.
+        """
+        todo = []
+        for l in locations:
+            loc = _location(l)
+            known = dict([(r['path'], (r['size'], r['mtime'])) for r in
+                          self.db.execute('SELECT path, size, mtime FROM '+
+                                          'frames WHERE location=?', (loc,))])
+            present = set()
+            for entry in os.scandir(loc):
+                if not '.fits' in entry.name or not entry.is_file():
+                    continue
+                st = entry.stat()
+                path = loc+'/'+entry.name
+                present.add(path)
+                if known.get(path) != (st.st_size, st.st_mtime):
+                    todo.append((path, loc, entry.name, st.st_size,
+                                 st.st_mtime))
+            gone = [(p,) for p in known if not p in present]
+            self.db.executemany('DELETE FROM frames WHERE path=?', gone)
+
+        if len(todo) > 0:
+            if len(todo) > 100 and self.processes != 1:
+                pool = Pool(self.processes)
+                rows = pool.map(read_entry, todo, chunksize=256)
+                pool.close()
+                pool.join()
+            else:
+                rows = [read_entry(t) for t in todo]
+            self.db.executemany('INSERT OR REPLACE INTO frames VALUES ('+
+                                ', '.join(['?']*len(COLUMNS))+')', rows)
+        self.db.commit()
+        return len(todo)
+
+    def files(self, location, **conditions):
+        """
+        Input: a data directory, and optionally conditions on the columns of
+        the manifest (e.g. imagetyp='object')
+        Output: a list of rows (sqlite3.Row, accessible by column name) for
+        the files of this directory, sorted by filename
+        """
+        query = 'SELECT * FROM frames WHERE location=?'
+        values = [_location(location)]
+        for column in sorted(conditions):
+            if not column in COLUMNS:
+                raise ValueError("Unknown column: "+column)
+            query += ' AND '+column+'=?'
+            values.append(conditions[column])
+        query += ' ORDER BY filename'
+        return self.db.execute(query, values).fetchall()
+
+    def hdr_index(self, location):
+        """
+        Input: a data directory
+        Output: the index of the header containing FILTRE for the files in
+        this directory (0 for unextended files, 1 for extended files), or None
+        if the directory contains no readable .fits file
+        """
+        row = self.db.execute('SELECT hdr_ind FROM frames WHERE location=? '+
+                              'AND hdr_ind IS NOT NULL ORDER BY filename '+
+                              'LIMIT 1', (_location(location),)).fetchone()
+        if row is None:
+            return None
+        return row['hdr_ind']
+
+    def close(self):
+        """
+        Input: None
+        Output: None
+        """
+        self.db.close()
@@ -0,0 +1,181 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@multiscale.py
+
+Hierarchical stacking: the frames of a night (a framecube.frame_cube) are
+reduced once into base stacks (e.g. of 100 frames), and stacks of any
+multiple of the base size (1000, 3000, ...) are then composed from the base
+products, without reading the frames again.
+
+For each base stack, the following are stored as memory-mapped .npy files:
+the sum of the (corrected) pixel values, the sum of their squared deviations
+from the mean of the base stack, the number of (finite) values of each pixel,
+and the median of the base stack. The mean and standard deviation of a
+larger stack are combined exactly from these; its median is approximated by
+the median of the medians of its base stacks. The exposures and timestamps
+of each base stack are kept in a sidecar table (.txt) in the same way, so
+that the statistics of datared.py can be produced for any stack size.
+
+See examples/hierarchical.py, which builds the base stacks of a night once
+and then reduces and measures stacks of several sizes from them.
+"""
+import warnings
+import numpy as np
+
+# products of each base stack, and their data types
+PRODUCTS = [('sum', np.float64), ('m2', np.float64), ('count', np.int32),
+            ('median', np.float32)]
+
+# columns of the sidecar table
+TABLE_COLUMNS = ['first', 'last', 'n', 'exp_mean', 'exp_m2', 'time_mean',
+                 'time_m2']
+
+
+def _combine_moments(n, means, m2s):
+    """
+    Input: the numbers of values, means and sums of squared deviations of
+    several groups (arrays, one element or image per group)
+    Output: the total number of values, mean and sum of squared deviations
+    of the union of the groups (Chan et al.'s parallel algorithm)
+    """
+    total = np.sum(n, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(n*means, axis=0)/total
+        m2 = np.sum(m2s, axis=0)+np.sum(n*(means-mean)**2, axis=0)
+    return total, mean, m2
+
+def build(cube, path, base=100, flat=None, bias=None, start=0, stop=None):
+    """
+    Input: a framecube.frame_cube, the path (without extension) of the base
+    products to create, the number of frames per base stack (optional;
+    default is 100), a combined flat and a combined bias with which to
+    correct the frames (optional; default is no correction) and the range of
+    frames to use (optional; default is the whole cube)
+    Output: the multiscale_stacks
+    Reads each frame of the cube once. Frames left over after the last full
+    base stack are not used.
+    """
+    if stop is None or stop > len(cube):
+        stop = len(cube)
+    nbase = (stop-start)//base
+    if nbase < 1:
+        raise ValueError("Fewer than "+str(base)+" frames between frames "+
+                         str(start)+" and "+str(stop)+"; no base stack can "
+                         "be built")
+    shape = (nbase,)+cube.data.shape[1:]
+    products = dict([(p, np.lib.format.open_memmap(path+'_'+p+'.npy',
+                                                   mode='w+', dtype=dtype,
+                                                   shape=shape))
+                     for p, dtype in PRODUCTS])
+    flat_mean = None if flat is None else np.mean(flat)
+
+    f = open(path+'.txt', 'w')
+    f.write('# '+'\t'.join(TABLE_COLUMNS)+'\n')
+    for k in range(nbase):
+        first = start+k*base
+        data = cube.corrected(first, first+base, flat, bias, flat_mean)
+        count = np.sum(np.isfinite(data), axis=0)
+        mean = np.nanmean(data, axis=0)
+        products['sum'][k] = np.nansum(data, axis=0)
+        products['m2'][k] = np.nansum((data-mean)**2, axis=0)
+        products['count'][k] = count
+        products['median'][k] = np.nanmedian(data, axis=0)
+        exp = cube.exposures[first:first+base]
+        time = cube.times[first:first+base]
+        f.write('\t'.join([str(first), str(first+base), str(base),
+                           repr(float(np.mean(exp))),
+                           repr(float(np.sum((exp-np.mean(exp))**2))),
+                           repr(float(np.mean(time))),
+                           repr(float(np.sum((time-np.mean(time))**2)))])+
+                '\n')
+    f.close()
+    for p in products:
+        products[p].flush()
+    del products
+    print("Reduced "+str(nbase)+" base stacks of "+str(base)+" frames into "+
+          path)
+    return multiscale_stacks(path)
+
+class multiscale_stacks:
+    """
+    Input:
+    path: the path (without extension) of base products written by build()
+
+    Output: multiscale_stacks object
+    """
+    def __init__(self, path):
+        self.path = path
+        with warnings.catch_warnings(): # an empty table is reported below
+            warnings.simplefilter('ignore', UserWarning)
+            table = np.loadtxt(path+'.txt', ndmin=2)
+        if len(table) == 0:
+            raise ValueError("No base stacks in "+path+".txt")
+        for p, dtype in PRODUCTS:
+            setattr(self, p, np.load(path+'_'+p+'.npy', mmap_mode='r'))
+        self.first = table[:,0].astype(int)
+        self.last = table[:,1].astype(int)
+        self.n = table[:,2]
+        self.exp_mean = table[:,3]
+        self.exp_m2 = table[:,4]
+        self.time_mean = table[:,5]
+        self.time_m2 = table[:,6]
+        self.base = int(self.n[0])
+
+    def __len__(self):
+        return len(self.n)
+
+    def compose(self, k0, k1):
+        """
+        Input: the first and last (excluded) base stacks to combine
+        Output: the mean, standard deviation and (approximate) median images
+        of all the frames of these base stacks
+        """
+        count = np.asarray(self.count[k0:k1], dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.asarray(self.sum[k0:k1])/count
+        means[count == 0] = 0.0
+        n, mean, m2 = _combine_moments(count, means,
+                                       np.asarray(self.m2[k0:k1]))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(m2/n)
+        median = np.nanmedian(np.asarray(self.median[k0:k1],
+                                         dtype=np.float64), axis=0)
+        return mean, std, median
+
+    def statistics(self, k0, k1):
+        """
+        Input: the first and last (excluded) base stacks to combine
+        Output: the same statistics as reduction.stack_statistics() for all
+        the frames of these base stacks
+        """
+        n = self.n[k0:k1]
+        total, exp, exp_m2 = _combine_moments(n, self.exp_mean[k0:k1],
+                                              self.exp_m2[k0:k1])
+        total, time, time_m2 = _combine_moments(n, self.time_mean[k0:k1],
+                                                self.time_m2[k0:k1])
+        estd = np.sqrt(exp_m2/total)
+        if estd < 1e-5:
+            estd = 0.0
+        return int(total), exp, estd, time, np.sqrt(time_m2/total)
+
+    def stacks(self, size, stride=None, combine='average'):
+        """
+        Input: the number of frames per stack (a multiple of the base size),
+        the number of frames between the starts of two consecutive stacks
+        (optional; default is size, i.e. disjoint stacks; also a multiple of
+        the base size) and the image to produce, 'average', 'median'
+        (approximate) or 'std' (optional; default is 'average')
+        Output: a generator of (first frame, last frame (excluded), image,
+        statistics), one for each stack
+        """
+        if stride is None:
+            stride = size
+        if size % self.base != 0 or stride % self.base != 0:
+            raise ValueError("The stack size and stride must be multiples of "
+                             "the base size ("+str(self.base)+")")
+        m = size//self.base
+        for k0 in range(0, len(self)-m+1, stride//self.base):
+            mean, std, median = self.compose(k0, k0+m)
+            image = {'average':mean, 'median':median, 'std':std}[combine]
+            yield (self.first[k0], self.last[k0+m-1], image,
+                   self.statistics(k0, k0+m))
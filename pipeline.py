@@ -0,0 +1,535 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@pipeline.py
+
+A batch runner for whole nights of PESTO data, driven by a JSON config file
+rather than a script per date (see examples/maxi_config.json).
+
+The config describes each night (where its frames and calibration files
+are, which frames to use, its WCS solution, its results file) and the
+settings shared by all nights (target directory, stack size, RA/Dec bounds
+of the source, reduction backend). Each night is split into stack jobs,
+which are run in parallel on a pool of processes sized to the CPUs and the
+memory available. Each job reduces its stack in its own directory,
+<target>/<night>/<first frame>, and writes its own results file; the rows
+are then appended to the results file of the night in the order of the
+stacks, so that parallel jobs never interleave their rows.
+
+Progress is recorded in a journal (an SQLite database, by default
+<target>/journal.sqlite) holding the frame range, status and rows of each
+stack. Running the same config again resumes the run: completed stacks are
+skipped and only incomplete or failed ones are redone. The rows of each
+stack are appended to the results files once it is recorded as done. On
+resuming, each results file is first rewritten atomically from the journal
+(whatever it held before the first run, followed by the rows of the
+completed stacks), so a crash can never leave a partial row or cause a row
+to be written twice.
+
+If the config gives a 'store' (the path to an SQLite database, see
+resultstore.py), each job also writes the rows of its stack to the store as
+one record per band, in a single transaction, under the name of the results
+file of its night.
+
+If the config gives a 'catalogue_cache' directory (see catalogue.py), the
+reference catalogue is read from tiles cached there instead of querying
+Vizier for every stack; with 'offline' set, only tiles already cached are
+used.
+
+Each pool process keeps a model of the field of each night (see
+fieldmodel.py), so that the catalogue is queried and projected once per
+night rather than for every stack; set 'field_model' to false in the config
+to query and match the catalogue for every stack instead.
+
+With 'mode' set to 'forced', the photometry measures the given 'positions'
+(or the centre of the RA/Dec bounds) in apertures instead of detecting the
+sources (see aperturephotometry.forced_photometry()). Their magnitudes are
+calibrated against the reference catalogue, unless a 'zero_point' is given.
+
+Other 'targets' (e.g. comparison stars), each [name, [RA min, RA max],
+[Dec min, Dec max]], are measured in the same pass as the source, and each
+has its own results file (e.g. results_190312_source1.txt), also kept in the
+journal and the store.
+
+The timestamps of each stack are measured from the date of its earliest
+frame, as in results files written before this runner. With
+'observing_night' set, they are measured from the 'date' of the night (or,
+if it has none, the observing night of the earliest frame), so that frames
+taken after midnight are above 86400 s (see headerstats.py); results files
+written with and without it must not be mixed, as lightcurve.py assumes
+the default.
+
+Once a night is done, associate_night() links the sources detected in all
+its stacks into per-star time series (see association.py).
+
+Run with
+    python3 pipeline.py <config file> [<night> ...]
+"""
+import os
+import re
+import sys
+import glob
+import json
+import bisect
+import time
+import shutil
+import sqlite3
+from subprocess import run
+from multiprocessing import Pool
+
+import PESTO_lib
+import reduction
+import headerstats
+import resultstore
+import aperturephotometry
+
+# settings used when absent from the config
+DEFAULTS = {'stack':1000, 'thresh_factor':2.0, 'backend':'numpy',
+            'ram_budget':None, 'library':None, 'spool':None,
+            'results_dir':reduction.RESULTS_DIRECTORY, 'processes':None,
+            'job_memory':None, 'keep_working_directories':False,
+            'journal':None, 'store':None, 'catalogue_cache':None,
+            'offline':False, 'field_model':True, 'mode':'segmentation',
+            'positions':None, 'apertures':[6.0, 10.0, 15.0], 'targets':[],
+            'zero_point':None, 'observing_night':False}
+
+# field models of the nights, by night and then filter (kept by each process
+# across the jobs it runs)
+FIELDS = {}
+
+# memory assumed per job when neither job_memory nor ram_budget is given
+JOB_MEMORY = 4e9
+
+
+def load_config(path):
+    """
+    Input: the path to a JSON config file
+    Output: the config, as a dictionary, with the defaults filled in
+    """
+    f = open(path, 'r')
+    config = json.load(f)
+    f.close()
+    for key in DEFAULTS:
+        config.setdefault(key, DEFAULTS[key])
+    return config
+
+def frame_number(filename):
+    """
+    Input: the name of a raw frame, e.g. 190312_0000008241.fits.gz
+    Output: its number (the last digits before .fits), or None
+    """
+    match = re.search(r'(\d+)\.fits', os.path.basename(filename))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def expand(config, nights=None):
+    """
+    Input: a config, and the nights to process (optional; default is all
+    nights of the config)
+    Output: the list of stack jobs, in order, each a dictionary holding the
+    settings of its night and the paths to its frames
+    Each night is split into stacks of config['stack'] consecutive frame
+    numbers, starting at frame number 'first' (optional; default is the
+    first frame of the night) and ending at 'last' (optional; default is the
+    last frame of the night): the stacks hold frames first to first+stack-1,
+    first+stack to first+2*stack-1, and so on, whichever of them exist. A
+    last stack which would go beyond 'last' is dropped, as in the driver
+    scripts. With 'first' a multiple of the stack size, stacks are aligned
+    to multiples of it, as were those of the original driver scripts (whose
+    starting point was the frame number divided by the stack size).
+    """
+    jobs = []
+    for night in sorted(config['nights']):
+        if nights and not night in nights:
+            continue
+        settings = dict(config)
+        del settings['nights']
+        settings.update(config['nights'][night])
+        frames = [(frame_number(f), f) for f in glob.glob(settings['frames'])]
+        frames = sorted([(n, f) for n, f in frames if n is not None])
+        if len(frames) == 0:
+            continue
+        first = settings.get('first', frames[0][0])
+        last = min(settings.get('last', frames[-1][0]), frames[-1][0])
+        stack = settings['stack']
+        numbers = [n for n, f in frames]
+        for start in range(first, last-stack+2, stack):
+            files = [f for n, f in frames[bisect.bisect_left(numbers, start):
+                                          bisect.bisect_left(numbers,
+                                                             start+stack)]]
+            if len(files) == 0: # a gap in the night
+                continue
+            job = dict(settings)
+            job['night'] = night
+            job['start'] = start
+            job['end'] = start+stack-1
+            job['files'] = files
+            job['directory'] = (settings['target']+'/'+night+'/'+str(start))
+            jobs.append(job)
+    return jobs
+
+def pool_size(config):
+    """
+    Input: a config
+    Output: the number of jobs to run at once: config['processes'] if given,
+    otherwise as many as there are CPUs, and no more than fit in the
+    available memory
+    """
+    if config['processes'] is not None:
+        return config['processes']
+    cpus = os.cpu_count() or 1
+    memory = config['job_memory']
+    if memory is None:
+        memory = 2*config['ram_budget'] if config['ram_budget'] else (
+                JOB_MEMORY)
+    try:
+        available = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError): # not available
+        return cpus
+    return int(max(1, min(cpus, available//memory)))
+
+def stage_frames(files, directory, decompress):
+    """
+    Input: the paths to the frames of a stack, the directory in which to
+    place them, and whether to decompress them (needed by iraf)
+    Output: None
+    Without decompression, the frames are only linked, not copied.
+    """
+    os.makedirs(directory, exist_ok=True)
+    gz = []
+    for f in files:
+        dest = directory+'/'+os.path.basename(f)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if decompress:
+            shutil.copyfile(f, dest)
+            if dest.endswith('.gz'):
+                gz.append(dest)
+        else:
+            os.symlink(os.path.abspath(f), dest)
+    for i in range(0, len(gz), 500):
+        run(['gzip', '-d', '-f']+gz[i:i+500])
+
+def streams(job):
+    """
+    Input: a stack job (see expand())
+    Output: a list of (results file of the night, results file of the job),
+    for the source and then for each of the other targets
+    """
+    results = job['directory']+'/results.txt'
+    night = os.path.join(job['results_dir'], job['results_file'])
+    return [(night, results)]+[
+            (aperturephotometry.target_results_path(night, t[0]),
+             aperturephotometry.target_results_path(results, t[0]))
+            for t in job['targets']]
+
+def read_stats(path, bands):
+    """
+    Input: the path to the statistics written by the reduction of a stack, 
+    and the bands it reduced, in order
+    Output: a dictionary of the statistics of the stack in each band, as 
+    written by the reduction (ending with a tab), by band
+    """
+    f = open(path, 'r')
+    fields = f.read().split('\t')
+    f.close()
+    n = len(resultstore.STATS)
+    return dict([(b, '\t'.join(fields[n*k:n*(k+1)])+'\t') for k, b in 
+                 enumerate(bands)])
+
+def timestamp_night(job):
+    """
+    Input: a job
+    Output: the night from which its timestamps are measured (None for the
+    date of its earliest frame, unless 'observing_night' is set)
+    """
+    if not job.get('observing_night'):
+        return None
+    return job.get('date') or headerstats.OBSERVING
+
+def run_job(job, staged=None):
+    """
+    Input: a stack job (see expand()), and a directory into which its frames
+    were already copied (optional; default is to stage them in the directory
+    of the job; see prefetched())
+    Output: a dictionary of the rows written to the results files of the job 
+    (by results file of the night; see streams()), or None if the job failed
+    Reduces the stack, merges the WCS solution and performs the photometry,
+    all within the directory of the job. The statistics of the stack are 
+    written with the photometry of each band, rather than by the reduction, 
+    so that each row is written at once.
+    """
+    d = job['directory']
+    results = d+'/results.txt'
+    try:
+        for path in [d+'/stats.txt']+[s[1] for s in streams(job)]:
+            if os.path.exists(path): # an earlier, unfinished attempt
+                os.remove(path)
+        decompress = job['backend'] != 'numpy'
+        objects = staged or d+'/objects'
+        if staged is None:
+            stage_frames(job['files'], objects, decompress)
+        data = PESTO_lib.raw_PESTO_data([objects, job['calibration']],
+                                        ['object', 'calibration'], 'work', d)
+        data.produce_lists(readonly=True, processes=1)
+        data.make_working_directory(link='symlink', fix_headers=decompress)
+        library = None
+        if job['library'] is not None:
+            import calibration
+            library = calibration.calibration_library(job['library'])
+        data.pyraf_reduction(d+'/stats.txt', job['backend'], job['ram_budget'],
+                             library, night=timestamp_night(job), workers=1,
+                             spool=job['spool'])
+        if os.path.exists(d+'/reduced'):
+            shutil.rmtree(d+'/reduced')
+        reduced_data = data.extract_reduced_images(d, 'reduced')
+        bands = [b for b in ['r','g','i','z'] if 
+                 os.path.exists(d+'/reduced/object_'+b+'_reduced.fits')]
+        stats = read_stats(d+'/stats.txt', bands)
+        if job.get('wcs') is not None: # new WCS technique
+            reduced_data.WCS_merge(job['wcs'], job.get('delta_x', 0),
+                                   job.get('delta_y', 0))
+        else: # old WCS technique
+            reduced_data.WCS_preparation(job.get('wcs_angle', 0))
+        reduced_data.photometry(job['RA'], job['DEC'], job['thresh_factor'],
+                                results, output_dir=d,
+                                cache_dir=job['catalogue_cache'],
+                                offline=job['offline'],
+                                fields=FIELDS.setdefault(job['night'], {})
+                                if job['field_model'] else None,
+                                mode=job['mode'], positions=job['positions'],
+                                apertures=job['apertures'],
+                                targets=job['targets'], stats=stats,
+                                zero_point=job['zero_point'])
+        if not job['keep_working_directories']:
+            if staged is None: # the prefetcher empties its own buffers
+                shutil.rmtree(objects)
+            data.delete_working_directory()
+        rows = {}
+        for night_path, path in streams(job):
+            rows[night_path] = ''
+            if os.path.exists(path): # no photometry was written
+                f = open(path, 'r')
+                rows[night_path] = f.read()
+                f.close()
+        if job['store'] is not None:
+            store = resultstore.results_store(job['store'])
+            for night_path in rows:
+                store.record(os.path.basename(night_path), rows[night_path],
+                             job['night'], job['start'], d)
+            store.close()
+        return rows
+    except Exception as e:
+        print("Stack "+str(job['start'])+" of night "+job['night']+
+              " failed: "+str(e))
+        return None
+
+class job_journal:
+    """
+    Input:
+    db_path: the path to the SQLite database holding the journal (created if 
+             it does not exist)
+
+    Output: job_journal object
+    """
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (night TEXT, '+
+                        'start INTEGER, end INTEGER, directory TEXT, '+
+                        'results TEXT, status TEXT, rows TEXT, '+
+                        'updated REAL, PRIMARY KEY (night, start))')
+        # size of each results file before its first stack was written
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (path TEXT '+
+                        'PRIMARY KEY, base INTEGER)')
+        self.db.commit()
+
+    def status(self, job):
+        """
+        Input: a stack job
+        Output: its status ('running', 'done' or 'failed'), or None if it 
+        was never started
+        """
+        row = self.db.execute('SELECT status FROM jobs WHERE night=? AND '+
+                              'start=?', (job['night'], job['start'])
+                              ).fetchone()
+        return None if row is None else row[0]
+
+    def mark(self, job, status, rows=None):
+        """
+        Input: a stack job, its new status and, once done, its rows (by 
+        results file; see run_job())
+        Output: None
+        """
+        paths = [s[0] for s in streams(job)]
+        for path in paths:
+            if self.db.execute('SELECT base FROM results WHERE path=?', 
+                               (path,)).fetchone() is None:
+                base = os.path.getsize(path) if os.path.exists(path) else 0
+                self.db.execute('INSERT INTO results VALUES (?, ?)', 
+                                (path, base))
+        if rows is not None:
+            rows = json.dumps(rows)
+        self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, '+
+                        '?, ?, ?)', (job['night'], job['start'], job['end'],
+                                     job['directory'], paths[0], status, 
+                                     rows, time.time()))
+        self.db.commit()
+
+    def rewrite_results(self, path):
+        """
+        Input: the path to a results file
+        Output: None
+        Rewrites the results file as its original contents followed by the 
+        rows of all completed stacks, in order. The new file is written 
+        under a temporary name and then moved into place.
+        """
+        base = self.db.execute('SELECT base FROM results WHERE path=?', 
+                               (path,)).fetchone()
+        if base is None:
+            return
+        prefix = b''
+        if os.path.exists(path):
+            f = open(path, 'rb') # the base is a size in bytes
+            prefix = f.read(base[0])
+            f.close()
+        rows = [json.loads(r[0]) for r in 
+                self.db.execute("SELECT rows FROM jobs WHERE status='done' "+
+                                "ORDER BY night, start")]
+        temp = path+'.'+str(os.getpid())+'.tmp'
+        f = open(temp, 'wb')
+        f.write(prefix+''.join([r[path] for r in rows if path in r]
+                               ).encode('utf-8'))
+        f.close()
+        os.replace(temp, path)
+
+    def last_done(self, path):
+        """
+        Input: the path to a results file
+        Output: the (night, first frame) of the last completed stack with 
+        rows in this results file, or None
+        """
+        last = None
+        for night, start, rows in self.db.execute(
+                "SELECT night, start, rows FROM jobs WHERE status='done' AND "+
+                "rows LIKE ? ORDER BY night DESC, start DESC", 
+                ('%'+json.dumps(path)+'%',)):
+            if path in json.loads(rows):
+                last = (night, start)
+                break
+        return last
+
+    def close(self):
+        """
+        Input: None
+        Output: None
+        """
+        self.db.close()
+
+def prefetched(jobs, buffers):
+    """
+    Input: stack jobs, and two buffer directories
+    Output: a generator of the results of the jobs (see run_job()), in order
+    The frames of each job are copied (and decompressed) into one buffer
+    while the job before it is run from the other (see
+    PESTO_lib.stack_prefetcher).
+    """
+    prefetcher = PESTO_lib.stack_prefetcher([j['files'] for j in jobs],
+                                            buffers)
+    for job, buffer in zip(jobs, prefetcher):
+        yield run_job(job, buffer)
+
+def run_pipeline(config, nights=None):
+    """
+    Input: a config (or the path to a config file), and the nights to
+    process (optional; default is all nights of the config)
+    Output: the number of stacks which failed
+    Runs all the stack jobs which are not yet done (see job_journal) on a 
+    pool of processes, appending the rows of each job to the results file 
+    of its night as it completes. When resuming, the results files are first
+    rewritten from the journal; a stack which completes before an earlier 
+    completed one (e.g. a failed stack redone) has its results files 
+    rewritten at the end instead, so that the rows stay in stack order.
+    With a single process and the IRAF backends, which need the frames
+    copied and decompressed, the frames of the next stack are staged while
+    the current one is reduced (see prefetched()); with several processes,
+    the staging of a stack already overlaps the reduction of the others.
+    """
+    if not isinstance(config, dict):
+        config = load_config(config)
+    os.makedirs(config['target'], exist_ok=True)
+    journal = job_journal(config['journal'] or 
+                          config['target']+'/journal.sqlite')
+    jobs = expand(config, nights)
+    # resuming: drop whatever a crash may have left after the rows of the 
+    # completed stacks
+    last = {}
+    for path in set([s[0] for j in jobs for s in streams(j)]):
+        journal.rewrite_results(path)
+        last[path] = journal.last_done(path)
+    jobs = [j for j in jobs if journal.status(j) != 'done']
+    processes = pool_size(config)
+    print("Running "+str(len(jobs))+" stacks on "+str(processes)+
+          " processes")
+    for job in jobs:
+        journal.mark(job, 'running')
+    failed = 0
+    unordered = set()
+    pool = None
+    if processes == 1 and all([j['backend'] != 'numpy' for j in jobs]):
+        results = prefetched(jobs, [config['target']+'/buffer_A', 
+                                    config['target']+'/buffer_B'])
+    else:
+        pool = Pool(processes)
+        # imap returns the results in the order of the jobs
+        results = pool.imap(run_job, jobs)
+    for job, rows in zip(jobs, results):
+        if rows is None:
+            failed += 1
+            journal.mark(job, 'failed')
+            continue
+        journal.mark(job, 'done', rows)
+        for path in rows:
+            if last[path] is not None and last[path] > (job['night'], 
+                                                        job['start']):
+                unordered.add(path)
+                continue
+            f = open(path, 'a')
+            f.write(rows[path])
+            f.close()
+            last[path] = (job['night'], job['start'])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for path in unordered:
+        journal.rewrite_results(path)
+    journal.close()
+    return failed
+
+def associate_night(config, night, band='r', radius=2.0):
+    """
+    Input: a config (or the path to a config file), a night, the band 
+    (optional; default 'r') and the association radius in arcsec (optional; 
+    default 2.0)
+    Output: the path of the star x stack matrix written for the night
+    Links the sources detected in the stacks of the night which are done 
+    into per-star time series (see association.py), written to 
+    <target>/<night>/field_<band>.npz.
+    """
+    import association
+    if not isinstance(config, dict):
+        config = load_config(config)
+    journal = job_journal(config['journal'] or 
+                          config['target']+'/journal.sqlite')
+    jobs = [j for j in expand(config, [night]) if 
+            journal.status(j) == 'done']
+    journal.close()
+    a = association.from_directories([j['directory'] for j in jobs],
+                                     'object_'+band+'_reduced', radius)
+    path = config['target']+'/'+night+'/field_'+band+'.npz'
+    a.save(path)
+    print("Associated the sources of "+str(len(jobs))+" stacks into "+
+          str(len(a))+" stars: "+path)
+    return path
+
+if __name__ == '__main__':
+    run_pipeline(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,627 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@reduction.py
+
+A native (Python 3 / NumPy) replacement for the IRAF reduction in datared.py.
+Combines the domeflats of each band, applies the combined flat to each object
+image, and then stacks the corrected object images, all in memory and within
+the calling process.
+
+The combination follows the default parameters of IRAF's ccdred.flatcombine
+(mode scaling, median combine, crreject rejection), ccdproc (flat normalized by
+its mean, low flat values replaced by 1) and imcombine (average, no rejection)
+so that the reduced images match those produced by datared.py.
+
+Compressed (.fits.gz) frames are read directly, decompressing them in memory
+with several threads, so that they need not be gunzipped on disk first.
+"""
+import os
+import io
+import gzip
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, current_process
+import numpy as np
+from astropy.io import fits
+
+import headerstats
+
+# directory to which datared.py appends the stack statistics
+RESULTS_DIRECTORY = '/data/irulan/omm_transients'
+
+# parameters of IRAF's mode estimator (imcombine, icstat.x)
+MODE_NMIN = 10      # below this many pixels, use the median
+MODE_ZRANGE = 0.7   # fraction of the pixels about the median to use
+MODE_ZSTEP = 0.01   # step size for the search for the mode
+MODE_ZBIN = 0.1     # bin size for the mode
+MODE_NMAX = 100000  # maximum number of pixels sampled
+
+# for out-of-core (tiled) stacking: number of float64 copies of a tile which
+# exist at once while combining (tile, scaled copy, masks, median workspace)
+TILE_OVERHEAD = 4
+
+# size of the compressed chunks read at once from a .fits.gz frame, in bytes
+GZIP_CHUNK = 65536
+
+# data types of the pixels of a .fits file, by BITPIX
+BITPIX_DTYPES = {8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+# keywords which describe the structure of the input file and must not be
+# copied into the header of a new image
+STRUCTURE_KEYWORDS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1',
+                      'NAXIS2', 'NAXIS3', 'EXTEND', 'NEXTEND', 'PCOUNT',
+                      'GCOUNT', 'BZERO', 'BSCALE']
+
+
+def resolve(filename):
+    """
+    Input: the path to a .fits file
+    Output: the path itself if it exists, or the path to its compressed
+    version (.fits.gz or tile-compressed .fits.fz) if only that exists
+    The lists of raw_PESTO_data always name the decompressed files.
+    """
+    if not os.path.exists(filename):
+        for ext in ['.gz', '.fz']:
+            if os.path.exists(filename+ext):
+                return filename+ext
+    return filename
+
+def open_frame(filename):
+    """
+    Input: the path to a .fits or .fits.gz file
+    Output: the opened HDUList
+    Compressed files are decompressed into a memory buffer, without writing
+    anything to disk. (The decompression releases the GIL, so several frames
+    can be decompressed at once by threads.)
+    """
+    if filename.endswith('.gz'):
+        f = open(filename, 'rb')
+        raw = gzip.decompress(f.read())
+        f.close()
+        return fits.open(io.BytesIO(raw))
+    return fits.open(filename)
+
+def load_frame(filename):
+    """
+    Input: the path to a .fits or .fits.gz file
+    Output: the image data (as float64) and the header of the image
+    Reads the first HDU which contains image data, so that both unextended and
+    extended PESTO files can be read.
+    """
+    hdul = open_frame(filename)
+    for hdu in hdul:
+        if hdu.data is not None:
+            data = np.asarray(hdu.data, dtype=np.float64)
+            header = hdu.header.copy()
+            hdul.close()
+            return data, header
+    hdul.close()
+    raise ValueError("No image data found in "+filename)
+
+def load_cube(filenames, threads=None):
+    """
+    Input: a list of paths to .fits (or .fits.gz) files of identical
+    dimensions, and the number of threads used to read them (optional;
+    default is chosen by concurrent.futures)
+    Output: a 3D array (frame, y, x) of the image data and the header of the
+    first frame
+    """
+    data, header = load_frame(filenames[0])
+    cube = np.empty((len(filenames),)+data.shape, dtype=np.float64)
+    cube[0] = data
+    pool = ThreadPoolExecutor(threads)
+    for i, frame in enumerate(pool.map(load_frame, filenames[1:])):
+        cube[i+1] = frame[0]
+    pool.shutdown()
+    return cube, header
+
+class mapped_frame:
+    """
+    Input: the path to a .fits (or .fits.gz) file
+    Output: mapped_frame object
+
+    A frame whose image data is left on disk. Rows of the image are read
+    through a memory map only when requested, so that stacks of thousands of
+    frames can be combined one tile of rows at a time. No file descriptor is
+    kept open between reads. For compressed files, the requested rows are
+    decompressed as a stream, so the full frame is never held in memory; the
+    state of the decompression is kept between reads, so that reading the
+    tiles of a frame in order decompresses it only once. For
+    tile-compressed (.fits.fz) files, only the tiles holding the requested
+    rows are decompressed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        hdul = fits.open(filename)
+        for n in range(len(hdul)):
+            if hdul[n].header.get('NAXIS', 0) >= 2 and (
+                    hdul[n].header.get('NAXIS1', 0) > 0):
+                break
+        else:
+            hdul.close()
+            raise ValueError("No image data found in "+filename)
+        hdr = hdul[n].header
+        self.index = n
+        self.tiled = isinstance(hdul[n], fits.CompImageHDU)
+        if hdr['BITPIX'] not in BITPIX_DTYPES:
+            hdul.close()
+            raise ValueError(filename+" cannot be memory-mapped")
+        self.header = hdr.copy()
+        self.offset = hdul.fileinfo(n)['datLoc']
+        self.dtype = np.dtype(BITPIX_DTYPES[hdr['BITPIX']])
+        self.shape = (hdr['NAXIS2'], hdr['NAXIS1'])
+        self.bscale = hdr.get('BSCALE', 1.0)
+        self.bzero = hdr.get('BZERO', 0.0)
+        self.compressed = filename.endswith('.gz')
+        self.stream = None
+        hdul.close()
+
+    def _decompress(self, start, length):
+        """
+        Reads length bytes from position start of the decompressed file,
+        carrying on from the previous read if start is not before its end.
+        """
+        if self.stream is None or start < self.stream[2]:
+            # decompressor, position in the compressed file, position in the
+            # decompressed file, decompressed bytes not yet returned
+            self.stream = [zlib.decompressobj(16+zlib.MAX_WBITS), 0, 0, b'']
+        d, cpos, pos, pending = self.stream
+        end = start+length
+        parts = []
+        f = open(self.filename, 'rb')
+        f.seek(cpos)
+        while pos < end:
+            if pending:
+                chunk, pending = pending, b''
+            else:
+                raw = f.read(GZIP_CHUNK)
+                if not raw:
+                    break
+                cpos += len(raw)
+                chunk = d.decompress(raw)
+            lo = max(start-pos, 0)
+            hi = min(end-pos, len(chunk))
+            if lo < hi:
+                parts.append(chunk[lo:hi])
+            if hi < len(chunk): # keep the rest for the next read
+                pending = chunk[hi:]
+                pos += hi
+            else:
+                pos += len(chunk)
+        f.close()
+        self.stream = [d, cpos, pos, pending]
+        return b''.join(parts)
+
+    def rows(self, y0, y1):
+        """
+        Input: the first and last (excluded) rows to read
+        Output: the rows of the image, as float64
+        """
+        if self.tiled: # the section is already scaled
+            hdul = fits.open(self.filename)
+            data = np.asarray(hdul[self.index].section[y0:y1], 
+                              dtype=np.float64)
+            hdul.close()
+            return data
+        if self.compressed:
+            row_bytes = self.shape[1]*self.dtype.itemsize
+            raw = self._decompress(self.offset+y0*row_bytes, 
+                                   (y1-y0)*row_bytes)
+            if y1 >= self.shape[0]: # the last tile: free the decompressor
+                self.stream = None
+            data = np.frombuffer(raw, dtype=self.dtype).reshape(
+                    (y1-y0, self.shape[1])).astype(np.float64)
+        else:
+            mm = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                           offset=self.offset, shape=self.shape)
+            data = np.array(mm[y0:y1], dtype=np.float64)
+            del mm
+        if self.bscale != 1.0:
+            data *= self.bscale
+        if self.bzero != 0.0:
+            data += self.bzero
+        return data
+
+def write_image(filename, data, header):
+    """
+    Input: the path of the image to write, its data and a header to copy into
+    it
+    Output: None
+    Writes a single-HDU, 32-bit float image (IRAF's 'real' pixel type),
+    overwriting any existing file.
+    """
+    header = header.copy()
+    for key in STRUCTURE_KEYWORDS:
+        header.remove(key, ignore_missing=True, remove_all=True)
+    hdu = fits.PrimaryHDU(np.asarray(data, dtype=np.float32), header)
+    hdu.writeto(filename, overwrite=True)
+
+###############################################################################
+
+def iraf_mode(data):
+    """
+    Input: an image (or any array)
+    Output: the mode of the pixel values, as estimated by IRAF's imcombine
+    The mode is found by sliding a bin over the central 70% of the sorted
+    pixel values and taking the centre of the most populated bin.
+    """
+    a = np.ravel(data)
+    a = a[np.isfinite(a)]
+    if a.size > MODE_NMAX: # sample the image
+        a = a[::int(np.ceil(a.size/MODE_NMAX))]
+    a = np.sort(a)
+    n = a.size
+    if n < MODE_NMIN:
+        return float(np.median(a))
+
+    i = int(n*(1.0-MODE_ZRANGE)/2.0)
+    j = min(int(n*(1.0+MODE_ZRANGE)/2.0), n-1)
+    z1, z2 = a[i], a[j]
+    if z1 == z2:
+        return float(z1)
+    zstep = MODE_ZSTEP*(z2-z1)
+    zbin = MODE_ZBIN*(z2-z1)
+
+    # lower edges of all bins, and the number of pixels in each bin
+    lows = z1 + zstep*np.arange(int(np.ceil((z2-z1)/zstep))+1)
+    starts = np.searchsorted(a[i:j], lows, side='left')
+    ends = np.searchsorted(a[i:j], lows+zbin, side='left')
+    best = np.argmax(ends-starts)
+    return float(a[i+(starts[best]+ends[best])//2])
+
+def combine_frames(cube, combine='median', reject='none', scales=None,
+                   lsigma=3.0, hsigma=3.0, rdnoise=0.0, gain=1.0, snoise=0.0,
+                   nkeep=1, mclip=True, nlow=1, nhigh=1):
+    """
+    Input: a 3D array (frame, y, x), the type of combining ('median' or
+    'average'), the type of rejection ('none', 'crreject', 'sigclip' or
+    'minmax'), the multiplicative scale of each frame (optional; default is no
+    scaling), and the rejection parameters of IRAF's imcombine (optional;
+    IRAF's defaults)
+    Output: the combined 2D image
+    Combines a stack of frames pixel-by-pixel. Frames are divided by their
+    scale before combining. With 'crreject', only pixels which are hsigma
+    above the median (according to the CCD noise model given by rdnoise, gain
+    and snoise) are rejected; with 'sigclip', pixels which are lsigma below or
+    hsigma above the median/mean are rejected, using the standard deviation of
+    the pixel values. Rejection is iterated until no more pixels are rejected,
+    and at least nkeep pixels are always kept. With 'minmax', the nlow lowest
+    and nhigh highest pixels are rejected.
+    """
+    cube = np.array(cube, dtype=np.float64) # work on a copy
+    if scales is None:
+        scales = np.ones(len(cube))
+    scales = np.asarray(scales, dtype=np.float64).reshape((-1,1,1))
+    cube /= scales
+
+    if reject == 'minmax':
+        if nlow+nhigh < len(cube): # otherwise, nothing would be left
+            cube = np.sort(cube, axis=0)[nlow:len(cube)-nhigh]
+    elif reject != 'none':
+        if reject not in ['crreject','sigclip']:
+            raise ValueError("Unknown rejection: "+str(reject))
+        cube = _reject(cube, reject, scales, lsigma, hsigma, rdnoise, gain,
+                       snoise, nkeep, mclip)
+
+    if combine == 'median':
+        return np.nanmedian(cube, axis=0)
+    elif combine == 'average':
+        return np.nanmean(cube, axis=0)
+    raise ValueError("Unknown combine: "+str(combine))
+
+def _reject(cube, reject, scales, lsigma, hsigma, rdnoise, gain, snoise,
+            nkeep, mclip):
+    """
+    Iteratively replaces rejected pixels of a (scaled) cube by NaN.
+    """
+    # pixels which are not finite from the start are never counted
+    while True:
+        n = np.sum(np.isfinite(cube), axis=0)
+        if mclip:
+            centre = np.nanmedian(cube, axis=0)
+        else:
+            centre = np.nanmean(cube, axis=0)
+
+        if reject == 'crreject':
+            # expected noise in each (unscaled) frame, in ADU
+            counts = np.maximum(centre*scales, 0.0)
+            sigma = np.sqrt((rdnoise/gain)**2 + counts/gain +
+                            (snoise*counts)**2)/scales
+            with np.errstate(invalid='ignore'):
+                bad = (cube-centre) > hsigma*sigma
+        else: # sigclip
+            sigma = np.nanstd(cube, axis=0, ddof=1) if cube.shape[0] > 1 else (
+                    np.zeros(centre.shape))
+            with np.errstate(invalid='ignore'):
+                bad = ((cube-centre) > hsigma*sigma) | (
+                        (centre-cube) > lsigma*sigma)
+
+        # only reject where enough pixels remain
+        bad &= ((n - np.sum(bad, axis=0)) >= nkeep)
+        if not np.any(bad):
+            return cube
+        cube[bad] = np.nan
+
+###############################################################################
+
+def tiled_combine(frames, combine='median', reject='none', scales=None,
+                  flat=None, ram_budget=2e9, zero=None, **kwargs):
+    """
+    Input: a list of paths to .fits files (or of mapped_frame objects) of
+    identical dimensions, or a 3D array (frame, y, x) such as a slice of a
+    memory-mapped framecube.frame_cube, the type of combining and rejection
+    (see combine_frames()), the scale of each frame (optional; default is no
+    scaling), a combined flat with which to correct each frame before
+    combining (optional; default is no correction), the amount of memory in
+    bytes which may be used (optional; default is 2 GB), a combined bias to
+    subtract from each frame before the flat correction (optional; default is
+    no correction), and any other rejection parameters of combine_frames()
+    Output: the combined 2D image
+    Out-of-core equivalent of combine_frames(). The frames are memory-mapped
+    and combined one tile of rows at a time, where the number of rows per
+    tile is chosen such that the tile fits within ram_budget. The result is
+    identical to that of combine_frames() on the full cube.
+    """
+    if isinstance(frames, np.ndarray):
+        ny, nx = frames.shape[1:]
+    else:
+        frames = [f if isinstance(f, mapped_frame) else mapped_frame(f)
+                  for f in frames]
+        ny, nx = frames[0].shape
+    bytes_per_row = len(frames)*nx*8*TILE_OVERHEAD
+    tile_rows = int(max(1, min(ny, ram_budget//bytes_per_row)))
+    if flat is not None:
+        flat_mean = np.mean(flat)
+
+    combined = np.empty((ny, nx), dtype=np.float64)
+    tile = np.empty((len(frames), tile_rows, nx), dtype=np.float64)
+    for y0 in range(0, ny, tile_rows):
+        y1 = min(ny, y0+tile_rows)
+        if isinstance(frames, np.ndarray):
+            tile[:,:y1-y0] = frames[:,y0:y1]
+        else:
+            for i in range(len(frames)):
+                tile[i,:y1-y0] = frames[i].rows(y0, y1)
+        data = tile[:,:y1-y0]
+        if zero is not None:
+            data = zero_correct(data, zero[y0:y1])
+        if flat is not None:
+            data = flat_correct(data, flat[y0:y1], flat_mean)
+        combined[y0:y1] = combine_frames(data, combine, reject, scales,
+                                         **kwargs)
+    return combined
+
+def flatcombine(filenames, output=None, combine='median', reject='crreject',
+                scale='mode', minreplace=1.0, ram_budget=None):
+    """
+    Input: a list of paths to flats of a single band, the path of the combined
+    flat to write (optional; default is to write nothing), the type of
+    combining and rejection (optional; default is IRAF's 'median' and
+    'crreject'), the type of scaling ('mode' or 'none'; optional; default is
+    IRAF's 'mode'), the minimum value of the flat (optional; default is 1) and
+    the memory budget in bytes for tiled combining (optional; default is to
+    load all flats at once)
+    Output: the combined flat and its header
+    Equivalent to IRAF's ccdred.flatcombine with its default parameters. Each
+    flat is scaled by its mode (normalized to the mean mode of all flats) and
+    the flats are combined. Values below minreplace are replaced by minreplace,
+    as done by ccdproc, and the mean of the flat is recorded as CCDMEAN.
+    """
+    if ram_budget is None:
+        cube, header = load_cube(filenames)
+        frames = cube
+    else:
+        frames = [mapped_frame(f) for f in filenames]
+        header = frames[0].header.copy()
+    if scale == 'mode':
+        # with tiled combining, only one full flat is in memory at a time
+        scales = np.array([iraf_mode(frame if ram_budget is None else
+                                     frame.rows(0, frame.shape[0]))
+                           for frame in frames])
+        scales /= np.mean(scales)
+    else:
+        scales = None
+    if ram_budget is None:
+        flat = combine_frames(cube, combine, reject, scales)
+    else:
+        flat = tiled_combine(frames, combine, reject, scales,
+                             ram_budget=ram_budget)
+    flat[~np.isfinite(flat) | (flat < minreplace)] = minreplace
+
+    header['NCOMBINE'] = len(filenames)
+    header['CCDMEAN'] = float(np.mean(flat))
+    header['IMAGETYP'] = 'flat'
+    header['CCDPROC'] = 'Combined by reduction.py' # usable as-is by ccdproc
+    if output:
+        write_image(output, flat, header)
+    return flat, header
+
+def zerocombine(filenames, output=None, combine='average', reject='minmax',
+                ram_budget=None):
+    """
+    Input: a list of paths to biases, the path of the combined bias to write
+    (optional; default is to write nothing), the type of combining and
+    rejection (optional; default is IRAF's 'average' and 'minmax') and the
+    memory budget in bytes for tiled combining (optional; default is to load
+    all biases at once)
+    Output: the combined bias and its header
+    Equivalent to IRAF's ccdred.zerocombine with its default parameters: the
+    highest pixel is rejected and the remaining pixels are averaged.
+    """
+    if ram_budget is None:
+        cube, header = load_cube(filenames)
+        bias = combine_frames(cube, combine, reject, nlow=0, nhigh=1)
+    else:
+        frames = [mapped_frame(f) for f in filenames]
+        header = frames[0].header.copy()
+        bias = tiled_combine(frames, combine, reject, ram_budget=ram_budget,
+                             nlow=0, nhigh=1)
+    header['NCOMBINE'] = len(filenames)
+    header['IMAGETYP'] = 'zero'
+    header['CCDPROC'] = 'Combined by reduction.py'
+    if output:
+        write_image(output, bias, header)
+    return bias, header
+
+def zero_correct(data, bias):
+    """
+    Input: an image (or a cube of images) and a combined bias
+    Output: the bias-corrected image(s)
+    Equivalent to ccdproc with zerocor=yes.
+    """
+    return data - bias
+
+def flat_correct(data, flat, flat_mean=None):
+    """
+    Input: an image (or a cube of images), a combined flat and the mean of the
+    flat (optional; default is to compute it, which is only correct if the
+    full flat is given)
+    Output: the flat-corrected image(s)
+    Equivalent to ccdproc with flatcor=yes: the data is divided by the flat
+    normalized to a mean of 1.
+    """
+    if flat_mean is None:
+        flat_mean = np.mean(flat)
+    return data*(flat_mean/flat)
+
+def imcombine(cube, combine='average', reject='none'):
+    """
+    Input: a 3D array (frame, y, x), the type of combining and of rejection
+    (optional; default is IRAF's 'average' and 'none')
+    Output: the combined 2D image
+    Equivalent to IRAF's imcombine with its default parameters.
+    """
+    return combine_frames(cube, combine, reject)
+
+def stack_statistics(filenames, night=None):
+    """
+    Input: a list of paths to the object images of a stack, and the night 
+    from which to measure the timestamps (optional; default is the date of
+    the earliest frame; see headerstats.py)
+    Output: the stack size, the mean and standard deviation of the exposure
+    and the mean and standard deviation of the timestamp (in s)
+    """
+    return headerstats.stack_statistics(filenames, night)
+
+###############################################################################
+
+def _read_list(path):
+    """
+    Reads one of the lists written by raw_PESTO_data.make_working_directory.
+    """
+    f = open(path, 'r')
+    contents = [line.strip() for line in f.readlines()]
+    f.close()
+    return [c for c in contents if c]
+
+def reduce_filter(workdir, filter_type, ram_budget=None, library=None,
+                  bias=None, night=None):
+    """
+    Input: the working directory, the band to reduce, the memory budget in
+    bytes (optional; default is to load each stack entirely in memory), a
+    calibration_library from which to take the combined flat (optional;
+    default is to combine the flats of the working directory) and a combined
+    bias to subtract from the object images (optional; default is none) and
+    the night from which to measure the timestamps (optional; see
+    stack_statistics())
+    Output: the statistics of the stack (see stack_statistics()) or None if
+    there is nothing to reduce in this band
+    Combines the flats of the band into Flat_<band>.fits, corrects the object
+    images with this flat and stacks them into object_<band>_reduced.fits,
+    all within the working directory. Unlike ccdproc, the object images on disk
+    are left untouched. If a memory budget is given, the flats and objects are
+    stacked in tiles which fit within it (see tiled_combine()).
+    """
+    obj_list = workdir+'/object_list_'+filter_type+'.txt'
+    cal_list = workdir+'/'+filter_type+'_list.txt'
+    if not (os.path.exists(obj_list) and os.path.exists(cal_list)):
+        return None
+    objects = [resolve(workdir+'/'+f) for f in _read_list(obj_list)]
+    flats = [resolve(workdir+'/'+f) for f in _read_list(cal_list)]
+    if len(objects) == 0 or len(flats) == 0:
+        return None
+
+    stats = stack_statistics(objects, night)
+    if library is None:
+        flat = flatcombine(flats, workdir+'/Flat_'+filter_type+'.fits',
+                           ram_budget=ram_budget)[0]
+    else:
+        flat = library.install(library.master_flat(flats, filter_type,
+                                                   ram_budget),
+                               workdir+'/Flat_'+filter_type+'.fits')
+    if ram_budget is None:
+        cube, header = load_cube(objects)
+        if bias is not None:
+            cube = zero_correct(cube, bias)
+        stacked = imcombine(flat_correct(cube, flat))
+    else:
+        frames = [mapped_frame(f) for f in objects]
+        header = frames[0].header.copy()
+        stacked = tiled_combine(frames, 'average', 'none', flat=flat,
+                                ram_budget=ram_budget, zero=bias)
+    header['NCOMBINE'] = len(objects)
+    write_image(workdir+'/object_'+filter_type+'_reduced.fits', stacked,
+                header)
+    return stats
+
+def reduce_working_directory(workdir, results_file="results.txt",
+                             results_dir=RESULTS_DIRECTORY, ram_budget=None,
+                             library=None, zerocor=False, night=None,
+                             workers=None):
+    """
+    Input: the working directory produced by
+    raw_PESTO_data.make_working_directory(), the name of the results file to
+    which we save the data (optional; "results.txt" by default), the
+    directory of this results file (optional; same as datared.py by default;
+    ignored if results_file is an absolute path),
+    the memory budget in bytes for tiled stacking (optional; default is to
+    load each stack entirely in memory), a calibration_library in which to
+    look for (or store) the combined flats and bias (optional; default is to
+    combine them for this stack only) and whether to apply a bias correction
+    using the biases in bias_list.txt (optional; default is False, as the bias
+    correction is performed automatically at OMM) and the night from which to
+    measure the timestamps (optional; e.g. '2018-07-09'; default is the date
+    of the earliest frame of each stack) and the number of bands reduced at
+    once (optional; default is all the bands at once, 1 to reduce them one
+    after the other)
+    Output: None
+    Native equivalent of running datared.py in the working directory. For each
+    band, the stack size, exposure time, error on exposure, timestamp and
+    error on timestamp are appended to the results file (with no newline;
+    the photometry completes the line) and the reduced image is written.
+    The bands share no data, so each is reduced in its own process; the
+    results are still written in the order r, g, i, z. The memory budget
+    applies to each band. Within a worker of a pool (a daemonic process,
+    which cannot start processes of its own), the bands are reduced one
+    after the other.
+    """
+    bias = None
+    biases = []
+    if zerocor and os.path.exists(workdir+'/bias_list.txt'):
+        biases = [resolve(workdir+'/'+f) for f in
+                  _read_list(workdir+'/bias_list.txt')]
+    # as with the iraf backend, no correction without biases
+    if len(biases) > 0:
+        if library is None:
+            bias = zerocombine(biases, workdir+'/bias.fits',
+                               ram_budget=ram_budget)[0]
+        else:
+            bias = library.install(library.master_bias(biases, ram_budget),
+                                   workdir+'/bias.fits')
+
+    args = [(workdir, filter_type, ram_budget, library, bias, night) for
+            filter_type in ['r','g','i','z']]
+    if workers == 1 or current_process().daemon:
+        results = [reduce_filter(*a) for a in args]
+    else:
+        pool = Pool(workers or len(args))
+        results = pool.starmap(reduce_filter, args)
+        pool.close()
+        pool.join()
+
+    for stats in results:
+        if stats is None:
+            continue
+        tf = open(os.path.join(results_dir, results_file), 'a')
+        tf.write("\t".join([str(s) for s in stats])+"\t")
+        tf.close()
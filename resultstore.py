@@ -0,0 +1,199 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@resultstore.py
+
+A structured store (SQLite database) for the results of the pipeline, in
+place of appending to a text results file. Each stack is written as a single
+record, in a single transaction, holding both the statistics of the stack
+(see datared.py and reduction.py) and the photometry of the source (see
+aperturephotometry.py) in one band; pipeline.py writes the statistics
+together with the photometry of each band, so that a record is never split
+between the reduction and the photometry.
+
+The database is in write-ahead logging (WAL) mode, so that many processes
+(e.g. the jobs of pipeline.py) can write to it at once while others read it.
+Records are keyed by run (the name of the results file they replace),
+night, first frame of the stack and filter, and indexed by run and
+timestamp, for time-range reads, and can be exported to a text results file
+in the format expected by lightcurve.py.
+"""
+import time
+import sqlite3
+
+# statistics of a stack, as written by the reduction
+STATS = ['stack', 'exposure', 'exposure_err', 'time', 'time_err']
+
+# photometry of the source, as written by aperturephotometry.photometry()
+PHOTOMETRY = ['x', 'y', 'area', 'pc', 'pc_err', 'mag', 'mag_err', 'filter']
+
+# columns of the store, in order
+COLUMNS = (['run', 'night', 'first', 'status']+STATS+PHOTOMETRY+
+           ['directory', 'written'])
+
+# statuses of a record: the source was found, not found, or the photometry
+# did not complete (only the statistics were written)
+FOUND = 'found'
+NO_SOURCE = 'no source'
+INCOMPLETE = 'incomplete'
+
+
+def parse_line(line):
+    """
+    Input: a line of a text results file
+    Output: a dictionary of the statistics, photometry and status of the
+    stack, or None if the line does not even hold the statistics
+    The filter is the last field of a line with photometry, or follows the
+    NO SOURCE FOUND flag (see aperturephotometry.no_source_row()); it is None
+    for a line with no photometry.
+    """
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) < len(STATS):
+        return None
+    try:
+        record = dict(zip(STATS, [float(v) for v in fields[:len(STATS)]]))
+    except ValueError:
+        return None
+    record['stack'] = int(record['stack'])
+    rest = [v for v in fields[len(STATS):] if v != '']
+    if len(rest) == len(PHOTOMETRY):
+        try:
+            record.update(zip(PHOTOMETRY[:-1], [float(v) for v in rest[:-1]]))
+            record['filter'] = rest[-1]
+            record['status'] = FOUND
+            return record
+        except ValueError:
+            pass
+    record['filter'] = None
+    if len(rest) > 0 and 'SOURCE' in rest[0]:
+        record['status'] = NO_SOURCE
+        if len(rest) > 1:
+            record['filter'] = rest[-1]
+    else:
+        record['status'] = INCOMPLETE
+    return record
+
+def format_record(row):
+    """
+    Input: a record of the store (sqlite3.Row or dictionary)
+    Output: its line in a text results file, including the newline
+    """
+    line = '\t'.join([str(row[c]) for c in STATS])+'\t'
+    if row['status'] == FOUND:
+        line += '\t'.join([str(row[c]) for c in PHOTOMETRY])
+    elif row['status'] == NO_SOURCE:
+        line += 'NO SOURCE FOUND.'
+        if row['filter'] is not None:
+            line += '\t'+row['filter']
+    return line+'\n'
+
+class results_store:
+    """
+    Input:
+    db_path: the path to the SQLite database holding the results (created if
+             it does not exist)
+
+    Output: results_store object
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        types = {'first':'INTEGER', 'stack':'INTEGER',
+                 'exposure':'REAL', 'exposure_err':'REAL', 'time':'REAL',
+                 'time_err':'REAL', 'x':'REAL', 'y':'REAL', 'area':'REAL',
+                 'pc':'REAL', 'pc_err':'REAL', 'mag':'REAL', 'mag_err':'REAL',
+                 'written':'REAL'}
+        columns = [c+' '+types.get(c, 'TEXT') for c in COLUMNS]
+        # a stack written again (e.g. after a restart) replaces its records
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('+
+                        ', '.join(columns)+', PRIMARY KEY (run, night, '+
+                        'first, filter))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_time '+
+                        'ON results (run, time)')
+        self.db.commit()
+
+    def record(self, run, rows, night='', first=0, directory=None):
+        """
+        Input: the run (e.g. the name of the results file the rows would
+        have been appended to), the rows of a stack (the text written to a
+        results file, one line per band), the night and first frame of the
+        stack (optional; together with the run, they identify the stack) and
+        the directory in which it was reduced (optional)
+        Output: the number of records written
+        All the records of the stack are written in one transaction, so that
+        readers never see a partial stack. Each record is keyed by the filter
+        of its line (see parse_line()). Lines which do not hold the
+        statistics of a stack are skipped.
+        """
+        records = []
+        for line in [l for l in rows.split('\n') if l]:
+            record = parse_line(line)
+            if record is None:
+                print("Skipping a broken results line: "+line)
+                continue
+            record.update({'run':run, 'night':night, 'first':first,
+                           'directory':directory, 'written':time.time()})
+            records.append(tuple([record.get(c) for c in COLUMNS]))
+        with self.db: # one transaction, committed (or rolled back) at once
+            self.db.execute('DELETE FROM results WHERE run=? AND night=? '+
+                            'AND first=?', (run, night, first))
+            self.db.executemany('INSERT INTO results VALUES ('+
+                                ', '.join(['?']*len(COLUMNS))+')', records)
+        return len(records)
+
+    def rows(self, run, t0=None, t1=None, status=None):
+        """
+        Input: the run, the range of timestamps to read (optional; default is
+        all) and the status of the records to read (optional; e.g. FOUND;
+        default is all)
+        Output: a list of records (sqlite3.Row, accessible by column name),
+        sorted by night, first frame and timestamp, and the records of a
+        stack in the order of its rows
+        """
+        query = 'SELECT * FROM results WHERE run=?'
+        values = [run]
+        if t0 is not None:
+            query += ' AND time>=?'
+            values.append(t0)
+        if t1 is not None:
+            query += ' AND time<=?'
+            values.append(t1)
+        if status is not None:
+            query += ' AND status=?'
+            values.append(status)
+        # records are inserted in the order of the rows of their stack
+        query += ' ORDER BY night, first, time, rowid'
+        return self.db.execute(query, values).fetchall()
+
+    def runs(self):
+        """
+        Input: None
+        Output: a list of the runs in the store
+        """
+        return [r[0] for r in self.db.execute('SELECT DISTINCT run FROM '+
+                                              'results ORDER BY run')]
+
+    def export(self, run, output_path, complete=True):
+        """
+        Input: the run, the path of the text results file to write, and
+        whether to leave out records whose photometry did not complete
+        (optional; default True)
+        Output: the number of lines written
+        Writes the records of the run in the format of the text results files
+        (see lightcurve.py), in order.
+        """
+        rows = self.rows(run)
+        if complete:
+            rows = [r for r in rows if r['status'] != INCOMPLETE]
+        f = open(output_path, 'w')
+        f.write(''.join([format_record(r) for r in rows]))
+        f.close()
+        return len(rows)
+
+    def close(self):
+        """
+        Input: None
+        Output: None
+        """
+        self.db.close()
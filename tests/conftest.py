@@ -0,0 +1,69 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@conftest.py
+
+Shared fixtures of the tests: small synthetic frames written as .fits files
+(optionally compressed), with the header keywords of PESTO frames.
+"""
+import os
+import sys
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+# the modules of the pipeline are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+
+def frame_header(date, exposure=100.0, filt='r', imagetyp='object'):
+    """
+    Input: the DATE of the frame, its exposure (optional; default 100), its
+    filter (optional; default 'r') and its image type (optional; default
+    'object')
+    Output: a header of a PESTO frame
+    """
+    header = fits.Header()
+    header['DATE'] = date
+    header['EXPOSURE'] = exposure
+    header['FILTRE'] = filt
+    header['IMAGETYP'] = imagetyp
+    return header
+
+@pytest.fixture
+def write_frame():
+    """
+    Output: a function writing a frame, given its path, data and DATE (and
+    any other keyword of frame_header()), and how to compress it: None,
+    'gz' (gzip, as .fits.gz) or 'fz' (tile compression, as .fits.fz); it
+    returns the path written
+    """
+    def write(path, data, date='2019-03-12T03:00:00.000', compress=None,
+              **kwargs):
+        header = frame_header(date, **kwargs)
+        if compress == 'fz':
+            path += '.fz'
+            fits.HDUList([fits.PrimaryHDU(), 
+                          fits.CompImageHDU(data, header)]).writeto(path)
+            return path
+        fits.PrimaryHDU(data, header).writeto(path)
+        if compress == 'gz':
+            f = open(path, 'rb')
+            g = gzip.open(path+'.gz', 'wb')
+            shutil.copyfileobj(f, g)
+            g.close()
+            f.close()
+            os.remove(path)
+            path += '.gz'
+        return path
+    return write
+
+@pytest.fixture
+def rng():
+    """
+    Output: a seeded random number generator
+    """
+    return np.random.default_rng(42)
@@ -0,0 +1,74 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@test_compressed_frames.py
+
+Reading compressed frames directly in the numpy reduction: gzipped frames
+(.fits.gz) and tile-compressed frames (.fits.fz, see PESTO_lib.fpack_frame()).
+"""
+import os
+
+import numpy as np
+
+import PESTO_lib
+import reduction
+
+
+def test_gz_rows_match_data(tmp_path, write_frame, rng):
+    # unsigned 16-bit data, stored with BZERO as raw PESTO frames are
+    data = rng.integers(0, 65535, (40, 13)).astype(np.uint16)
+    path = write_frame(str(tmp_path/'frame.fits'), data, compress='gz')
+    frame = reduction.mapped_frame(path)
+    assert frame.shape == data.shape
+    # in order (one pass of the decompressor), then from the start again
+    tiles = [frame.rows(y, min(40, y+7)) for y in range(0, 40, 7)]
+    assert np.array_equal(np.concatenate(tiles), data)
+    assert np.array_equal(frame.rows(3, 9), data[3:9])
+    assert np.array_equal(reduction.load_frame(path)[0], data)
+
+def test_gz_frames_match_uncompressed(tmp_path, write_frame, rng):
+    cube = rng.normal(1000.0, 30.0, (5, 20, 8)).astype(np.float32)
+    (tmp_path/'gz').mkdir()
+    (tmp_path/'plain').mkdir()
+    gz = [write_frame(str(tmp_path/'gz'/('f%d.fits' % i)), frame,
+                      compress='gz') for i, frame in enumerate(cube)]
+    plain = [write_frame(str(tmp_path/'plain'/('f%d.fits' % i)), frame)
+             for i, frame in enumerate(cube)]
+    # the lists of raw_PESTO_data name the decompressed files
+    assert reduction.resolve(str(tmp_path/'gz'/'f0.fits')) == gz[0]
+    budget = len(cube)*8*8*reduction.TILE_OVERHEAD*6
+    expected = reduction.tiled_combine(plain, 'median', 'crreject',
+                                       ram_budget=budget)
+    assert np.array_equal(reduction.tiled_combine(gz, 'median', 'crreject',
+                                                  ram_budget=budget),
+                          expected)
+    assert np.array_equal(reduction.load_cube(gz)[0], cube)
+
+def test_fz_round_trip(tmp_path, write_frame, rng):
+    data = rng.integers(0, 65535, (40, 13)).astype(np.uint16)
+    path = write_frame(str(tmp_path/'frame.fits'), data)
+    PESTO_lib.fpack_frame((path, 'RICE_1', 16, True))
+    assert not os.path.exists(path)
+    fz = path+PESTO_lib.FPACK_EXTENSION
+    assert reduction.resolve(path) == fz
+    # headers and sections are read without decompressing the whole image
+    assert PESTO_lib.read_header(fz)['FILTRE'] == 'r'
+    assert np.array_equal(PESTO_lib.read_section(fz, 5, 17, 2, 9),
+                          data[5:17, 2:9])
+    PESTO_lib.funpack_frame((fz, False))
+    assert np.array_equal(reduction.load_frame(path)[0], data)
+
+def test_fz_frames_match_uncompressed(tmp_path, write_frame, rng):
+    cube = rng.integers(500, 1500, (5, 20, 8)).astype(np.int32)
+    plain = [write_frame(str(tmp_path/('f%d.fits' % i)), frame)
+             for i, frame in enumerate(cube)]
+    fz = [write_frame(str(tmp_path/('g%d.fits' % i)), frame, compress='fz')
+          for i, frame in enumerate(cube)]
+    frame = reduction.mapped_frame(fz[0])
+    assert frame.tiled
+    assert np.array_equal(frame.rows(4, 11), cube[0, 4:11])
+    budget = len(cube)*8*8*reduction.TILE_OVERHEAD*6
+    assert np.array_equal(reduction.tiled_combine(fz, 'median', 'crreject',
+                                                  ram_budget=budget),
+                          reduction.tiled_combine(plain, 'median', 'crreject',
+                                                  ram_budget=budget))
+    assert np.array_equal(reduction.load_cube(fz)[0], cube)
@@ -0,0 +1,83 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@test_journal.py
+
+Resuming a run of pipeline.py from its journal: completed stacks are not
+run again, and no row is written twice or out of order.
+"""
+import os
+import json
+
+import pipeline
+
+# starts of the stacks which fail, and the log of the stacks run (set by the
+# tests before the pool is started)
+FAILING = set()
+LOG = None
+
+
+def fake_run_job(job, staged=None):
+    """
+    Stands in for pipeline.run_job(): writes one row per stack, or fails.
+    """
+    f = open(LOG, 'a')
+    f.write(str(job['start'])+'\n')
+    f.close()
+    if job['start'] in FAILING:
+        return None
+    return dict([(night, 'row of stack '+str(job['start'])+'\n') for
+                 night, path in pipeline.streams(job)])
+
+def write_config(tmp_path, nframes=10, stack=2):
+    """
+    Input: the directory of the test, the number of frames of the night and
+    the stack size
+    Output: the path to the config, and to the results file of the night
+    """
+    frames = tmp_path/'frames'
+    frames.mkdir()
+    for n in range(nframes):
+        (frames/('190312_%010d.fits' % n)).write_bytes(b'')
+    config = {'target':str(tmp_path/'target'), 'stack':stack,
+              'processes':1, 'results_dir':str(tmp_path),
+              'nights':{'190312':{'frames':str(frames/'*.fits'),
+                                  'results_file':'results_190312.txt'}}}
+    path = str(tmp_path/'config.json')
+    f = open(path, 'w')
+    json.dump(config, f)
+    f.close()
+    return path, str(tmp_path/'results_190312.txt')
+
+def test_resume_writes_each_row_once(tmp_path, monkeypatch):
+    global LOG
+    LOG = str(tmp_path/'log.txt')
+    monkeypatch.setattr(pipeline, 'run_job', fake_run_job)
+    config, results = write_config(tmp_path)
+    # rows written before the first run are kept
+    f = open(results, 'w')
+    f.write('earlier row\n')
+    f.close()
+
+    FAILING.add(4)
+    try:
+        assert pipeline.run_pipeline(config) == 1
+    finally:
+        FAILING.clear()
+    assert open(results).read() == ''.join(
+            ['earlier row\n']+['row of stack %d\n' % s for s in [0,2,6,8]])
+
+    # a crash in the middle of writing a row
+    f = open(results, 'a')
+    f.write('row of st')
+    f.close()
+    os.remove(LOG)
+    assert pipeline.run_pipeline(config) == 0
+    assert open(LOG).read() == '4\n' # only the failed stack is run again
+    assert open(results).read() == ''.join(
+            ['earlier row\n']+['row of stack %d\n' % s for s in range(0,10,2)])
+
+    # nothing left to run
+    os.remove(LOG)
+    assert pipeline.run_pipeline(config) == 0
+    assert not os.path.exists(LOG)
+    assert open(results).read().count('row of stack 4\n') == 1
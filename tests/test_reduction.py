@@ -0,0 +1,70 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@test_reduction.py
+
+The numpy reduction backend (reduction.py) against the same reduction done
+by hand, in memory.
+"""
+import numpy as np
+from astropy.io import fits
+
+import reduction
+
+
+def make_working_directory(workdir, write_frame, rng, nflats=4, nobjects=5):
+    """
+    Input: the working directory, the write_frame fixture, a random number
+    generator, and the numbers of flats and object images
+    Output: the flat pattern and the object images written
+    Writes the flats and object images of the r band, and their lists, as
+    raw_PESTO_data.make_working_directory() does.
+    """
+    pattern = rng.uniform(0.8, 1.2, (12, 9))
+    flats = []
+    for i in range(nflats):
+        name = 'flat_%d.fits' % i
+        write_frame(str(workdir/name), (10000.0*(i+1)*pattern
+                                        ).astype(np.float32),
+                    imagetyp='flat')
+        flats.append(name)
+    objects, data = [], []
+    for i in range(nobjects):
+        name = 'object_%d.fits' % i
+        image = (rng.uniform(100.0, 200.0, (12, 9))*pattern).astype(np.float32)
+        write_frame(str(workdir/name), image,
+                    date='2019-03-12T03:00:%02d.000' % (10*i))
+        objects.append(name)
+        data.append(image)
+    (workdir/'r_list.txt').write_text('\n'.join(flats)+'\n')
+    (workdir/'object_list_r.txt').write_text('\n'.join(objects)+'\n')
+    return pattern, np.array(data, dtype=np.float64)
+
+def expected_stack(pattern, data):
+    """
+    Input: the flat pattern and the object images
+    Output: the flat-corrected average of the object images
+    """
+    return np.mean(data*np.mean(pattern)/pattern, axis=0)
+
+def test_numpy_backend_matches_in_memory_combine(tmp_path, write_frame, rng):
+    pattern, data = make_working_directory(tmp_path, write_frame, rng)
+    reduction.reduce_working_directory(str(tmp_path), 'results.txt',
+                                       results_dir=str(tmp_path), workers=1)
+    stacked = fits.getdata(str(tmp_path/'object_r_reduced.fits'))
+    assert np.allclose(stacked, expected_stack(pattern, data), rtol=1e-5)
+    assert fits.getheader(str(tmp_path/'object_r_reduced.fits')
+                          )['NCOMBINE'] == 5
+
+    fields = (tmp_path/'results.txt').read_text().split('\t')
+    assert int(fields[0]) == 5
+    assert float(fields[1]) == 100.0
+    assert float(fields[3]) == 3*3600.0+20.0 # the mean timestamp, in s
+
+def test_memory_budget_matches_in_memory_combine(tmp_path, write_frame, rng):
+    make_working_directory(tmp_path, write_frame, rng)
+    reduction.reduce_filter(str(tmp_path), 'r')
+    full = fits.getdata(str(tmp_path/'object_r_reduced.fits'))
+    # a budget of a few rows, so that the stack is combined in several tiles
+    reduction.reduce_filter(str(tmp_path), 'r', ram_budget=3*5*9*8*4)
+    tiled = fits.getdata(str(tmp_path/'object_r_reduced.fits'))
+    assert np.array_equal(full, tiled)
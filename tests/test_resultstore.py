@@ -0,0 +1,63 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@test_resultstore.py
+
+Round trip of the rows of a text results file through the results store
+(resultstore.py).
+"""
+import resultstore
+import aperturephotometry
+
+STATS = '1000\t100.0\t0.0\t%s\t288.6\t'
+
+# the rows of two stacks: each band found, or not
+FIRST = (STATS % '10800.5'+
+         '512.3\t498.1\t42.0\t15000.0\t130.0\t16.2\t0.01\tr\n'+
+         STATS % '10800.5'+aperturephotometry.no_source_row('g'))
+SECOND = (STATS % '11800.5'+
+          '512.1\t498.4\t40.0\t14000.0\t125.0\t16.3\t0.01\tr\n'+
+          STATS % '11800.5'+
+          '511.9\t498.0\t41.0\t9000.0\t100.0\t17.1\t0.01\tg\n')
+
+
+def test_parse_line():
+    found, missing = [resultstore.parse_line(l) for l in FIRST.splitlines()]
+    assert found['status'] == resultstore.FOUND
+    assert found['stack'] == 1000 and found['filter'] == 'r'
+    assert found['mag'] == 16.2
+    assert missing['status'] == resultstore.NO_SOURCE
+    assert missing['filter'] == 'g'
+    # only the statistics: the photometry did not complete
+    assert resultstore.parse_line(STATS % '1.0')['status'] == (
+            resultstore.INCOMPLETE)
+    assert resultstore.parse_line('10\t100') is None
+
+def test_store_round_trip(tmp_path):
+    store = resultstore.results_store(str(tmp_path/'results.sqlite'))
+    # written out of order, as by parallel jobs
+    assert store.record('results_190312.txt', SECOND, '190312', 1000) == 2
+    assert store.record('results_190312.txt', FIRST, '190312', 0) == 2
+    assert store.runs() == ['results_190312.txt']
+    assert store.export('results_190312.txt', str(tmp_path/'out.txt')) == 4
+    assert (tmp_path/'out.txt').read_text() == FIRST+SECOND
+    assert len(store.rows('results_190312.txt', 11000.0, 12000.0)) == 2
+    assert len(store.rows('results_190312.txt', 
+                          status=resultstore.NO_SOURCE)) == 1
+
+    # a stack written again replaces its records
+    store.record('results_190312.txt', SECOND.splitlines(True)[0], 
+                 '190312', 1000)
+    store.close()
+    store = resultstore.results_store(str(tmp_path/'results.sqlite'))
+    assert [r['filter'] for r in store.rows('results_190312.txt')] == [
+            'r', 'g', 'r']
+    store.close()
+
+def test_export_leaves_out_incomplete_rows(tmp_path):
+    store = resultstore.results_store(str(tmp_path/'results.sqlite'))
+    store.record('run', FIRST, '190312', 0)
+    store.record('run', STATS % '11800.5'+'\n', '190312', 1000)
+    assert store.export('run', str(tmp_path/'out.txt')) == 2
+    assert (tmp_path/'out.txt').read_text() == FIRST
+    assert store.export('run', str(tmp_path/'all.txt'), complete=False) == 3
+    store.close()
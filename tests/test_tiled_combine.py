@@ -0,0 +1,59 @@
+"""
+@authors: Valérie Desharnais & Nicholas Vieira
+@test_tiled_combine.py
+
+Tiled (out-of-core) combining (reduction.tiled_combine()) against combining
+the full cube at once (reduction.combine_frames()).
+"""
+import numpy as np
+import pytest
+
+import reduction
+
+# combining and rejection types of IRAF's imcombine
+METHODS = [('average', 'none'), ('median', 'none'), ('average', 'minmax'),
+           ('median', 'crreject'), ('average', 'sigclip')]
+
+
+def budget(cube, rows):
+    """
+    Input: a cube, and the number of rows per tile
+    Output: the memory budget giving tiles of this many rows
+    """
+    return len(cube)*cube.shape[2]*8*reduction.TILE_OVERHEAD*rows
+
+@pytest.fixture
+def cube(rng):
+    """
+    Output: a cube of 7 frames with a few cosmic rays
+    """
+    cube = rng.normal(1000.0, 30.0, (7, 23, 11))
+    cube[2, 5, 3] = 1e5
+    cube[4, 17, 8] = 5e4
+    return cube
+
+@pytest.mark.parametrize('combine,reject', METHODS)
+@pytest.mark.parametrize('rows', [1, 4, 23])
+def test_tiled_matches_full(cube, combine, reject, rows):
+    full = reduction.combine_frames(cube, combine, reject)
+    tiled = reduction.tiled_combine(cube, combine, reject,
+                                    ram_budget=budget(cube, rows))
+    assert np.allclose(tiled, full, rtol=0, atol=1e-9)
+
+def test_tiled_files_match_full(tmp_path, cube, write_frame):
+    paths = [write_frame(str(tmp_path/('frame_%d.fits' % i)), frame)
+             for i, frame in enumerate(cube)]
+    full = reduction.combine_frames(cube, 'median', 'crreject')
+    tiled = reduction.tiled_combine(paths, 'median', 'crreject',
+                                    ram_budget=budget(cube, 4))
+    assert np.allclose(tiled, full, rtol=0, atol=1e-9)
+
+def test_tiled_corrections_match_full(cube, rng):
+    flat = rng.uniform(0.9, 1.1, cube.shape[1:])
+    bias = rng.normal(300.0, 2.0, cube.shape[1:])
+    full = reduction.combine_frames(
+            reduction.flat_correct(reduction.zero_correct(cube, bias), flat),
+            'average', 'none')
+    tiled = reduction.tiled_combine(cube, 'average', 'none', flat=flat,
+                                    ram_budget=budget(cube, 5), zero=bias)
+    assert np.allclose(tiled, full, rtol=0, atol=1e-9)